@@ -1,15 +1,39 @@
 from __future__ import annotations
 
+import time
 from abc import ABCMeta, abstractmethod
 from asyncio import get_running_loop
-from collections.abc import Awaitable, Iterable
+from collections.abc import AsyncIterable, AsyncIterator, Awaitable, Iterable
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
 from email.headerregistry import Address
 from email.message import EmailMessage
-from mimetypes import guess_type
 from pathlib import Path
-from typing import Any, Union
+from typing import TYPE_CHECKING, Any, NamedTuple, Union
+
+from .attachments import AttachmentLoader
+from .idempotency import IdempotencyCache, get_idempotency_key, set_idempotency_key
+from .scheduler import DeliveryScheduler
+from .tracing import Span, _null_span, _NullSpan, child_span
+from .utils import (
+    _attach,
+    _create_attachment,
+    estimate_size,
+    get_recipients,
+    get_transfer_encoding,
+    iterate_messages,
+)
+
+if TYPE_CHECKING:
+    from .concurrency import ByteBudget
+    from .dkim import DKIMSigner
+    from .journal import DeliveryJournal
+    from .tracing import Tracer
 
 AddressListType = Union[str, Address, "Iterable[str | Address]"]
+MessagesType = Union[
+    EmailMessage, "Iterable[EmailMessage]", "AsyncIterable[EmailMessage]"
+]
 
 
 class DeliveryError(Exception):
@@ -27,19 +51,72 @@ class DeliveryError(Exception):
         return f"error sending mail message: {self.args[0]}"
 
 
+class DeliveryResult(NamedTuple):
+    """
+    The outcome of delivering a single message with :meth:`Mailer.deliver_iter`.
+
+    :ivar message: the message that was delivered (or failed to be delivered)
+    :ivar error: the error that caused the delivery to fail, or ``None`` on success
+    """
+
+    message: EmailMessage
+    error: DeliveryError | None = None
+
+
 class Mailer(metaclass=ABCMeta):
     """
     This is the abstract base class for all mailers.
 
     :param message_defaults: default values for omitted keyword arguments of
         :meth:`create_message`
+
+    :cvar supports_8bit: ``True`` if the backend can transfer 8-bit message bodies
+        without encoding them first; this is used by :meth:`create_message` to pick
+        the content transfer encoding of the message body
+    :ivar dkim_signer: if set, used by backends to add a DKIM signature to each message
+        they deliver (see :meth:`sign_message`)
+    :vartype dkim_signer: ~asphalt.mailer.dkim.DKIMSigner | None
+    :ivar idempotency_cache: if set, used by backends to skip messages with an
+        idempotency key that has already been delivered (see :meth:`claim_message`)
+    :vartype idempotency_cache: ~asphalt.mailer.idempotency.IdempotencyCache | None
+    :ivar scheduler: holds the messages passed to :meth:`deliver_at` and
+        :meth:`deliver_after` until they're due
+    :vartype scheduler: ~asphalt.mailer.scheduler.DeliveryScheduler | None
+    :ivar journal: if set, used by backends to record each delivery attempt (see
+        :meth:`record_delivery`)
+    :vartype journal: ~asphalt.mailer.journal.DeliveryJournal | None
+    :ivar byte_budget: if set, used by backends to limit the total size of the messages
+        being delivered at once (see :meth:`reserve_bytes`)
+    :vartype byte_budget: ~asphalt.mailer.concurrency.ByteBudget | None
+    :ivar tracer: if set, used to time the operations of the mailer (see :meth:`trace`)
+    :vartype tracer: ~asphalt.mailer.tracing.Tracer | None
+    :ivar attachment_loader: reads the files passed to :meth:`add_file_attachments`
+    :vartype attachment_loader: ~asphalt.mailer.attachments.AttachmentLoader | None
     """
 
-    __slots__ = "message_defaults"
+    __slots__ = (
+        "message_defaults",
+        "dkim_signer",
+        "idempotency_cache",
+        "scheduler",
+        "journal",
+        "byte_budget",
+        "tracer",
+        "attachment_loader",
+    )
+
+    supports_8bit = True
 
     def __init__(self, message_defaults: dict[str, Any] | None = None):
         self.message_defaults = message_defaults or {}
         self.message_defaults.setdefault("charset", "utf-8")
+        self.dkim_signer: DKIMSigner | None = None
+        self.idempotency_cache: IdempotencyCache | None = None
+        self.scheduler: DeliveryScheduler | None = None
+        self.journal: DeliveryJournal | None = None
+        self.byte_budget: ByteBudget | None = None
+        self.tracer: Tracer | None = None
+        self.attachment_loader: AttachmentLoader | None = None
 
     async def start(self) -> None:
         """
@@ -74,35 +151,53 @@ class Mailer(metaclass=ABCMeta):
         :param html_body: HTML body
 
         """
-        msg = EmailMessage()
-        msg["Subject"] = subject or self.message_defaults.get("subject")
-
-        sender = sender or self.message_defaults.get("sender")
-        if sender:
-            msg["From"] = sender
-
-        to = to or self.message_defaults.get("to")
-        if to:
-            msg["To"] = to
-
-        cc = cc or self.message_defaults.get("cc")
-        if cc:
-            msg["Cc"] = cc
-
-        bcc = bcc or self.message_defaults.get("bcc")
-        if bcc:
-            msg["Bcc"] = bcc
-
-        charset = charset or self.message_defaults.get("charset")
-        if plain_body is not None and html_body is not None:
-            msg.set_content(plain_body, charset=charset)
-            msg.add_alternative(html_body, charset=charset, subtype="html")
-        elif plain_body is not None:
-            msg.set_content(plain_body, charset=charset)
-        elif html_body is not None:
-            msg.set_content(html_body, charset=charset, subtype="html")
-
-        return msg
+        with self.trace("create_message"):
+            msg = EmailMessage()
+            msg["Subject"] = subject or self.message_defaults.get("subject")
+
+            sender = sender or self.message_defaults.get("sender")
+            if sender:
+                msg["From"] = sender
+
+            to = to or self.message_defaults.get("to")
+            if to:
+                msg["To"] = to
+
+            cc = cc or self.message_defaults.get("cc")
+            if cc:
+                msg["Cc"] = cc
+
+            bcc = bcc or self.message_defaults.get("bcc")
+            if bcc:
+                msg["Bcc"] = bcc
+
+            charset = charset or self.message_defaults.get("charset") or "utf-8"
+            if plain_body is not None and html_body is not None:
+                msg.set_content(
+                    plain_body, charset=charset, cte=self._get_cte(plain_body, charset)
+                )
+                msg.add_alternative(
+                    html_body,
+                    charset=charset,
+                    subtype="html",
+                    cte=self._get_cte(html_body, charset),
+                )
+            elif plain_body is not None:
+                msg.set_content(
+                    plain_body, charset=charset, cte=self._get_cte(plain_body, charset)
+                )
+            elif html_body is not None:
+                msg.set_content(
+                    html_body,
+                    charset=charset,
+                    subtype="html",
+                    cte=self._get_cte(html_body, charset),
+                )
+
+            return msg
+
+    def _get_cte(self, body: str, charset: str) -> str:
+        return get_transfer_encoding(body, charset, self.supports_8bit)
 
     @classmethod
     def add_attachment(
@@ -124,23 +219,9 @@ class Mailer(metaclass=ABCMeta):
         :param mimetype: the MIME type indicating the type of the file
 
         """
-        if not mimetype:
-            mimetype, _encoding = guess_type(filename, False)
-            if not mimetype:
-                mimetype = "application/octet-stream"
-
-        maintype, subtype = mimetype.split("/", 1)
-        if not maintype or not subtype:
-            raise ValueError(
-                'mimetype must be a string in the "maintype/subtype" format'
-            )
-
-        msg.add_attachment(
-            content,
-            maintype=maintype,
-            subtype=subtype,
-            filename=filename,
-        )
+        with child_span("add_attachment", size=len(content)):
+            part = _create_attachment(content, filename, mimetype, msg.policy)
+            _attach(msg, part)
 
     @classmethod
     async def add_file_attachment(
@@ -166,23 +247,313 @@ class Mailer(metaclass=ABCMeta):
         content = await get_running_loop().run_in_executor(None, path.read_bytes)
         cls.add_attachment(msg, content, filename or path.name, mimetype)
 
-    def create_and_deliver(self, **kwargs: Any) -> Awaitable[None]:
+    async def add_file_attachments(
+        self, msg: EmailMessage, paths: Iterable[str | Path]
+    ) -> None:
+        """
+        Read the contents of several files and add them as attachments to the given
+        message.
+
+        The files are read and encoded concurrently by :attr:`attachment_loader`, on a
+        thread pool of its own. If no loader has been set, one with the default settings
+        is used for this call only. The displayed file names are the names of the files,
+        and the MIME types are guessed from them.
+
+        Unlike :meth:`add_file_attachment`, this is an instance method, as it uses the
+        loader (and the tracer) of the mailer.
+
+        If any of the files is too large for the loader, no attachments are added.
+
+        :param msg: the message
+        :param paths: paths to the files to attach
+        :raises ValueError: if a file, or the files together, exceed the size limits of
+            the loader
+
+        """
+        loader = self.attachment_loader or AttachmentLoader()
+        paths = list(paths)
+        try:
+            with self.trace("add_file_attachments", files=len(paths)):
+                parts = await loader.load(paths, msg.policy)
+                for part in parts:
+                    _attach(msg, part)
+        finally:
+            if loader is not self.attachment_loader:
+                await loader.close()
+
+    async def sign_message(self, data: bytes) -> bytes:
+        """
+        Add a DKIM signature to a serialized message using :attr:`dkim_signer`.
+
+        The signing is done in a worker thread so it won't block the event loop. If no
+        signer has been set, the data is returned as is.
+
+        Backends should call this with the final serialized form of each message, right
+        before transmitting it.
+
+        :param data: the message as it will be transmitted
+        :return: the signed message
+
+        """
+        if self.dkim_signer is None:
+            return data
+
+        with self.trace("sign"):
+            return await get_running_loop().run_in_executor(
+                None, self.dkim_signer.sign, data
+            )
+
+    async def claim_message(self, message: EmailMessage) -> bool:
+        """
+        Check if a message should be delivered, based on its idempotency key.
+
+        If the message has an idempotency key and :attr:`idempotency_cache` has been
+        set, the key is claimed in the cache. If the key had already been claimed, the
+        message is a duplicate and should be skipped. If the delivery the key was
+        claimed for is still in progress, this waits for it to finish, and claims the
+        key after all if that delivery failed.
+
+        Backends should call this for each message before delivering it, and then call
+        either :meth:`release_message` if the delivery fails, or
+        :meth:`complete_message` otherwise.
+
+        :param message: the message about to be delivered
+        :return: ``False`` if the message is a duplicate, ``True`` otherwise
+
+        """
+        if self.idempotency_cache is None:
+            return True
+
+        key = get_idempotency_key(message)
+        if key is None:
+            return True
+
+        while not self.idempotency_cache.claim(key):
+            if not await self.idempotency_cache.wait(key):
+                return False
+
+        return True
+
+    def complete_message(self, message: EmailMessage) -> None:
+        """
+        Mark the delivery of a message claimed with :meth:`claim_message` as finished.
+
+        This lets the duplicates waiting for the delivery to finish be skipped. It does
+        nothing if the message was already released with :meth:`release_message`, so
+        it's safe to call this in a ``finally:`` block.
+
+        :param message: the message that was claimed with :meth:`claim_message`
+
+        """
+        if self.idempotency_cache is not None:
+            key = get_idempotency_key(message)
+            if key is not None:
+                self.idempotency_cache.complete(key)
+
+    def release_message(self, message: EmailMessage) -> None:
+        """
+        Release the idempotency key of a message that failed to be delivered.
+
+        This allows the delivery to be retried with the same key.
+
+        :param message: the message that was claimed with :meth:`claim_message`
+
+        """
+        if self.idempotency_cache is not None:
+            key = get_idempotency_key(message)
+            if key is not None:
+                self.idempotency_cache.release(key)
+
+    def trace(self, name: str, **attributes: Any) -> Span | _NullSpan:
+        """
+        Open a tracing span with :attr:`tracer`.
+
+        If no tracer has been set, this returns a context manager that does nothing.
+
+        Backends should use this to time connection setup (``<backend>.connect``,
+        ``<backend>.starttls``, ``<backend>.login``), serialization
+        (``<backend>.serialize``) and the delivery of each message (``<backend>.send``).
+
+        :param name: name of the operation
+        :param attributes: extra information about the operation
+        :return: a context manager
+
+        """
+        if self.tracer is None:
+            return _null_span
+
+        return self.tracer.span(name, **attributes)
+
+    @asynccontextmanager
+    async def reserve_bytes(self, *messages: EmailMessage) -> AsyncIterator[None]:
+        """
+        Reserve room in :attr:`byte_budget` for delivering the given messages.
+
+        The estimated size of the messages (see
+        :func:`~asphalt.mailer.utils.estimate_size`) is reserved for the duration of the
+        context block, waiting for room to free up if necessary. If no budget has been
+        set, this does nothing.
+
+        Backends should wrap the delivery of each message (or each batch of messages
+        delivered together) in this.
+
+        :param messages: the messages about to be delivered
+
+        """
+        if self.byte_budget is None:
+            yield
+        else:
+            size = sum(estimate_size(message) for message in messages)
+            async with self.byte_budget.reserve(size):
+                yield
+
+    def record_delivery(
+        self,
+        message: EmailMessage,
+        started: float,
+        *,
+        recipients: list[str] | None = None,
+        status: int | None = None,
+        size: int | None = None,
+        error: BaseException | None = None,
+    ) -> None:
+        """
+        Record a delivery attempt in :attr:`journal`, if one has been set.
+
+        Backends should call this once for each attempt to deliver a message, whether
+        it succeeded or not.
+
+        :param message: the message that was being delivered
+        :param started: the value of :func:`time.monotonic` when the attempt started
+        :param recipients: the email addresses the message was being delivered to
+            (defaults to all the recipients of the message)
+        :param status: the status code reported for the attempt (like the final SMTP
+            reply code)
+        :param size: size of the message as transmitted (in bytes)
+        :param error: the exception that caused the attempt to fail
+
+        """
+        if self.journal is None:
+            return
+
+        error_text: str | None = None
+        if isinstance(error, DeliveryError):
+            error_text = error.args[0]
+        elif error is not None:
+            error_text = str(error) or error.__class__.__name__
+
+        message_id = message["Message-ID"]
+        self.journal.record(
+            self.__class__.__name__,
+            str(message_id) if message_id is not None else None,
+            get_recipients(message) if recipients is None else recipients,
+            started,
+            status,
+            size,
+            error_text,
+        )
+
+    def create_and_deliver(
+        self, *, idempotency_key: str | None = None, **kwargs: Any
+    ) -> Awaitable[None]:
         """
         Build a new email message and deliver it.
 
         This is a shortcut to calling :meth:`create_message` and then passing the result
         to :meth:`deliver`.
 
+        :param idempotency_key: if given, attached to the message with
+            :func:`~asphalt.mailer.idempotency.set_idempotency_key`
         :param kwargs: keyword arguments passed to :meth:`create_message`
         """
 
         msg = self.create_message(**kwargs)
+        if idempotency_key is not None:
+            set_idempotency_key(msg, idempotency_key)
+
         return self.deliver(msg)
 
     @abstractmethod
-    async def deliver(self, messages: EmailMessage | Iterable[EmailMessage]) -> None:
+    async def deliver(self, messages: MessagesType) -> None:
         """
         Deliver the given message(s).
 
-        :param messages: the message or iterable of messages to deliver
+        Delivery stops at the first message that fails to be delivered.
+
+        :param messages: the message, or an iterable or asynchronous iterable of
+            messages to deliver
+        :raises DeliveryError: if a message could not be delivered
+        """
+
+    async def deliver_at(self, messages: MessagesType, when: datetime | float) -> None:
+        """
+        Schedule the given message(s) to be delivered at the given time.
+
+        The messages are held by :attr:`scheduler` until they're due, and then passed
+        to :meth:`deliver`. The component always sets up a scheduler; mailers created
+        without the component need one set (and started) explicitly.
+
+        :param messages: the message, or an iterable or asynchronous iterable of
+            messages to deliver
+        :param when: the time to deliver the messages at, as a
+            :class:`~datetime.datetime` (naive ones are taken as local time) or a UNIX
+            timestamp
+        :raises RuntimeError: if no scheduler has been set
+
+        """
+        if self.scheduler is None:
+            raise RuntimeError(
+                "no scheduler has been set on this mailer (set the scheduler attribute "
+                "to a DeliveryScheduler)"
+            )
+
+        if isinstance(when, datetime):
+            when = when.timestamp()
+
+        await self.scheduler.schedule(messages, when)
+
+    async def deliver_after(
+        self, messages: MessagesType, delay: timedelta | float
+    ) -> None:
+        """
+        Schedule the given message(s) to be delivered after a delay.
+
+        See :meth:`deliver_at` for details.
+
+        :param messages: the message, or an iterable or asynchronous iterable of
+            messages to deliver
+        :param delay: the delay, as a :class:`~datetime.timedelta` or in seconds
+
+        """
+        if isinstance(delay, timedelta):
+            delay = delay.total_seconds()
+
+        await self.deliver_at(messages, time.time() + delay)
+
+    async def deliver_iter(
+        self, messages: MessagesType
+    ) -> AsyncIterator[DeliveryResult]:
+        """
+        Deliver the given message(s), yielding the outcome of each one as it completes.
+
+        Unlike :meth:`deliver`, a message that fails to be delivered does not stop the
+        delivery of the rest. The messages are consumed lazily, so a large batch can be
+        streamed from an asynchronous source with the results persisted as they arrive.
+
+        The default implementation calls :meth:`deliver` for each message separately.
+        Backends should override this if they can share resources (like connections)
+        between messages.
+
+        :param messages: the message, or an iterable or asynchronous iterable of
+            messages to deliver
+        :return: an asynchronous iterator yielding a :class:`DeliveryResult` for each
+            message
+
         """
+        async for message in iterate_messages(messages):
+            try:
+                await self.deliver(message)
+            except DeliveryError as exc:
+                yield DeliveryResult(message, exc)
+            else:
+                yield DeliveryResult(message)
@@ -0,0 +1,133 @@
+"""Loading of file attachments."""
+
+from __future__ import annotations
+
+import os
+from asyncio import gather, get_running_loop
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+from email.policy import Policy
+from pathlib import Path
+
+from .utils import _create_attachment
+
+__all__ = ["AttachmentLoader"]
+
+
+class AttachmentLoader:
+    """
+    Reads and encodes files to be attached to messages on a dedicated thread pool.
+
+    Reading files and encoding their contents (as base64) are blocking operations. Doing
+    them on a pool of their own keeps messages with many attachments from competing with
+    everything else that uses the default executor of the event loop, and lets the
+    files of a single message be loaded concurrently.
+
+    Before any file is read, the sizes of all the files are checked against
+    ``max_file_size`` and ``max_total_size``, so an oversized file is rejected right
+    away instead of after reading (and encoding) everything else.
+
+    The loader is used by :meth:`~asphalt.mailer.api.Mailer.add_file_attachments`. It's
+    normally created by the component (with the ``attachment_loader`` option), and
+    closed when the context is torn down.
+
+    :param max_workers: maximum number of files to read and encode at once
+    :param max_file_size: maximum size of a single file (in bytes)
+    :param max_total_size: maximum combined size of the files loaded in one call (in
+        bytes)
+    """
+
+    __slots__ = ("max_workers", "max_file_size", "max_total_size", "_executor")
+
+    def __init__(
+        self,
+        max_workers: int = 4,
+        *,
+        max_file_size: int | None = None,
+        max_total_size: int | None = None,
+    ):
+        if max_workers < 1:
+            raise ValueError("max_workers must be at least 1")
+        if max_file_size is not None and max_file_size < 1:
+            raise ValueError("max_file_size must be at least 1")
+        if max_total_size is not None and max_total_size < 1:
+            raise ValueError("max_total_size must be at least 1")
+
+        self.max_workers = max_workers
+        self.max_file_size = max_file_size
+        self.max_total_size = max_total_size
+        self._executor: ThreadPoolExecutor | None = None
+
+    async def load(
+        self, paths: Iterable[str | Path], policy: Policy
+    ) -> list[EmailMessage]:
+        """
+        Read the given files and turn them into attachment parts.
+
+        The displayed file name of each attachment is the name of the file, and its MIME
+        type is guessed from the file name.
+
+        :param paths: paths to the files to load
+        :param policy: the policy of the message the attachments are meant for
+        :return: the attachment parts, in the same order as ``paths``
+        :raises ValueError: if a file, or the files together, are too large
+
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                self.max_workers, thread_name_prefix="asphalt-mailer-attachments"
+            )
+
+        loop = get_running_loop()
+        path_list = [Path(path) for path in paths]
+        results = await gather(
+            *[loop.run_in_executor(self._executor, os.stat, path) for path in path_list]
+        )
+        for path, stat_result in zip(path_list, results):
+            self._check_file_size(path, stat_result.st_size)
+
+        self._check_total_size(sum(result.st_size for result in results))
+        loaded = await gather(
+            *[
+                loop.run_in_executor(self._executor, self._load, path, policy)
+                for path in path_list
+            ]
+        )
+
+        # A file may have grown after its size was checked
+        self._check_total_size(sum(size for _, size in loaded))
+        return [part for part, _ in loaded]
+
+    def _load(self, path: Path, policy: Policy) -> tuple[EmailMessage, int]:
+        with path.open("rb") as file:
+            if self.max_file_size is not None:
+                content = file.read(self.max_file_size + 1)
+            else:
+                content = file.read()
+
+        self._check_file_size(path, len(content))
+        return _create_attachment(content, path.name, None, policy), len(content)
+
+    def _check_file_size(self, path: Path, size: int) -> None:
+        if self.max_file_size is not None and size > self.max_file_size:
+            raise ValueError(
+                f"{path} is larger than the maximum attachment size "
+                f"({self.max_file_size} bytes)"
+            )
+
+    def _check_total_size(self, size: int) -> None:
+        if self.max_total_size is not None and size > self.max_total_size:
+            raise ValueError(
+                f"the attachments are larger than the maximum total size "
+                f"({self.max_total_size} bytes)"
+            )
+
+    async def close(self) -> None:
+        """Shut down the thread pool."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(max_workers={self.max_workers})"
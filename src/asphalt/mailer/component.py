@@ -5,6 +5,12 @@ from typing import Any
 
 from asphalt.core import Component, Context, PluginContainer, qualified_name
 from asphalt.mailer.api import Mailer
+from asphalt.mailer.attachments import AttachmentLoader
+from asphalt.mailer.concurrency import ByteBudget
+from asphalt.mailer.idempotency import IdempotencyCache
+from asphalt.mailer.journal import DeliveryJournal
+from asphalt.mailer.scheduler import DeliveryScheduler
+from asphalt.mailer.tracing import Tracer
 
 mailer_backends = PluginContainer("asphalt.mailer.mailers", Mailer)
 logger = logging.getLogger(__name__)
@@ -16,17 +22,95 @@ class MailerComponent(Component):
 
     :param backend: entry point name of the mailer backend class
     :param resource_name: name of the mailer resource to be published
+    :param dkim: keyword arguments passed to :class:`~asphalt.mailer.dkim.DKIMSigner`
+        to sign all messages delivered by the mailer
+    :param idempotency: keyword arguments passed to
+        :class:`~asphalt.mailer.idempotency.IdempotencyCache` to skip messages whose
+        idempotency keys have already been delivered
+    :param scheduler: keyword arguments passed to
+        :class:`~asphalt.mailer.scheduler.DeliveryScheduler` to hold the messages
+        passed to :meth:`~asphalt.mailer.api.Mailer.deliver_at` and
+        :meth:`~asphalt.mailer.api.Mailer.deliver_after` (a scheduler with the default
+        settings is created if omitted)
+    :param journal: keyword arguments passed to
+        :class:`~asphalt.mailer.journal.DeliveryJournal` to record every delivery
+        attempt
+    :param byte_budget: limit on the total (estimated) size of the messages being
+        delivered at once: either a number of bytes, in which case a new
+        :class:`~asphalt.mailer.concurrency.ByteBudget` is created and also published
+        as a resource (under ``resource_name``) for other mailers to share, or the
+        resource name of an existing one
+    :param tracing: keyword arguments passed to
+        :class:`~asphalt.mailer.tracing.Tracer` to time the operations of the mailer
+    :param attachment_loader: keyword arguments passed to
+        :class:`~asphalt.mailer.attachments.AttachmentLoader` to read the files passed
+        to :meth:`~asphalt.mailer.api.Mailer.add_file_attachments` (a loader with the
+        default settings is created if omitted)
     :param mailer_args: keyword arguments passed to the mailer backend class
     """
 
     def __init__(
-        self, backend: str, resource_name: str = "default", **mailer_args: Any
+        self,
+        backend: str,
+        resource_name: str = "default",
+        dkim: dict[str, Any] | None = None,
+        idempotency: dict[str, Any] | None = None,
+        scheduler: dict[str, Any] | None = None,
+        journal: dict[str, Any] | None = None,
+        byte_budget: int | str | None = None,
+        tracing: dict[str, Any] | None = None,
+        attachment_loader: dict[str, Any] | None = None,
+        **mailer_args: Any,
     ):
         self.mailer = mailer_backends.create_object(backend, **mailer_args)
         self.resource_name = resource_name
+        self.byte_budget = byte_budget
+        if isinstance(byte_budget, int):
+            self.mailer.byte_budget = ByteBudget(byte_budget)
+        if dkim is not None:
+            from .dkim import DKIMSigner
+
+            self.mailer.dkim_signer = DKIMSigner(**dkim)
+
+        if idempotency is not None:
+            self.mailer.idempotency_cache = IdempotencyCache(**idempotency)
+
+        self.mailer.scheduler = DeliveryScheduler(self.mailer, **(scheduler or {}))
+
+        if journal is not None:
+            self.mailer.journal = DeliveryJournal(**journal)
+
+        if tracing is not None:
+            self.mailer.tracer = Tracer(**tracing)
+
+        self.mailer.attachment_loader = AttachmentLoader(**(attachment_loader or {}))
 
     async def start(self, ctx: Context) -> None:
+        if isinstance(self.byte_budget, str):
+            self.mailer.byte_budget = await ctx.request_resource(
+                ByteBudget, self.byte_budget
+            )
+        elif self.mailer.byte_budget is not None:
+            ctx.add_resource(self.mailer.byte_budget, self.resource_name)
+
+        if self.mailer.idempotency_cache is not None:
+            ctx.add_teardown_callback(self.mailer.idempotency_cache.close)
+
+        if self.mailer.journal is not None:
+            ctx.add_teardown_callback(self.mailer.journal.close)
+
+        if self.mailer.tracer is not None:
+            await self.mailer.tracer.start()
+            ctx.add_teardown_callback(self.mailer.tracer.close)
+
+        if self.mailer.attachment_loader is not None:
+            ctx.add_teardown_callback(self.mailer.attachment_loader.close)
+
         await self.mailer.start()
+        if self.mailer.scheduler is not None:
+            await self.mailer.scheduler.start()
+            ctx.add_teardown_callback(self.mailer.scheduler.close)
+
         ctx.add_resource(
             self.mailer, self.resource_name, types=[Mailer, type(self.mailer)]
         )
@@ -0,0 +1,315 @@
+"""Limiting of concurrent deliveries."""
+
+from __future__ import annotations
+
+import logging
+import time
+from asyncio import Future, get_running_loop
+from collections import deque
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from types import TracebackType
+
+__all__ = ["AdaptiveLimiter", "ByteBudget"]
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveLimiter:
+    """
+    Limits the number of concurrent deliveries, adjusting the limit to what the mail
+    server can handle.
+
+    The limit is adjusted using AIMD (additive increase, multiplicative decrease), the
+    same scheme TCP uses for congestion control:
+
+    * every delivery that completes in time raises the limit by ``1 / limit``, so the
+      limit goes up by about one for each full round of concurrent deliveries
+    * a delivery that failed due to overload (like a timeout or a ``4xx`` response) or
+      the smoothed delivery latency rising above ``latency_tolerance`` times the
+      lowest observed latency multiplies the limit by ``backoff``
+
+    Deliveries that were already in progress when the limit was decreased cannot
+    decrease it again, so a burst of failures only backs off once.
+
+    The limiter is used as an asynchronous context manager around each delivery, and
+    the outcome of the delivery is reported with :meth:`record`.
+
+    :param initial_limit: the limit to start with
+    :param min_limit: the lowest the limit can go
+    :param max_limit: the highest the limit can go
+    :param backoff: factor to multiply the limit by when overload is detected
+    :param latency_tolerance: how many times higher than the lowest observed latency
+        the smoothed latency can go before it's treated as a sign of overload (``None``
+        to only react to failures)
+    """
+
+    __slots__ = (
+        "min_limit",
+        "max_limit",
+        "backoff",
+        "latency_tolerance",
+        "_limit",
+        "_in_flight",
+        "_waiters",
+        "_latency",
+        "_min_latency",
+        "_last_decrease",
+    )
+
+    def __init__(
+        self,
+        *,
+        initial_limit: int = 4,
+        min_limit: int = 1,
+        max_limit: int = 100,
+        backoff: float = 0.5,
+        latency_tolerance: float | None = 3.0,
+    ):
+        if min_limit < 1:
+            raise ValueError("min_limit must be at least 1")
+        if max_limit < min_limit:
+            raise ValueError("max_limit must not be lower than min_limit")
+        if not 0 < backoff < 1:
+            raise ValueError("backoff must be between 0 and 1")
+
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self._limit = float(min(max(initial_limit, min_limit), max_limit))
+        self._in_flight = 0
+        self._waiters: deque[Future[None]] = deque()
+        self._latency: float | None = None
+        self._min_latency: float | None = None
+        self._last_decrease = float("-inf")
+
+    @property
+    def limit(self) -> int:
+        """The current maximum number of concurrent deliveries."""
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        """The number of deliveries currently in progress."""
+        return self._in_flight
+
+    @property
+    def latency(self) -> float | None:
+        """
+        The smoothed latency (in seconds) of recent deliveries, or ``None`` if nothing
+        has been recorded yet.
+        """
+        return self._latency
+
+    def _wake_waiters(self) -> None:
+        while self._waiters and self._in_flight < self.limit:
+            future = self._waiters.popleft()
+            if not future.done():
+                self._in_flight += 1
+                future.set_result(None)
+
+    async def acquire(self) -> None:
+        """Wait until a delivery can be started within the current limit."""
+        if not self._waiters and self._in_flight < self.limit:
+            self._in_flight += 1
+            return
+
+        future: Future[None] = get_running_loop().create_future()
+        self._waiters.append(future)
+        try:
+            await future
+        except BaseException:
+            if future.done() and not future.cancelled():
+                # The slot was granted right before the cancellation
+                self.release()
+            elif future in self._waiters:
+                # (a release may have already discarded the cancelled future)
+                self._waiters.remove(future)
+
+            raise
+
+    def release(self) -> None:
+        """Mark a delivery started with :meth:`acquire` as finished."""
+        self._in_flight -= 1
+        self._wake_waiters()
+
+    def record(self, started: float, overloaded: bool = False) -> None:
+        """
+        Record the outcome of a delivery and adjust the limit accordingly.
+
+        :param started: the value of :func:`time.monotonic` when the delivery started
+        :param overloaded: ``True`` if the delivery failed in a way that indicates the
+            server is overloaded
+
+        """
+        now = time.monotonic()
+        if not overloaded:
+            latency = now - started
+            if self._latency is None or self._min_latency is None:
+                self._latency = self._min_latency = latency
+            else:
+                self._latency += (latency - self._latency) * 0.1
+                if latency < self._min_latency:
+                    self._min_latency = latency
+                else:
+                    # Let the baseline creep up, in case the server got slower for good
+                    self._min_latency += (latency - self._min_latency) * 0.001
+
+            if (
+                self.latency_tolerance is None
+                or self._latency <= self._min_latency * self.latency_tolerance
+            ):
+                if self._limit < self.max_limit:
+                    self._limit = min(self._limit + 1 / self._limit, self.max_limit)
+                    self._wake_waiters()
+
+                return
+
+        if started > self._last_decrease:
+            self._last_decrease = now
+            old_limit = self.limit
+            self._limit = max(self._limit * self.backoff, self.min_limit)
+            logger.debug(
+                "Overload detected; concurrency limit lowered from %d to %d",
+                old_limit,
+                self.limit,
+            )
+
+    async def __aenter__(self) -> None:
+        await self.acquire()
+
+    async def __aexit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_val: BaseException | None,
+        exc_tb: TracebackType | None,
+    ) -> None:
+        self.release()
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.__class__.__name__}(limit={self.limit}, "
+            f"in_flight={self._in_flight})"
+        )
+
+
+class ByteBudget:
+    """
+    Limits the total size of the messages being delivered at once.
+
+    Each delivery reserves the (estimated) size of its message from the budget for as
+    long as it's in progress, so a few very large messages can't use up all the memory
+    or bandwidth. A message larger than the whole budget is counted as taking all of
+    it, so it can still be delivered on its own.
+
+    Deliveries that don't fit in the remaining budget wait. Smaller deliveries that do
+    fit may go ahead of them, so small messages keep flowing while a large one waits
+    for room, but only until the oldest waiting delivery has waited for
+    ``starvation_timeout`` seconds. After that, everything else waits behind it.
+
+    A single budget can be shared by several mailers (see the ``byte_budget`` option of
+    :class:`~asphalt.mailer.component.MailerComponent`).
+
+    :param max_bytes: the total size of the messages that can be delivered at once
+    :param starvation_timeout: how long (in seconds) a waiting delivery can be passed
+        by smaller ones
+    """
+
+    __slots__ = "max_bytes", "starvation_timeout", "_in_use", "_waiters"
+
+    def __init__(self, max_bytes: int = 104857600, starvation_timeout: float = 1):
+        if max_bytes < 1:
+            raise ValueError("max_bytes must be at least 1")
+
+        self.max_bytes = max_bytes
+        self.starvation_timeout = starvation_timeout
+        self._in_use = 0
+        self._waiters: deque[tuple[Future[None], int, float]] = deque()
+
+    @property
+    def in_use(self) -> int:
+        """The number of bytes currently reserved."""
+        return self._in_use
+
+    def _is_starving(self, waiter: tuple[Future[None], int, float]) -> bool:
+        return time.monotonic() - waiter[2] >= self.starvation_timeout
+
+    def _wake_waiters(self) -> None:
+        for waiter in list(self._waiters):
+            future, size, _ = waiter
+            if future.done():
+                continue
+            elif self._in_use + size <= self.max_bytes:
+                self._waiters.remove(waiter)
+                self._in_use += size
+                future.set_result(None)
+            elif self._is_starving(waiter):
+                # Don't let anyone else past until this one fits
+                break
+
+    async def acquire(self, size: int) -> int:
+        """
+        Wait until the given number of bytes can be reserved, and reserve them.
+
+        :param size: the number of bytes to reserve
+        :return: the number of bytes actually reserved (to be passed to
+            :meth:`release`)
+
+        """
+        size = min(max(size, 0), self.max_bytes)
+        oldest = next(
+            (waiter for waiter in self._waiters if not waiter[0].done()), None
+        )
+        if self._in_use + size <= self.max_bytes and (
+            oldest is None or not self._is_starving(oldest)
+        ):
+            self._in_use += size
+            return size
+
+        future: Future[None] = get_running_loop().create_future()
+        waiter = future, size, time.monotonic()
+        self._waiters.append(waiter)
+        try:
+            await future
+        except BaseException:
+            if future.done() and not future.cancelled():
+                # The bytes were reserved right before the cancellation
+                self.release(size)
+            else:
+                self._waiters.remove(waiter)
+                self._wake_waiters()
+
+            raise
+
+        return size
+
+    def release(self, size: int) -> None:
+        """
+        Release bytes reserved with :meth:`acquire`.
+
+        :param size: the return value of :meth:`acquire`
+
+        """
+        self._in_use -= size
+        self._wake_waiters()
+
+    @asynccontextmanager
+    async def reserve(self, size: int) -> AsyncIterator[None]:
+        """
+        Reserve the given number of bytes for the duration of the context block.
+
+        :param size: the number of bytes to reserve
+
+        """
+        size = await self.acquire(size)
+        try:
+            yield
+        finally:
+            self.release(size)
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.__class__.__name__}(max_bytes={self.max_bytes}, "
+            f"in_use={self._in_use})"
+        )
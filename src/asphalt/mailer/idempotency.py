@@ -0,0 +1,292 @@
+"""
+Deduplication of message deliveries using idempotency keys.
+
+An idempotency key is an arbitrary string chosen by the caller (like the ID of the
+request that caused the message to be sent). When a mailer has an
+:class:`IdempotencyCache`, a message whose key has already been seen is silently
+skipped, so retried requests don't result in duplicate mail. If the delivery of the
+earlier message is still in progress, the duplicate waits for its outcome, and is only
+delivered if the earlier delivery fails.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import time
+from asyncio import Future, Task, get_running_loop
+from collections import OrderedDict
+from email.message import EmailMessage
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["IdempotencyCache", "get_idempotency_key", "set_idempotency_key"]
+
+_key_attribute = "_asphalt_mailer_idempotency_key"
+
+
+def set_idempotency_key(message: EmailMessage, key: str) -> None:
+    """
+    Attach an idempotency key to a message.
+
+    The key is stored as an attribute of the message object, and is not part of the
+    message as it is transmitted.
+
+    :param message: the message
+    :param key: the idempotency key
+
+    """
+    setattr(message, _key_attribute, key)
+
+
+def get_idempotency_key(message: EmailMessage) -> str | None:
+    """
+    Return the idempotency key attached to a message.
+
+    :param message: the message
+    :return: the idempotency key, or ``None`` if the message doesn't have one
+
+    """
+    return getattr(message, _key_attribute, None)
+
+
+class IdempotencyCache:
+    """
+    Remembers the idempotency keys of recently delivered messages.
+
+    Keys are remembered for ``ttl`` seconds after they were claimed. If more than
+    ``max_size`` keys are live at once, the oldest ones are forgotten early. Claiming a
+    key and checking for duplicates are constant time operations.
+
+    A claimed key is *in flight* until :meth:`complete` or :meth:`release` is called
+    for it. :meth:`wait` lets a duplicate wait for the outcome of the delivery in
+    flight.
+
+    If ``path`` is given, claimed keys are also appended to that file, so they survive
+    restarts. The file is written in batches on a worker thread, so claiming a key
+    never blocks on disk I/O (and the keys claimed right before a crash may be lost).
+    The file is compacted when it's loaded on startup and whenever it has grown to
+    twice the size of the cache.
+
+    :param max_size: maximum number of keys to remember
+    :param ttl: number of seconds to remember each key for
+    :param path: path to a file for persisting the keys
+    """
+
+    __slots__ = (
+        "max_size",
+        "ttl",
+        "path",
+        "_expires",
+        "_in_flight",
+        "_file_entries",
+        "_pending",
+        "_snapshot",
+        "_flush_task",
+    )
+
+    def __init__(
+        self,
+        *,
+        max_size: int = 100000,
+        ttl: float = 86400,
+        path: str | Path | None = None,
+    ):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = Path(path) if path is not None else None
+        # Every key has the same TTL, so insertion order is also expiration order
+        self._expires: OrderedDict[str, float] = OrderedDict()
+        self._in_flight: dict[str, list[Future[bool]]] = {}
+        self._file_entries = 0
+        self._pending: list[str] = []
+        self._snapshot: list[tuple[str, float]] | None = None
+        self._flush_task: Task[None] | None = None
+        if self.path is not None:
+            self._load(self.path)
+            self._write_file(list(self._expires.items()), [])
+            self._file_entries = len(self._expires)
+
+    def _load(self, path: Path) -> None:
+        try:
+            file = path.open(encoding="utf-8")
+        except FileNotFoundError:
+            return
+
+        now = time.time()
+        with file:
+            for line in file:
+                try:
+                    expires, key = json.loads(line)
+                except ValueError:
+                    continue  # a partially written last line
+
+                self._expires.pop(key, None)
+                if expires > now:
+                    self._expires[key] = expires
+
+        # The keys may have been claimed with a different TTL
+        self._expires = OrderedDict(
+            sorted(self._expires.items(), key=lambda item: item[1])
+        )
+        while len(self._expires) > self.max_size:
+            self._expires.popitem(last=False)
+
+    def _write_file(
+        self, snapshot: list[tuple[str, float]] | None, lines: list[str]
+    ) -> None:
+        # Runs on a worker thread, except when the cache is used without an event loop
+        assert self.path is not None
+        if snapshot is not None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_name(self.path.name + ".tmp")
+            with tmp_path.open("w", encoding="utf-8") as file:
+                for key, expires in snapshot:
+                    file.write(json.dumps([expires, key]) + "\n")
+
+            os.replace(tmp_path, self.path)
+
+        if lines:
+            with self.path.open("a", encoding="utf-8") as file:
+                file.writelines(lines)
+
+    def _write(self, expires: float, key: str) -> None:
+        if self.path is None:
+            return
+
+        self._pending.append(json.dumps([expires, key]) + "\n")
+        self._file_entries += 1
+        if self._file_entries >= 2 * self.max_size:
+            # Rewrite the file with the live keys, which supersede everything queued
+            self._snapshot = list(self._expires.items())
+            self._pending.clear()
+            self._file_entries = len(self._snapshot)
+
+        if self._flush_task is None:
+            try:
+                loop = get_running_loop()
+            except RuntimeError:
+                self._write_file(self._snapshot, self._pending)
+                self._snapshot = None
+                self._pending = []
+            else:
+                self._flush_task = loop.create_task(self._flush())
+
+    async def _flush(self) -> None:
+        loop = get_running_loop()
+        try:
+            while self._pending or self._snapshot is not None:
+                lines, self._pending = self._pending, []
+                snapshot, self._snapshot = self._snapshot, None
+                try:
+                    await loop.run_in_executor(None, self._write_file, snapshot, lines)
+                except Exception:
+                    logger.exception("Error writing idempotency keys to %s", self.path)
+        finally:
+            self._flush_task = None
+
+    def _purge(self, now: float) -> None:
+        expires = self._expires
+        while expires:
+            key, expiration_time = next(iter(expires.items()))
+            if expiration_time > now and len(expires) <= self.max_size:
+                break
+
+            # Let anything waiting for a forgotten key go ahead
+            del expires[key]
+            self._finish(key, True)
+
+    def __contains__(self, key: object) -> bool:
+        expires = self._expires.get(key)  # type: ignore[call-overload]
+        return expires is not None and expires > time.time()
+
+    def __len__(self) -> int:
+        self._purge(time.time())
+        return len(self._expires)
+
+    def claim(self, key: str) -> bool:
+        """
+        Claim a key for a delivery.
+
+        :param key: the idempotency key
+        :return: ``True`` if the key was claimed, ``False`` if it has already been
+            claimed and not released or expired since
+
+        """
+        now = time.time()
+        expires = self._expires.get(key)
+        if expires is not None and expires > now:
+            return False
+
+        self._expires.pop(key, None)
+        self._expires[key] = expires = now + self.ttl
+        self._in_flight.setdefault(key, [])
+        self._purge(now)
+        self._write(expires, key)
+        return True
+
+    def complete(self, key: str) -> None:
+        """
+        Mark the delivery a key was claimed for as finished.
+
+        This is meant to be called when the delivery succeeded. Calling it for a key
+        that isn't in flight (like one that was released already) does nothing.
+
+        :param key: the idempotency key
+
+        """
+        self._finish(key, False)
+
+    def release(self, key: str) -> None:
+        """
+        Release a claimed key, allowing it to be claimed again.
+
+        This is meant to be called when the delivery the key was claimed for failed.
+
+        :param key: the idempotency key
+
+        """
+        self._finish(key, True)
+        if self._expires.pop(key, None) is not None:
+            self._write(0, key)
+
+    def _finish(self, key: str, released: bool) -> None:
+        for future in self._in_flight.pop(key, ()):
+            if not future.done():
+                future.set_result(released)
+
+    async def wait(self, key: str) -> bool:
+        """
+        Wait for the delivery a key was claimed for to finish.
+
+        :param key: the idempotency key
+        :return: ``True`` if the delivery failed and the key was released (so it can
+            be claimed again), ``False`` if it succeeded or wasn't in flight
+
+        """
+        waiters = self._in_flight.get(key)
+        if waiters is None:
+            return False
+
+        future: Future[bool] = get_running_loop().create_future()
+        waiters.append(future)
+        return await future
+
+    async def close(self) -> None:
+        """Write any keys not yet written to the persistence file."""
+        if self._flush_task is not None:
+            await self._flush_task
+
+        if self._pending or self._snapshot is not None:
+            await self._flush()
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.__class__.__name__}(max_size={self.max_size}, ttl={self.ttl}, "
+            f"path={self.path!r})"
+        )
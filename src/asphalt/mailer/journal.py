@@ -0,0 +1,382 @@
+"""
+Audit trail of delivery attempts.
+
+A :class:`DeliveryJournal` records one entry for every attempt to deliver a message:
+when it happened, which backend made it, the message ID and recipients, how long it
+took, the status code, the size of the message and the error if it failed. Entries are
+stored one per line, as compact JSON arrays, in an append-only file that is rotated
+when it grows too large.
+
+Journals can be read with :func:`read_journal`, or from the command line::
+
+    python -m asphalt.mailer.journal /var/log/myapp/mail.journal --failed
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from asyncio import Event, Task, create_task, get_running_loop
+from collections.abc import Iterator
+from datetime import datetime
+from pathlib import Path
+from typing import IO, Any, List, NamedTuple, Optional, Tuple
+
+__all__ = ["DeliveryJournal", "JournalEntry", "read_journal"]
+
+logger = logging.getLogger(__name__)
+
+# (timestamp, backend, message ID, recipients, duration, status, size, error)
+_Record = Tuple[
+    float,
+    str,
+    Optional[str],
+    List[str],
+    float,
+    Optional[int],
+    Optional[int],
+    Optional[str],
+]
+
+
+class JournalEntry(NamedTuple):
+    """
+    A single delivery attempt, as read from a journal with :func:`read_journal`.
+
+    :ivar timestamp: when the attempt finished (as a UNIX timestamp)
+    :ivar backend: class name of the mailer that made the attempt
+    :ivar message_id: the ``Message-ID`` of the message, if it had one
+    :ivar recipients: the email addresses the message was being delivered to
+    :ivar duration: how long the attempt took (in seconds)
+    :ivar status: the status code reported by the backend (like the final SMTP reply
+        code, or the exit code of ``sendmail``), if there is one
+    :ivar size: size of the message as transmitted (in bytes), if known
+    :ivar error: the error message, or ``None`` if the attempt succeeded
+    """
+
+    timestamp: float
+    backend: str
+    message_id: str | None
+    recipients: list[str]
+    duration: float
+    status: int | None
+    size: int | None
+    error: str | None
+
+
+class DeliveryJournal:
+    """
+    Records delivery attempts in an append-only file.
+
+    Recording an attempt only appends a tuple to a list. The entries are serialized and
+    written in batches by a background task (and a worker thread), either when
+    ``flush_interval`` seconds have passed since the first entry of a batch was
+    recorded, or right away when the batch has grown to ``max_batch`` entries.
+
+    When writing a batch would make the file larger than ``max_bytes``, the file is
+    rotated first: ``mail.journal`` is renamed to ``mail.journal.1``, ``mail.journal.1``
+    to ``mail.journal.2`` and so on, keeping at most ``backup_count`` old files. If
+    ``backup_count`` is 0, the file is never rotated (like with
+    :class:`~logging.handlers.RotatingFileHandler`), so no entries are ever discarded.
+
+    Mailers record their delivery attempts in the journal set as their
+    :attr:`~asphalt.mailer.api.Mailer.journal` attribute, which the component does when
+    given the ``journal`` option.
+
+    :param path: path to the journal file
+    :param max_bytes: size (in bytes) at which the file is rotated
+    :param backup_count: number of rotated files to keep (0 to disable rotation)
+    :param flush_interval: maximum time (in seconds) an entry is kept in memory before
+        it is written
+    :param max_batch: number of entries at which a batch is written right away
+    """
+
+    __slots__ = (
+        "path",
+        "max_bytes",
+        "backup_count",
+        "flush_interval",
+        "max_batch",
+        "_pending",
+        "_file",
+        "_file_lock",
+        "_size",
+        "_wakeup",
+        "_task",
+        "_closed",
+    )
+
+    def __init__(
+        self,
+        path: str | Path,
+        *,
+        max_bytes: int = 104857600,
+        backup_count: int = 5,
+        flush_interval: float = 1,
+        max_batch: int = 1000,
+    ):
+        if max_bytes < 1:
+            raise ValueError("max_bytes must be at least 1")
+        if backup_count < 0:
+            raise ValueError("backup_count must not be negative")
+        if max_batch < 1:
+            raise ValueError("max_batch must be at least 1")
+
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._pending: list[_Record] = []
+        self._file_lock = threading.Lock()
+        self._wakeup = Event()
+        self._task: Task[None] | None = None
+        self._closed = False
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file: IO[bytes] | None = self.path.open("ab")
+        self._size = self._file.tell()
+
+    def record(
+        self,
+        backend: str,
+        message_id: str | None,
+        recipients: list[str],
+        started: float,
+        status: int | None = None,
+        size: int | None = None,
+        error: str | None = None,
+    ) -> None:
+        """
+        Record a delivery attempt.
+
+        This is normally called through
+        :meth:`~asphalt.mailer.api.Mailer.record_delivery`. It must be called from the
+        event loop thread.
+
+        :param backend: name of the mailer making the attempt
+        :param message_id: the ``Message-ID`` of the message
+        :param recipients: the email addresses the message was being delivered to
+        :param started: the value of :func:`time.monotonic` when the attempt started
+        :param status: the status code reported by the backend
+        :param size: size of the message as transmitted (in bytes)
+        :param error: the error message, if the attempt failed
+
+        """
+        if self._closed:
+            return
+
+        duration = time.monotonic() - started
+        self._pending.append(
+            (
+                time.time(),
+                backend,
+                message_id,
+                recipients,
+                duration,
+                status,
+                size,
+                error,
+            )
+        )
+        if self._task is None:
+            self._task = create_task(self._run())
+
+        if len(self._pending) == 1 or len(self._pending) >= self.max_batch:
+            self._wakeup.set()
+
+    async def _run(self) -> None:
+        loop = get_running_loop()
+        while True:
+            if not self._pending:
+                if self._closed:
+                    return
+
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            if len(self._pending) < self.max_batch and not self._closed:
+                # Give the batch a chance to fill up before writing it
+                self._wakeup.clear()
+                handle = loop.call_later(self.flush_interval, self._wakeup.set)
+                try:
+                    await self._wakeup.wait()
+                finally:
+                    handle.cancel()
+
+            batch, self._pending = self._pending, []
+            try:
+                await loop.run_in_executor(None, self._write, batch)
+            except Exception:
+                logger.exception(
+                    "Error writing %d entries to the delivery journal", len(batch)
+                )
+
+    def _write(self, batch: list[_Record]) -> None:
+        data = "".join(
+            [
+                json.dumps(
+                    [
+                        round(timestamp, 6),
+                        backend,
+                        message_id,
+                        recipients,
+                        round(duration, 6),
+                        status,
+                        size,
+                        error,
+                    ],
+                    ensure_ascii=False,
+                    separators=(",", ":"),
+                )
+                + "\n"
+                for (
+                    timestamp,
+                    backend,
+                    message_id,
+                    recipients,
+                    duration,
+                    status,
+                    size,
+                    error,
+                ) in batch
+            ]
+        ).encode("utf-8")
+        with self._file_lock:
+            if self._file is None:
+                return
+
+            if (
+                self.backup_count
+                and self._size
+                and self._size + len(data) > self.max_bytes
+            ):
+                self._rotate()
+
+            self._file.write(data)
+            self._file.flush()
+            self._size += len(data)
+
+    def _rotate(self) -> None:
+        assert self._file is not None
+        self._file.close()
+        for index in range(self.backup_count - 1, 0, -1):
+            source = self.path.with_name(f"{self.path.name}.{index}")
+            if source.exists():
+                os.replace(source, self.path.with_name(f"{self.path.name}.{index + 1}"))
+
+        os.replace(self.path, self.path.with_name(f"{self.path.name}.1"))
+
+        self._file = self.path.open("wb")
+        self._size = 0
+
+    async def close(self) -> None:
+        """Write any entries still in memory and close the file."""
+        self._closed = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+
+        with self._file_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(path={str(self.path)!r})"
+
+
+def read_journal(path: str | Path, *, rotated: bool = True) -> Iterator[JournalEntry]:
+    """
+    Iterate over the entries in a journal, oldest first.
+
+    The files are read one line at a time, so even very large journals can be processed
+    without loading them into memory. An incomplete last line (left behind by a crash
+    in the middle of a write) is skipped.
+
+    :param path: path to the journal file
+    :param rotated: ``True`` to also read the rotated files (``mail.journal.1`` and so
+        on) before the current one
+    :return: an iterator of journal entries
+
+    """
+    path = Path(path)
+    paths = [path]
+    if rotated:
+        index = 1
+        while (backup := path.with_name(f"{path.name}.{index}")).exists():
+            paths.insert(0, backup)
+            index += 1
+
+    for file_path in paths:
+        with file_path.open("rb") as file:
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break
+
+                yield JournalEntry(*json.loads(line))
+
+
+def _format_entry(entry: JournalEntry) -> str:
+    timestamp = datetime.fromtimestamp(entry.timestamp).isoformat(
+        sep=" ", timespec="milliseconds"
+    )
+    fields: list[Any] = [
+        timestamp,
+        entry.backend,
+        "-" if entry.status is None else entry.status,
+        entry.message_id or "-",
+        ",".join(entry.recipients) or "-",
+        "-" if entry.size is None else entry.size,
+        f"{entry.duration * 1000:.1f}ms",
+    ]
+    if entry.error is not None:
+        fields.append(entry.error)
+
+    return "\t".join(str(field) for field in fields)
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Print the entries of a delivery journal, oldest first"
+    )
+    parser.add_argument("path", help="path to the journal file")
+    parser.add_argument(
+        "--no-rotated", action="store_true", help="skip the rotated journal files"
+    )
+    parser.add_argument(
+        "--failed", action="store_true", help="only show failed delivery attempts"
+    )
+    parser.add_argument("--recipient", help="only show attempts to this address")
+    parser.add_argument("--message-id", help="only show attempts for this message")
+    parser.add_argument(
+        "--json", action="store_true", help="print the entries as JSON objects"
+    )
+    args = parser.parse_args(argv)
+    recipient = args.recipient.lower() if args.recipient else None
+    try:
+        for entry in read_journal(args.path, rotated=not args.no_rotated):
+            if args.failed and entry.error is None:
+                continue
+            if args.message_id and entry.message_id != args.message_id:
+                continue
+            if recipient and recipient not in (r.lower() for r in entry.recipients):
+                continue
+
+            if args.json:
+                print(json.dumps(entry._asdict(), ensure_ascii=False))
+            else:
+                print(_format_entry(entry))
+    except FileNotFoundError as exc:
+        parser.exit(1, f"{parser.prog}: error: {exc}\n")
+    except BrokenPipeError:  # pragma: no cover
+        # Output was piped to a program (like head) that exited early
+        os.dup2(os.open(os.devnull, os.O_WRONLY), 1)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
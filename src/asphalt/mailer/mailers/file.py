@@ -0,0 +1,222 @@
+from __future__ import annotations
+
+import os
+import socket
+import threading
+import time
+from asyncio import get_running_loop
+from email.generator import BytesGenerator
+from email.message import EmailMessage
+from io import BytesIO
+from itertools import count
+from pathlib import Path
+from secrets import token_hex
+from typing import Any
+
+from ..api import DeliveryError, Mailer, MessagesType
+from ..idempotency import get_idempotency_key
+from ..utils import iterate_messages
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None  # type: ignore[assignment]
+
+__all__ = ["FileMailer"]
+
+_counter = count()
+
+
+class FileMailer(Mailer):
+    """
+    A mailer that stores messages in a maildir_ or an mbox_ on the local file system
+    instead of sending them.
+
+    Messages are written in batches of up to ``batch_size`` messages in a worker thread.
+    When ``fsync`` is enabled, each batch is flushed to disk as a group before
+    :meth:`deliver` returns, so the cost of flushing is shared by the whole batch.
+
+    Maildir file names are unique even when several processes deliver to the same
+    maildir at once, and mbox writers hold an exclusive lock on the file (on platforms
+    that support :func:`fcntl.flock`) while appending to it.
+
+    :param path: path to the maildir (a directory) or the mbox (a file); created on
+        startup if it does not exist
+    :param format: either ``maildir`` or ``mbox``
+    :param batch_size: maximum number of messages to write at once
+    :param fsync: whether to flush the messages to disk before returning from
+        :meth:`deliver`
+    :param message_defaults: default values for omitted keyword arguments of
+        :meth:`~asphalt.mailer.api.Mailer.create_message`
+
+    .. _maildir: https://cr.yp.to/proto/maildir.html
+    .. _mbox: https://en.wikipedia.org/wiki/Mbox
+    """
+
+    __slots__ = "path", "format", "batch_size", "fsync", "_mbox_lock"
+
+    def __init__(
+        self,
+        *,
+        path: str | Path,
+        format: str = "maildir",
+        batch_size: int = 100,
+        fsync: bool = True,
+        message_defaults: dict[str, Any] | None = None,
+    ):
+        super().__init__(message_defaults or {})
+        if format not in ("maildir", "mbox"):
+            raise ValueError('format must be either "maildir" or "mbox"')
+
+        self.path = Path(path)
+        self.format = format
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self._mbox_lock = threading.Lock()
+
+    async def start(self) -> None:
+        if self.format == "maildir":
+            for subdir in ("tmp", "new", "cur"):
+                self.path.joinpath(subdir).mkdir(parents=True, exist_ok=True)
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    async def deliver(self, messages: MessagesType) -> None:
+        batch: list[EmailMessage] = []
+        batch_keys: set[str] = set()
+        try:
+            async for message in iterate_messages(messages):
+                key = get_idempotency_key(message)
+                if key is not None and key in batch_keys:
+                    # Claiming the key would wait for this very batch to be written
+                    continue
+
+                if not await self.claim_message(message):
+                    continue
+
+                del message["Bcc"]
+                batch.append(message)
+                if key is not None and self.idempotency_cache is not None:
+                    batch_keys.add(key)
+
+                if len(batch) == self.batch_size:
+                    await self._write_batch(batch)
+                    batch = []
+                    batch_keys.clear()
+
+            if batch:
+                await self._write_batch(batch)
+        except BaseException:
+            # Allow the messages that weren't written to be retried
+            for message in batch:
+                self.release_message(message)
+
+            raise
+
+    async def _write_batch(self, messages: list[EmailMessage]) -> None:
+        func = self._write_maildir if self.format == "maildir" else self._write_mbox
+        started = time.monotonic()
+        try:
+            async with self.reserve_bytes(*messages):
+                with self.trace("file.write", messages=len(messages)):
+                    await get_running_loop().run_in_executor(None, func, messages)
+        except Exception as e:
+            error = DeliveryError(str(e))
+            for message in messages:
+                self.record_delivery(message, started, error=error)
+
+            raise error from e
+
+        for message in messages:
+            self.record_delivery(message, started)
+            self.complete_message(message)
+
+    def _write_maildir(self, messages: list[EmailMessage]) -> None:
+        tmp_dir = self.path / "tmp"
+        new_dir = self.path / "new"
+        hostname = socket.gethostname().replace("/", r"\057").replace(":", r"\072")
+        names: list[str] = []
+        files = []
+        try:
+            for message in messages:
+                name = (
+                    f"{int(time.time())}.P{os.getpid()}Q{next(_counter)}"
+                    f"R{token_hex(4)}.{hostname}"
+                )
+                data = self._serialize_and_sign(message)
+                f = open(tmp_dir / name, "xb")
+                files.append(f)
+                names.append(name)
+                f.write(data)
+
+            # Flush all the files in one go, giving the file system a chance to combine
+            # the writes, before moving any of them in place
+            for f in files:
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+        except BaseException:
+            for f in files:
+                f.close()
+
+            for name in names:
+                tmp_dir.joinpath(name).unlink()
+
+            raise
+
+        for f in files:
+            f.close()
+
+        for name in names:
+            os.rename(tmp_dir / name, new_dir / name)
+
+        if self.fsync:
+            fd = os.open(new_dir, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _write_mbox(self, messages: list[EmailMessage]) -> None:
+        timestamp = time.asctime(time.gmtime())
+        data = b"".join(
+            f"From {self._get_envelope_sender(message)} {timestamp}\n".encode()
+            + self._serialize_and_sign(message, mangle_from=True)
+            + b"\n"
+            for message in messages
+        )
+        with self._mbox_lock, open(self.path, "ab") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+
+            f.write(data)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+
+    @staticmethod
+    def _get_envelope_sender(message: EmailMessage) -> str:
+        sender = message["Sender"] or message["From"]
+        if sender and sender.addresses:
+            return sender.addresses[0].addr_spec or "MAILER-DAEMON"
+
+        return "MAILER-DAEMON"
+
+    def _serialize_and_sign(
+        self, message: EmailMessage, mangle_from: bool = False
+    ) -> bytes:
+        with BytesIO() as buffer:
+            BytesGenerator(buffer, mangle_from_=mangle_from).flatten(message)
+            data = buffer.getvalue()
+
+        if not data.endswith(b"\n"):
+            data += b"\n"
+
+        # This already runs in a worker thread, so sign the message right here
+        if self.dkim_signer is not None:
+            data = self.dkim_signer.sign(data)
+
+        return data
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({str(self.path)!r}, format={self.format!r})"
@@ -0,0 +1,332 @@
+from __future__ import annotations
+
+import re
+import socket
+import time
+from asyncio import (
+    Lock,
+    StreamReader,
+    StreamWriter,
+    get_running_loop,
+    open_connection,
+    open_unix_connection,
+    wait_for,
+)
+from email.message import EmailMessage
+from pathlib import Path
+from typing import Any
+
+from aiosmtplib.email import extract_recipients, extract_sender, flatten_message
+from asphalt.core import current_context
+
+from ..api import DeliveryError, Mailer, MessagesType
+from ..utils import iterate_messages
+
+__all__ = ["LMTPMailer"]
+
+_newline_re = re.compile(rb"\r?\n")
+_leading_dot_re = re.compile(rb"^\.", re.MULTILINE)
+
+
+class LMTPMailer(Mailer):
+    """
+    A mailer that delivers mail to a local LMTP_ server (like Dovecot) over TCP or a
+    UNIX domain socket.
+
+    The connection is opened on the first delivery and then kept open for subsequent
+    deliveries, so there's no connection setup per message. Concurrent deliveries take
+    turns using the connection.
+
+    Unlike SMTP servers, LMTP servers report the outcome of the delivery separately for
+    each recipient. :meth:`deliver_message` returns these statuses, while
+    :meth:`deliver` and :meth:`deliver_iter` treat a message as failed if it could not
+    be delivered to all of its recipients.
+
+    If the server supports ``PIPELINING``, the ``MAIL`` and ``RCPT`` commands of each
+    message are sent in one go.
+
+    :param host: host name of the LMTP server
+    :param port: port of the LMTP server
+    :param path: path to the UNIX domain socket of the LMTP server (overrides ``host``
+        and ``port``)
+    :param local_hostname: the host name to send with ``LHLO`` (defaults to the fully
+        qualified domain name of the local host)
+    :param timeout: timeout (in seconds) for all network operations
+    :param message_defaults: default values for omitted keyword arguments of
+        :meth:`~asphalt.mailer.api.Mailer.create_message`
+
+    .. _LMTP: https://datatracker.ietf.org/doc/html/rfc2033
+    """
+
+    __slots__ = (
+        "host",
+        "port",
+        "path",
+        "local_hostname",
+        "timeout",
+        "supports_8bit",
+        "_lock",
+        "_reader",
+        "_writer",
+        "_extensions",
+    )
+
+    def __init__(
+        self,
+        *,
+        host: str = "localhost",
+        port: int = 24,
+        path: str | Path | None = None,
+        local_hostname: str | None = None,
+        timeout: float = 10,
+        message_defaults: dict[str, Any] | None = None,
+    ):
+        super().__init__(message_defaults or {})
+        self.host = host
+        self.port = port
+        self.path = str(path) if path is not None else None
+        self.local_hostname = local_hostname
+        self.timeout = timeout
+        self.supports_8bit = True
+        self._lock = Lock()
+        self._reader: StreamReader | None = None
+        self._writer: StreamWriter | None = None
+        self._extensions: dict[str, str] = {}
+
+    async def start(self) -> None:
+        current_context().add_teardown_callback(self._close)
+
+    async def _connect(self) -> None:
+        if self.local_hostname is None:
+            # This may involve DNS lookups, so keep it off the event loop
+            self.local_hostname = await get_running_loop().run_in_executor(
+                None, socket.getfqdn
+            )
+
+        if self.path is not None:
+            connect = open_unix_connection(self.path)
+        else:
+            connect = open_connection(self.host, self.port)
+
+        self._reader, self._writer = await wait_for(connect, self.timeout)
+        try:
+            code, text = await self._read_response()
+            if code != 220:
+                raise DeliveryError(f"unexpected greeting: {code} {text}")
+
+            code, text = await self._command(f"LHLO {self.local_hostname}")
+            if code != 250:
+                raise DeliveryError(f"LHLO failed: {code} {text}")
+        except BaseException:
+            await self._close()
+            raise
+
+        self._extensions = {}
+        for line in text.splitlines()[1:]:
+            keyword, _, params = line.partition(" ")
+            self._extensions[keyword.upper()] = params
+
+        self.supports_8bit = "8BITMIME" in self._extensions
+
+    async def _close(self) -> None:
+        writer, self._reader, self._writer = self._writer, None, None
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:  # pragma: no cover
+                pass
+
+    async def _read_response(self) -> tuple[int, str]:
+        assert self._reader is not None
+        lines: list[str] = []
+        while True:
+            line = await wait_for(self._reader.readline(), self.timeout)
+            if not line.endswith(b"\n"):
+                raise ConnectionError("connection closed by the LMTP server")
+
+            lines.append(line[4:].rstrip(b"\r\n").decode("utf-8", errors="replace"))
+            if line[3:4] != b"-":
+                return int(line[:3]), "\n".join(lines)
+
+    async def _write(self, data: bytes) -> None:
+        assert self._writer is not None
+        self._writer.write(data)
+        await wait_for(self._writer.drain(), self.timeout)
+
+    async def _command(self, command: str) -> tuple[int, str]:
+        await self._write(command.encode("utf-8") + b"\r\n")
+        return await self._read_response()
+
+    async def deliver_message(
+        self, message: EmailMessage
+    ) -> dict[str, tuple[int, str]]:
+        """
+        Deliver a single message.
+
+        A message that could only be delivered to some of its recipients does not
+        raise an exception; check the returned statuses instead.
+
+        :param message: the message to deliver
+        :return: a dictionary mapping each recipient address to the status code and
+            text the server replied with for that recipient
+        :raises DeliveryError: if the message could not be delivered to any recipient
+            due to a connection or protocol error
+
+        """
+        try:
+            sender = extract_sender(message)
+            # The server replies to DATA once for every accepted RCPT, so a recipient
+            # listed twice (like in both To and Cc) must only be sent once
+            recipients = list(dict.fromkeys(extract_recipients(message)))
+            if sender is None:
+                raise ValueError("No From header provided in message")
+        except Exception as e:
+            raise DeliveryError(str(e), message) from e
+
+        async with self.reserve_bytes(message), self._lock:
+            if (
+                self._reader is None
+                or self._writer is None
+                or self._reader.at_eof()
+                or self._writer.is_closing()
+            ):
+                # The server may have closed an idle connection
+                await self._close()
+                try:
+                    with self.trace("lmtp.connect"):
+                        await self._connect()
+                except DeliveryError:
+                    raise
+                except Exception as e:
+                    raise DeliveryError(str(e), message) from e
+
+            try:
+                with self.trace("lmtp.send"):
+                    return await self._transaction(message, sender, recipients)
+            except DeliveryError:
+                raise
+            except Exception as e:
+                # The state of the connection is unknown, so start over next time
+                await self._close()
+                raise DeliveryError(str(e), message) from e
+            except BaseException:
+                # Cancelled in the middle of a transaction, so the replies to it may
+                # still be on their way
+                if self._writer is not None:
+                    self._writer.close()
+
+                self._reader = self._writer = None
+                raise
+
+    async def _transaction(
+        self, message: EmailMessage, sender: str, recipients: list[str]
+    ) -> dict[str, tuple[int, str]]:
+        utf8 = "SMTPUTF8" in self._extensions
+        with self.trace("lmtp.serialize"):
+            data = flatten_message(
+                message, utf8=utf8, cte_type="8bit" if self.supports_8bit else "7bit"
+            )
+
+        data = await self.sign_message(data)
+        max_size = int(self._extensions.get("SIZE") or 0)
+        if max_size and len(data) > max_size:
+            raise DeliveryError(
+                f"message size ({len(data)} bytes) exceeds the server's limit "
+                f"({max_size} bytes)",
+                message,
+            )
+
+        mail_command = f"MAIL FROM:<{sender}>"
+        if self.supports_8bit:
+            mail_command += " BODY=8BITMIME"
+
+        if utf8 and not data[: data.find(b"\r\n\r\n")].isascii():
+            mail_command += " SMTPUTF8"
+
+        commands = [mail_command] + [f"RCPT TO:<{rcpt}>" for rcpt in recipients]
+        if "PIPELINING" in self._extensions:
+            await self._write(
+                b"".join(command.encode("utf-8") + b"\r\n" for command in commands)
+            )
+            responses = [await self._read_response() for _ in commands]
+        else:
+            responses = [await self._command(command) for command in commands]
+
+        code, text = responses[0]
+        if code != 250:
+            await self._command("RSET")
+            raise DeliveryError(f"{code} {text}", message)
+
+        statuses = dict(zip(recipients, responses[1:]))
+        accepted = [rcpt for rcpt, (code, _) in statuses.items() if code in (250, 251)]
+        if not accepted:
+            await self._command("RSET")
+            return statuses
+
+        code, text = await self._command("DATA")
+        if code != 354:
+            await self._command("RSET")
+            raise DeliveryError(f"{code} {text}", message)
+
+        # Normalize line endings and escape lines starting with a dot
+        data = _leading_dot_re.sub(b"..", _newline_re.sub(b"\r\n", data))
+        if not data.endswith(b"\r\n"):
+            data += b"\r\n"
+
+        await self._write(data + b".\r\n")
+        for recipient in accepted:
+            statuses[recipient] = await self._read_response()
+
+        return statuses
+
+    async def deliver(self, messages: MessagesType) -> None:
+        async for message in iterate_messages(messages):
+            if not await self.claim_message(message):
+                continue
+
+            started = time.monotonic()
+            try:
+                statuses = await self.deliver_message(message)
+            except BaseException as exc:
+                self.release_message(message)
+                self.record_delivery(message, started, error=exc)
+                raise
+
+            failures = {
+                recipient: (code, text)
+                for recipient, (code, text) in statuses.items()
+                if code not in (250, 251)
+            }
+            if failures and len(failures) == len(statuses):
+                self.release_message(message)
+            else:
+                self.complete_message(message)
+
+            if failures:
+                error = DeliveryError(
+                    "delivery failed for "
+                    + ", ".join(
+                        f"{recipient} ({code} {text})"
+                        for recipient, (code, text) in failures.items()
+                    ),
+                    message,
+                )
+                self.record_delivery(
+                    message,
+                    started,
+                    recipients=list(statuses),
+                    status=next(iter(failures.values()))[0],
+                    error=error,
+                )
+                raise error
+
+            self.record_delivery(
+                message, started, recipients=list(statuses), status=250
+            )
+
+    def __repr__(self) -> str:
+        if self.path is not None:
+            return f"{self.__class__.__name__}(path={self.path!r})"
+
+        return f"{self.__class__.__name__}(host={self.host!r}, port={self.port})"
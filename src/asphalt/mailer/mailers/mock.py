@@ -1,10 +1,288 @@
 from __future__ import annotations
 
-from collections.abc import Iterable
+import time
+from asyncio import Future, get_running_loop, sleep
+from collections import deque
+from collections.abc import AsyncIterator, Callable, Iterator, Mapping, Sequence
 from email.message import EmailMessage
-from typing import Any
+from email.utils import getaddresses
+from itertools import count, islice
+from random import Random
+from typing import Any, NamedTuple, Union, overload
 
-from ..api import Mailer
+from ..api import DeliveryError, DeliveryResult, Mailer, MessagesType
+from ..utils import iterate_messages
+
+__all__ = ["MessageStore", "MockMailer"]
+
+DelayType = Union[float, "Mapping[str, Any]"]
+
+
+_delay_parameters = {
+    "fixed": ("value",),
+    "uniform": ("low", "high"),
+    "lognormal": ("mu", "sigma"),
+}
+
+
+def _create_delay_sampler(
+    delay: DelayType | None,
+) -> Callable[[Random], float] | None:
+    if delay is None:
+        return None
+    elif isinstance(delay, (int, float)):
+        seconds = float(delay)
+        return lambda random: seconds
+
+    args = dict(delay)
+    distribution = args.pop("distribution", None)
+    parameters = _delay_parameters.get(distribution)
+    if parameters is None:
+        raise ValueError(
+            f"unknown delay distribution: {distribution!r} (must be one of "
+            f'"fixed", "uniform" or "lognormal")'
+        )
+    elif sorted(args) != sorted(parameters):
+        raise ValueError(
+            f"the {distribution} delay distribution requires exactly these "
+            f"parameters: {', '.join(parameters)}"
+        )
+
+    values = [float(args[name]) for name in parameters]
+    if distribution == "fixed":
+        return lambda random: values[0]
+    elif distribution == "uniform":
+        return lambda random: random.uniform(*values)
+    else:
+        return lambda random: random.lognormvariate(*values)
+
+
+class _Entry(NamedTuple):
+    id: int
+    message: EmailMessage
+    size: int
+    keys: dict[str, set[str]]
+
+
+class MessageStore:
+    """
+    A bounded, indexed store of captured messages.
+
+    The store behaves like a read-only sequence of messages, oldest first. When either
+    of the limits is exceeded, the oldest messages are discarded until the store fits
+    within the limits again.
+
+    Messages are indexed by recipient (including ``Bcc`` recipients), sender address,
+    subject and ``Message-ID``, so :meth:`find` does not have to scan the store.
+
+    :param max_messages: maximum number of messages to retain
+    :param max_bytes: maximum total size (in bytes) of the retained messages when
+        serialized
+
+    :ivar int total_count: number of messages that have been added to the store since
+        its creation or the last call to :meth:`clear`, including discarded ones
+    """
+
+    __slots__ = (
+        "max_messages",
+        "max_bytes",
+        "total_count",
+        "_entries",
+        "_size",
+        "_ids",
+        "_indexes",
+        "_waiters",
+    )
+
+    _keys = ("recipient", "sender", "subject", "message_id")
+
+    def __init__(self, max_messages: int | None = None, max_bytes: int | None = None):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self._ids = count()
+        self._waiters: list[tuple[dict[str, str], Future[EmailMessage]]] = []
+        self.clear()
+
+    def add(self, message: EmailMessage) -> None:
+        """
+        Add a message to the store, discarding the oldest messages if necessary.
+
+        :param message: the message to add
+
+        """
+        self.total_count += 1
+        keys = self._get_keys(message)
+        if self._waiters:
+            for criteria, future in self._waiters:
+                if not future.done() and self._matches(keys, criteria):
+                    future.set_result(message)
+
+            self._waiters = [item for item in self._waiters if not item[1].done()]
+
+        size = len(message.as_bytes()) if self.max_bytes is not None else 0
+        entry = _Entry(next(self._ids), message, size, keys)
+        self._entries.append(entry)
+        self._size += size
+        for key, values in keys.items():
+            index = self._indexes[key]
+            for value in values:
+                index.setdefault(value, {})[entry.id] = entry
+
+        while self._entries and (
+            (self.max_messages is not None and len(self._entries) > self.max_messages)
+            or (self.max_bytes is not None and self._size > self.max_bytes)
+        ):
+            self._discard_oldest()
+
+    def find(
+        self,
+        *,
+        recipient: str | None = None,
+        sender: str | None = None,
+        subject: str | None = None,
+        message_id: str | None = None,
+    ) -> list[EmailMessage]:
+        """
+        Return all retained messages matching the given criteria, oldest first.
+
+        Addresses are matched case insensitively against the bare address (like
+        ``foo@example.org``).
+
+        :param recipient: a ``To``, ``Cc`` or ``Bcc`` address of the message
+        :param sender: the ``From`` address of the message
+        :param subject: the exact subject of the message
+        :param message_id: the exact ``Message-ID`` of the message
+        :return: the list of matching messages
+
+        """
+        criteria = self._get_criteria(recipient, sender, subject, message_id)
+        if not criteria:
+            return list(self)
+
+        candidates = min(
+            (self._indexes[key].get(value, {}) for key, value in criteria.items()),
+            key=len,
+        )
+        return [
+            entry.message
+            for entry in candidates.values()
+            if self._matches(entry.keys, criteria)
+        ]
+
+    async def wait_for(
+        self,
+        *,
+        recipient: str | None = None,
+        sender: str | None = None,
+        subject: str | None = None,
+        message_id: str | None = None,
+    ) -> EmailMessage:
+        """
+        Return the oldest message matching the given criteria, waiting for one to be
+        added if necessary.
+
+        The criteria are the same as with :meth:`find`. To give up after a while, wrap
+        the call in :func:`asyncio.wait_for` or similar.
+
+        :return: the matching message
+
+        """
+        matches = self.find(
+            recipient=recipient, sender=sender, subject=subject, message_id=message_id
+        )
+        if matches:
+            return matches[0]
+
+        criteria = self._get_criteria(recipient, sender, subject, message_id)
+        future: Future[EmailMessage] = get_running_loop().create_future()
+        self._waiters.append((criteria, future))
+        return await future
+
+    def clear(self) -> None:
+        """Remove all messages from the store and reset the total count."""
+        self.total_count = 0
+        self._entries: deque[_Entry] = deque()
+        self._size = 0
+        self._indexes: dict[str, dict[str, dict[int, _Entry]]] = {
+            key: {} for key in self._keys
+        }
+
+    def _discard_oldest(self) -> None:
+        entry = self._entries.popleft()
+        self._size -= entry.size
+        for key, values in entry.keys.items():
+            index = self._indexes[key]
+            for value in values:
+                entries = index[value]
+                del entries[entry.id]
+                if not entries:
+                    del index[value]
+
+    @staticmethod
+    def _get_criteria(
+        recipient: str | None,
+        sender: str | None,
+        subject: str | None,
+        message_id: str | None,
+    ) -> dict[str, str]:
+        criteria = {
+            "recipient": recipient.lower() if recipient is not None else None,
+            "sender": sender.lower() if sender is not None else None,
+            "subject": subject,
+            "message_id": message_id,
+        }
+        return {key: value for key, value in criteria.items() if value is not None}
+
+    @staticmethod
+    def _get_keys(message: EmailMessage) -> dict[str, set[str]]:
+        keys: dict[str, set[str]] = {key: set() for key in MessageStore._keys}
+        for name, value in message.raw_items():
+            name = name.lower()
+            if name in ("to", "cc", "bcc", "from"):
+                # Headers set on an EmailMessage have already been parsed
+                addresses = getattr(value, "addresses", None)
+                if addresses is not None:
+                    addrs = [address.addr_spec for address in addresses]
+                else:
+                    addrs = [addr for _, addr in getaddresses([str(value)])]
+
+                key = "sender" if name == "from" else "recipient"
+                keys[key].update(addr.lower() for addr in addrs if addr)
+            elif name == "subject":
+                keys["subject"].add(str(message["Subject"]))
+            elif name == "message-id":
+                keys["message_id"].add(str(value).strip())
+
+        return keys
+
+    @staticmethod
+    def _matches(keys: dict[str, set[str]], criteria: dict[str, str]) -> bool:
+        return all(value in keys[key] for key, value in criteria.items())
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[EmailMessage]:
+        return (entry.message for entry in self._entries)
+
+    @overload
+    def __getitem__(self, index: int) -> EmailMessage: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> list[EmailMessage]: ...
+
+    def __getitem__(self, index: int | slice) -> EmailMessage | list[EmailMessage]:
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self._entries))
+            return list(islice(self, start, stop, step))
+
+        return self._entries[index].message
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.__class__.__name__}(max_messages={self.max_messages}, "
+            f"max_bytes={self.max_bytes})"
+        )
 
 
 class MockMailer(Mailer):
@@ -12,23 +290,120 @@ class MockMailer(Mailer):
     A mailer that does not send any messages but instead stores them in a member
     variable.
 
+    By default, all messages are retained. For long running load tests, limit the
+    number or the total size of the retained messages with ``max_messages`` and
+    ``max_bytes``.
+
+    To simulate the behavior of a real mail relay, the mailer can be made to delay and
+    fail deliveries, both per message and per :meth:`deliver` call (batch). A delay is
+    either a fixed number of seconds, or a mapping with a ``distribution`` key and the
+    parameters of that distribution:
+
+    * ``{"distribution": "fixed", "value": ...}``
+    * ``{"distribution": "uniform", "low": ..., "high": ...}``
+    * ``{"distribution": "lognormal", "mu": ..., "sigma": ...}`` (the parameters of the
+      underlying normal distribution, as in :func:`random.lognormvariate`)
+
+    A failed delivery raises a :exc:`~asphalt.mailer.api.DeliveryError` with an error
+    message picked at random from ``errors``. Failed messages are not stored.
+
+    Given the same ``seed``, the same sequence of deliveries always gets the same
+    delays and failures.
+
+    :param max_messages: maximum number of messages to retain
+    :param max_bytes: maximum total size (in bytes) of the retained messages
+    :param delay: delay applied to the delivery of each message
+    :param batch_delay: delay applied once per :meth:`deliver` call
+    :param failure_rate: probability (0 to 1) of the delivery of a message failing
+    :param batch_failure_rate: probability (0 to 1) of a whole :meth:`deliver` call
+        failing before any messages have been delivered
+    :param errors: error messages to pick from for failed deliveries
+    :param seed: seed for the random number generator used for delays and failures
     :param message_defaults: default values for omitted keyword arguments of
         :meth:`~asphalt.mailer.api.Mailer.create_message`
 
-    :ivar messages: list of messages that would normally have been sent
+    :ivar MessageStore messages: the messages that would normally have been sent
     """
 
-    __slots__ = "messages"
+    __slots__ = (
+        "messages",
+        "failure_rate",
+        "batch_failure_rate",
+        "errors",
+        "_delay",
+        "_batch_delay",
+        "_random",
+    )
 
-    def __init__(self, *, message_defaults: dict[str, Any] | None = None):
+    def __init__(
+        self,
+        *,
+        max_messages: int | None = None,
+        max_bytes: int | None = None,
+        delay: DelayType | None = None,
+        batch_delay: DelayType | None = None,
+        failure_rate: float = 0,
+        batch_failure_rate: float = 0,
+        errors: Sequence[str] = ("451 4.3.0 Temporary failure",),
+        seed: int | None = None,
+        message_defaults: dict[str, Any] | None = None,
+    ):
         super().__init__(message_defaults or {})
-        self.messages: list[EmailMessage] = []
+        if not errors:
+            raise ValueError("errors must contain at least one error message")
+
+        self.messages = MessageStore(max_messages, max_bytes)
+        self.failure_rate = failure_rate
+        self.batch_failure_rate = batch_failure_rate
+        self.errors = list(errors)
+        self._delay = _create_delay_sampler(delay)
+        self._batch_delay = _create_delay_sampler(batch_delay)
+        self._random = Random(seed)
+
+    async def _simulate(
+        self,
+        delay: Callable[[Random], float] | None,
+        failure_rate: float,
+        message: EmailMessage | None = None,
+    ) -> None:
+        if delay is not None:
+            await sleep(delay(self._random))
+
+        if failure_rate and self._random.random() < failure_rate:
+            raise DeliveryError(self._random.choice(self.errors), message)
+
+    async def _deliver_message(self, message: EmailMessage) -> None:
+        async with self.reserve_bytes(message):
+            if await self.claim_message(message):
+                started = time.monotonic()
+                try:
+                    with self.trace("mock.send"):
+                        await self._simulate(self._delay, self.failure_rate, message)
+                except BaseException as exc:
+                    self.release_message(message)
+                    self.record_delivery(message, started, error=exc)
+                    raise
+
+                self.messages.add(message)
+                self.record_delivery(message, started)
+                self.complete_message(message)
 
-    async def deliver(self, messages: EmailMessage | Iterable[EmailMessage]) -> None:
-        if isinstance(messages, EmailMessage):
-            messages = [messages]
+    async def deliver(self, messages: MessagesType) -> None:
+        await self._simulate(self._batch_delay, self.batch_failure_rate)
+        async for message in iterate_messages(messages):
+            await self._deliver_message(message)
 
-        self.messages.extend(messages)
+    async def deliver_iter(
+        self, messages: MessagesType
+    ) -> AsyncIterator[DeliveryResult]:
+        await self._simulate(self._batch_delay, self.batch_failure_rate)
+        async for message in iterate_messages(messages):
+            try:
+                await self._deliver_message(message)
+            except DeliveryError as exc:
+                yield DeliveryResult(message, exc)
+            else:
+                yield DeliveryResult(message)
 
     def __repr__(self) -> str:
         return f"{self.__class__.__name__}()"
@@ -0,0 +1,438 @@
+from __future__ import annotations
+
+import logging
+import random
+import time
+from abc import ABCMeta, abstractmethod
+from asyncio import Future, Lock, TimerHandle, gather, get_running_loop
+from email.message import EmailMessage
+from itertools import groupby
+from ssl import SSLContext
+from typing import Any, NamedTuple
+
+from aiosmtplib import SMTP, SMTPException, SMTPServerDisconnected
+from asphalt.core import current_context, require_resource
+
+from ..api import DeliveryError, MessagesType
+from ..utils import get_recipients, iterate_messages
+from .smtp import _BaseSMTPMailer, _get_status
+
+__all__ = ["MXRecord", "MXResolver", "DNSPythonResolver", "MXMailer"]
+
+logger = logging.getLogger(__name__)
+
+
+class MXRecord(NamedTuple):
+    """
+    A mail exchanger of a domain.
+
+    :ivar preference: the preference of the host (lower is preferred)
+    :ivar host: the host name of the mail exchanger
+    :ivar ttl: the number of seconds this record may be cached for
+    """
+
+    preference: int
+    host: str
+    ttl: float
+
+
+class MXResolver(metaclass=ABCMeta):
+    """Interface for looking up the mail exchangers of domains."""
+
+    @abstractmethod
+    async def resolve_mx(self, domain: str) -> list[MXRecord]:
+        """
+        Look up the ``MX`` records of the given domain.
+
+        :param domain: the domain name
+        :return: the ``MX`` records of the domain (an empty list if the domain exists
+            but has no ``MX`` records)
+        :raises LookupError: if the domain does not exist or the lookup failed
+
+        """
+
+
+class DNSPythonResolver(MXResolver):
+    """
+    Looks up ``MX`` records using dnspython_'s asynchronous resolver.
+
+    Requires the ``mx`` extra (``pip install asphalt-mailer[mx]``).
+
+    .. _dnspython: https://www.dnspython.org/
+    """
+
+    __slots__ = "_resolver"
+
+    def __init__(self) -> None:
+        import dns.asyncresolver
+
+        self._resolver = dns.asyncresolver.Resolver()
+
+    async def resolve_mx(self, domain: str) -> list[MXRecord]:
+        import dns.exception
+        import dns.resolver
+
+        try:
+            answer = await self._resolver.resolve(domain, "MX")
+        except dns.resolver.NoAnswer:
+            return []
+        except dns.exception.DNSException as exc:
+            raise LookupError(f"error looking up MX records for {domain}: {exc}")
+
+        ttl = answer.rrset.ttl if answer.rrset is not None else 0
+        return [
+            MXRecord(record.preference, record.exchange.to_text(True), ttl)
+            for record in answer
+        ]
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}()"
+
+
+class _Connection:
+    """A connection to a mail exchanger, kept open between deliveries."""
+
+    __slots__ = ("smtp", "lock", "idle_timer")
+
+    def __init__(self, smtp: SMTP):
+        self.smtp = smtp
+        self.lock = Lock()
+        self.idle_timer: TimerHandle | None = None
+
+
+class MXMailer(_BaseSMTPMailer):
+    """
+    A mailer that delivers messages directly to the mail exchangers of the recipients'
+    domains, without going through a relay.
+
+    The recipients of each message are grouped by domain, and the domains are delivered
+    to concurrently. For each domain, the mail exchangers are tried in the order of
+    preference (hosts with equal preference in random order) until one of them can be
+    connected to. If the domain has no ``MX`` records, the domain itself is used as the
+    mail exchanger, and a "null MX" (:rfc:`7505`) causes the delivery to the domain to
+    fail right away.
+
+    Lookup results are cached for as long as their TTL allows, capped at
+    ``max_cache_ttl`` seconds. A connection is kept open to each mail exchanger that
+    has been delivered to and reused for later deliveries to the same host, until it
+    has been idle for ``idle_timeout`` seconds. At most ``max_connections`` connections
+    are kept open; beyond that, the least recently used idle connection is closed.
+
+    STARTTLS is used whenever the mail exchanger offers it. As is customary between
+    mail servers, certificates are not validated unless ``validate_certs`` is enabled.
+
+    Like :class:`~asphalt.mailer.mailers.smtp.SMTPMailer`, this mailer honors the
+    ``SIZE``, ``8BITMIME``, ``SMTPUTF8``, ``CHUNKING`` and ``BINARYMIME`` extensions.
+
+    :param resolver: an :class:`MXResolver` or the resource name of one (defaults to
+        :class:`DNSPythonResolver`)
+    :param port: the port to connect to on the mail exchangers
+    :param local_hostname: the host name to send with ``EHLO`` (defaults to the fully
+        qualified domain name of the local host)
+    :param tls_context: either an :class:`~ssl.SSLContext` instance or the resource name
+        of one, used for STARTTLS
+    :param validate_certs: whether to validate the certificates of the mail exchangers
+    :param max_cache_ttl: maximum time (in seconds) to cache ``MX`` lookup results for
+    :param max_connections: maximum number of connections to keep open
+    :param idle_timeout: time (in seconds) after which an unused connection is closed
+    :param timeout: timeout (in seconds) for all network operations
+    :param chunk_size: maximum size (in bytes) of a single ``BDAT`` chunk
+    :param message_defaults: default values for omitted keyword arguments of
+        :meth:`~asphalt.mailer.api.Mailer.create_message`
+    """
+
+    resolver: MXResolver
+    tls_context: SSLContext | None
+
+    def __init__(
+        self,
+        *,
+        resolver: MXResolver | str | None = None,
+        port: int = 25,
+        local_hostname: str | None = None,
+        tls_context: str | SSLContext | None = None,
+        validate_certs: bool = False,
+        max_cache_ttl: float = 3600,
+        max_connections: int = 100,
+        idle_timeout: float = 60,
+        timeout: float = 10,
+        chunk_size: int = 1048576,
+        message_defaults: dict[str, Any] | None = None,
+    ):
+        super().__init__(
+            timeout=timeout, chunk_size=chunk_size, message_defaults=message_defaults
+        )
+        if max_connections < 1:
+            raise ValueError("max_connections must be at least 1")
+        if idle_timeout <= 0:
+            raise ValueError("idle_timeout must be positive")
+
+        self._resolver = resolver
+        self.port = port
+        self.local_hostname = local_hostname
+        self._tls_context = tls_context
+        self.validate_certs = validate_certs
+        self.max_cache_ttl = max_cache_ttl
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self._mx_cache: dict[str, tuple[float, list[MXRecord]]] = {}
+        self._lookups: dict[str, Future[list[MXRecord]]] = {}
+        # host -> connection, from the least to the most recently used
+        self._connections: dict[str, _Connection] = {}
+
+    async def start(self) -> None:
+        if isinstance(self._resolver, str):
+            self.resolver = require_resource(
+                MXResolver,  # type: ignore[type-abstract]
+                self._resolver,
+            )
+        elif self._resolver is None:
+            self.resolver = DNSPythonResolver()
+        else:
+            self.resolver = self._resolver
+
+        if isinstance(self._tls_context, str):
+            self.tls_context = require_resource(SSLContext, self._tls_context)
+        else:
+            self.tls_context = self._tls_context
+
+        current_context().add_teardown_callback(self._close_connections)
+
+    async def _close_connections(self) -> None:
+        connections, self._connections = self._connections, {}
+        for connection in connections.values():
+            if connection.idle_timer is not None:
+                connection.idle_timer.cancel()
+
+            if connection.smtp.is_connected:
+                try:
+                    await connection.smtp.quit()
+                except Exception:  # pragma: no cover
+                    connection.smtp.close()
+
+    async def get_mail_exchangers(self, domain: str) -> list[str]:
+        """
+        Return the host names of the mail exchangers of a domain in the order in which
+        they should be tried.
+
+        :param domain: the domain name
+        :return: the host names of the mail exchangers (an empty list if the domain
+            does not accept mail)
+        :raises LookupError: if the lookup failed
+
+        """
+        domain = domain.lower()
+        cached = self._mx_cache.get(domain)
+        if cached is not None and cached[0] > time.monotonic():
+            records = cached[1]
+        elif domain in self._lookups:
+            # Share the result of a lookup that is already in progress
+            records = await self._lookups[domain]
+        else:
+            future: Future[list[MXRecord]] = get_running_loop().create_future()
+            self._lookups[domain] = future
+            try:
+                records = await self.resolver.resolve_mx(domain)
+            except BaseException as exc:
+                future.set_exception(exc)
+                future.exception()  # don't warn about an unretrieved exception
+                raise
+            else:
+                future.set_result(records)
+                ttl = min((record.ttl for record in records), default=0)
+                expires = time.monotonic() + min(ttl, self.max_cache_ttl)
+                self._mx_cache[domain] = expires, records
+            finally:
+                del self._lookups[domain]
+
+        if not records:
+            # No MX records: the domain itself is the implicit mail exchanger
+            return [domain]
+
+        hosts: list[str] = []
+        records = sorted(records, key=lambda record: record.preference)
+        for _preference, group in groupby(records, lambda record: record.preference):
+            group_hosts = [record.host.rstrip(".") for record in group]
+            random.shuffle(group_hosts)
+            hosts.extend(group_hosts)
+
+        # A single "." means the domain does not accept mail (RFC 7505)
+        return [host for host in hosts if host]
+
+    def _get_connection(self, host: str) -> _Connection:
+        connection = self._connections.pop(host, None)
+        if connection is None:
+            # Make room by closing the least recently used idle connections
+            for other_host, other in list(self._connections.items()):
+                if len(self._connections) < self.max_connections:
+                    break
+
+                if not other.lock.locked():
+                    self._discard_connection(other_host, other)
+
+            connection = _Connection(
+                SMTP(
+                    hostname=host,
+                    port=self.port,
+                    local_hostname=self.local_hostname,
+                    tls_context=self.tls_context,
+                    validate_certs=self.validate_certs,
+                    timeout=self.timeout,
+                )
+            )
+        elif connection.idle_timer is not None:
+            connection.idle_timer.cancel()
+            connection.idle_timer = None
+
+        self._connections[host] = connection
+        return connection
+
+    def _release_connection(self, host: str, connection: _Connection) -> None:
+        if self._connections.get(host) is not connection:
+            # The connection was discarded while this delivery was waiting for it
+            connection.smtp.close()
+        elif not connection.lock.locked():
+            if connection.idle_timer is not None:
+                connection.idle_timer.cancel()
+
+            connection.idle_timer = get_running_loop().call_later(
+                self.idle_timeout, self._close_idle_connection, host, connection
+            )
+
+    def _close_idle_connection(self, host: str, connection: _Connection) -> None:
+        connection.idle_timer = None
+        if self._connections.get(host) is connection and not connection.lock.locked():
+            self._discard_connection(host, connection)
+
+    def _discard_connection(self, host: str, connection: _Connection) -> None:
+        if self._connections.get(host) is connection:
+            del self._connections[host]
+
+        if connection.idle_timer is not None:
+            connection.idle_timer.cancel()
+
+        connection.smtp.close()
+
+    async def _deliver_to_domain(
+        self, message: EmailMessage, domain: str, recipients: list[str]
+    ) -> None:
+        started = time.monotonic()
+        try:
+            with self.trace("mx.send", domain=domain):
+                size = await self._send_to_domain(message, domain, recipients)
+        except BaseException as exc:
+            self.record_delivery(
+                message,
+                started,
+                recipients=recipients,
+                status=_get_status(exc),
+                error=exc,
+            )
+            raise
+
+        self.record_delivery(
+            message, started, recipients=recipients, status=250, size=size
+        )
+
+    async def _send_to_domain(
+        self, message: EmailMessage, domain: str, recipients: list[str]
+    ) -> int:
+        try:
+            hosts = await self.get_mail_exchangers(domain)
+        except LookupError as exc:
+            raise DeliveryError(str(exc), message) from exc
+
+        if not hosts:
+            raise DeliveryError(f"{domain} does not accept mail", message)
+
+        errors: list[str] = []
+        for host in hosts:
+            connection = self._get_connection(host)
+            smtp = connection.smtp
+            try:
+                async with connection.lock:
+                    for attempt in range(2):
+                        reused = smtp.is_connected
+                        try:
+                            if not reused:
+                                with self.trace("mx.connect", host=host):
+                                    await smtp.connect()
+
+                            return await self._send_message(smtp, message, recipients)
+                        except (OSError, SMTPServerDisconnected) as exc:
+                            # Connection failed; try the next mail exchanger
+                            self._discard_connection(host, connection)
+                            errors.append(f"{host}: {exc}")
+                            break
+                        except SMTPException as exc:
+                            # The mail exchanger rejected the connection (like EHLO)
+                            self._discard_connection(host, connection)
+                            raise DeliveryError(f"{host}: {exc}", message) from exc
+                        except DeliveryError as exc:
+                            if isinstance(exc.__cause__, SMTPServerDisconnected):
+                                smtp.close()
+                                if reused and attempt == 0:
+                                    # The server closed the idle connection; try again
+                                    continue
+
+                            raise
+                        except BaseException:
+                            # Cancelled or timed out in an unknown protocol state
+                            self._discard_connection(host, connection)
+                            raise
+            finally:
+                self._release_connection(host, connection)
+
+        raise DeliveryError(
+            f"could not connect to any mail exchanger of {domain} "
+            f"({'; '.join(errors)})",
+            message,
+        )
+
+    async def deliver(self, messages: MessagesType) -> None:
+        async for message in iterate_messages(messages):
+            async with self.reserve_bytes(message):
+                await self._deliver_message(message)
+
+    async def _deliver_message(self, message: EmailMessage) -> None:
+        if not await self.claim_message(message):
+            return
+
+        recipients_by_domain: dict[str, list[str]] = {}
+        for recipient in get_recipients(message):
+            domain = recipient.rpartition("@")[2].lower()
+            recipients_by_domain.setdefault(domain, []).append(recipient)
+
+        try:
+            results = await gather(
+                *[
+                    self._deliver_to_domain(message, domain, recipients)
+                    for domain, recipients in recipients_by_domain.items()
+                ],
+                return_exceptions=True,
+            )
+        except BaseException:
+            self.release_message(message)
+            raise
+
+        errors: list[DeliveryError] = []
+        for result in results:
+            if isinstance(result, DeliveryError):
+                errors.append(result)
+            elif isinstance(result, BaseException):
+                self.release_message(message)
+                raise result
+
+        if errors and len(errors) == len(results):
+            # Nothing was delivered, so the message can be safely retried
+            self.release_message(message)
+        else:
+            self.complete_message(message)
+
+        if len(errors) == 1:
+            raise errors[0]
+        elif errors:
+            raise DeliveryError("; ".join(error.args[0] for error in errors), message)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(resolver={self._resolver!r})"
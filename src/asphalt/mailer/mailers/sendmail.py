@@ -1,45 +1,241 @@
 from __future__ import annotations
 
+import os
+import re
 import subprocess
 import sys
-from asyncio import create_subprocess_exec
+import time
+from asyncio import create_subprocess_exec, get_running_loop
 from collections.abc import Iterable
+from email import message_from_bytes, policy
 from email.message import EmailMessage
+from email.parser import BytesHeaderParser
 from pathlib import Path
-from typing import Any
+from typing import Any, Union
 
-from ..api import DeliveryError, Mailer
-from ..utils import get_recipients
+from ..api import DeliveryError, Mailer, MessagesType
+from ..concurrency import AdaptiveLimiter
+from ..utils import _size_attribute, estimate_size, get_recipients, iterate_messages
 
 __all__ = ["SendmailMailer"]
 
+#: exit code for temporary failures (from sysexits.h)
+_EX_TEMPFAIL = 75
+
+_header_end = re.compile(rb"\r?\n\r?\n")
+
+#: maximum size of the headers read by :meth:`SendmailMailer.deliver_file`
+_max_header_size = 1024 * 1024
+
+# A serialized message, or the path to a file containing one
+_MessageData = Union[bytes, Path]
+
+
+def _read_headers(path: Path) -> EmailMessage:
+    # Read just enough of the file to parse the headers
+    with path.open("rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        data = bytearray()
+        while True:
+            # Only search the new chunk, plus the tail of the previous one in case the
+            # blank line straddles the two
+            start = max(len(data) - 3, 0)
+            chunk = file.read(8192)
+            if not chunk:
+                break
+
+            data += chunk
+            match = _header_end.search(data, start)
+            if match:
+                del data[match.start() :]
+                break
+
+            if len(data) > _max_header_size:
+                raise ValueError(
+                    f"the headers of {path} exceed the maximum size "
+                    f"({_max_header_size} bytes)"
+                )
+
+    message = BytesHeaderParser(policy=policy.default).parsebytes(bytes(data))
+    setattr(message, _size_attribute, size)
+    return message
+
 
 class SendmailMailer(Mailer):
     """
     A mailer that sends mail by running the ``sendmail`` executable in a subprocess.
 
+    Since messages are passed to ``sendmail`` with ``-B 8BITMIME``, messages created
+    with :meth:`~asphalt.mailer.api.Mailer.create_message` get ``8bit`` bodies where
+    possible.
+
+    By default, every :meth:`deliver` call runs ``sendmail`` right away. To keep a
+    burst of deliveries from overwhelming the local mail system, pass options for an
+    :class:`~asphalt.mailer.concurrency.AdaptiveLimiter` as ``concurrency``. The number
+    of concurrent ``sendmail`` processes is then limited, and the limit is lowered when
+    ``sendmail`` slows down or exits with ``EX_TEMPFAIL``.
+
+    Messages that have already been serialized to a file (like the ones written by the
+    ``file`` mailer into a maildir) can be delivered with :meth:`deliver_file` without
+    loading them into memory.
+
     :param path: path to the sendmail executable
+    :param concurrency: keyword arguments passed to
+        :class:`~asphalt.mailer.concurrency.AdaptiveLimiter` to limit the number of
+        concurrent ``sendmail`` processes
     :param message_defaults: default values for omitted keyword arguments of
         :meth:`~asphalt.mailer.api.Mailer.create_message`
+    :ivar limiter: the concurrency limiter, if ``concurrency`` was given
+    :vartype limiter: ~asphalt.mailer.concurrency.AdaptiveLimiter | None
     """
 
-    __slots__ = "path"
+    __slots__ = "path", "limiter"
 
     def __init__(
         self,
         *,
         path: str | Path = "/usr/sbin/sendmail",
+        concurrency: dict[str, Any] | None = None,
         message_defaults: dict[str, Any] | None = None,
     ):
         super().__init__(message_defaults or {})
         self.path = str(path)
+        self.limiter = (
+            AdaptiveLimiter(**concurrency) if concurrency is not None else None
+        )
+
+    async def deliver(self, messages: MessagesType) -> None:
+        async for message in iterate_messages(messages):
+            await self._deliver(message)
+
+    async def deliver_file(
+        self, path: str | Path, recipients: Iterable[str] | None = None
+    ) -> None:
+        """
+        Deliver a message that has already been serialized to a file.
+
+        The file is passed to ``sendmail`` as its standard input, so the message goes
+        from the file to the process without being read into memory or copied through
+        Python. Only the headers are parsed (for the recipients, the idempotency key and
+        the journal).
+
+        If the message has a ``Bcc`` header (which must not be passed on), or if the
+        mailer has a DKIM signer, the message is loaded and delivered like the ones
+        passed to :meth:`deliver` instead.
+
+        :param path: path to a file containing the message, serialized like
+            :meth:`~email.message.EmailMessage.as_bytes` does
+        :param recipients: email addresses to deliver the message to (defaults to the
+            recipients listed in the headers of the message)
+        :raises ValueError: if the headers of the message are larger than 1 MiB
+
+        """
+        path = Path(path)
+        loop = get_running_loop()
+        message = await loop.run_in_executor(None, _read_headers, path)
+        recipient_list = list(recipients) if recipients is not None else None
+        if "Bcc" in message or self.dkim_signer is not None:
+            data = await loop.run_in_executor(None, path.read_bytes)
+            message = message_from_bytes(data, policy=policy.default)
+            await self._deliver(message, recipient_list)
+        else:
+            await self._deliver(message, recipient_list, path)
 
-    async def deliver(self, messages: EmailMessage | Iterable[EmailMessage]) -> None:
-        if isinstance(messages, EmailMessage):
-            messages = [messages]
+    async def _deliver(
+        self,
+        message: EmailMessage,
+        recipients: list[str] | None = None,
+        path: Path | None = None,
+    ) -> None:
+        if not await self.claim_message(message):
+            return
+
+        try:
+            async with self.reserve_bytes(message):
+                await self._deliver_message(message, recipients, path)
+        except BaseException:
+            self.release_message(message)
+            raise
+
+        self.complete_message(message)
+
+    async def _deliver_message(
+        self, message: EmailMessage, recipients: list[str] | None, path: Path | None
+    ) -> None:
+        if recipients is None:
+            recipients = get_recipients(message)
+
+        args = [self.path, "-i", "-B", "8BITMIME"] + recipients
+        del message["Bcc"]
+        attempt_started = time.monotonic()
+        returncode: int | None = None
+        data: _MessageData = b""
+        size: int | None = None
+        try:
+            if path is not None:
+                data = path
+                size = estimate_size(message)
+            else:
+                try:
+                    with self.trace("sendmail.serialize"):
+                        data = message.as_bytes()
 
-        for message in messages:
-            args = [self.path, "-i", "-B", "8BITMIME"] + get_recipients(message)
+                    data = await self.sign_message(data)
+                except Exception as e:
+                    raise DeliveryError(str(e), message) from e
+
+                size = len(data)
+
+            with self.trace("sendmail.send"):
+                if self.limiter is None:
+                    returncode, stderr = await self._run_sendmail(args, data, message)
+                else:
+                    async with self.limiter:
+                        started = time.monotonic()
+                        returncode, stderr = await self._run_sendmail(
+                            args, data, message
+                        )
+                        self.limiter.record(
+                            started, overloaded=returncode == _EX_TEMPFAIL
+                        )
+
+            if returncode:
+                error = stderr.decode(sys.stderr.encoding).rstrip()
+                raise DeliveryError(error, message)
+        except BaseException as exc:
+            self.record_delivery(
+                message,
+                attempt_started,
+                recipients=recipients,
+                status=returncode,
+                size=size,
+                error=exc,
+            )
+            raise
+
+        self.record_delivery(
+            message,
+            attempt_started,
+            recipients=recipients,
+            status=returncode,
+            size=size,
+        )
+
+    async def _run_sendmail(
+        self, args: list[str], data: _MessageData, message: EmailMessage
+    ) -> tuple[int | None, bytes]:
+        if isinstance(data, Path):
+            # Let the process read the message straight from the file
+            try:
+                with data.open("rb") as file:
+                    process = await create_subprocess_exec(
+                        *args, stdin=file, stderr=subprocess.PIPE
+                    )
+            except Exception as e:
+                raise DeliveryError(str(e), message) from e
+
+            stdout, stderr = await process.communicate()
+        else:
             try:
                 process = await create_subprocess_exec(
                     *args, stdin=subprocess.PIPE, stderr=subprocess.PIPE
@@ -47,11 +243,9 @@ class SendmailMailer(Mailer):
             except Exception as e:
                 raise DeliveryError(str(e), message) from e
 
-            del message["Bcc"]
-            stdout, stderr = await process.communicate(message.as_bytes())
-            if process.returncode:
-                error = stderr.decode(sys.stderr.encoding).rstrip()
-                raise DeliveryError(error, message)
+            stdout, stderr = await process.communicate(data)
+
+        return process.returncode, stderr
 
     def __repr__(self) -> str:
         return f"{self.__class__.__name__}({self.path!r})"
@@ -1,44 +1,356 @@
 from __future__ import annotations
 
+import asyncio
 import logging
-from collections.abc import Iterable
+import time
+from asyncio import Queue, wait_for
+from collections.abc import AsyncIterator, Awaitable
+from contextlib import asynccontextmanager
 from email.message import EmailMessage
 from ssl import SSLContext
-from typing import Any
+from typing import Any, TypeVar
 
-from aiosmtplib import SMTP, SMTPTimeoutError
+from aiosmtplib import (
+    SMTP,
+    SMTPDataError,
+    SMTPException,
+    SMTPRecipientRefused,
+    SMTPRecipientsRefused,
+    SMTPResponseException,
+    SMTPStatus,
+    SMTPTimeoutError,
+)
+from aiosmtplib.email import extract_recipients, extract_sender, flatten_message
 from asphalt.core import current_context, require_resource
 
-from ..api import DeliveryError, Mailer
+from ..api import DeliveryError, DeliveryResult, Mailer, MessagesType
+from ..concurrency import AdaptiveLimiter
+from ..utils import iterate_messages
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
 
-class SMTPMailer(Mailer):
+
+def _is_overload(exc: BaseException | None) -> bool:
+    # Timeouts and transient (4xx) failures are taken as signs of an overloaded server
+    if isinstance(exc, SMTPRecipientsRefused):
+        return any(400 <= refusal.code < 500 for refusal in exc.recipients)
+
+    return isinstance(exc, SMTPTimeoutError) or (
+        isinstance(exc, SMTPResponseException) and 400 <= exc.code < 500
+    )
+
+
+def _get_status(exc: BaseException) -> int | None:
+    # Return the reply code of the server response that caused a delivery to fail
+    cause = exc.__cause__ if isinstance(exc, DeliveryError) else exc
+    if isinstance(cause, SMTPRecipientsRefused) and cause.recipients:
+        return cause.recipients[0].code
+    elif isinstance(cause, SMTPResponseException):
+        return cause.code
+
+    return None
+
+
+class _Deadline:
+    """The time by which a whole delivery call must be finished, if any."""
+
+    __slots__ = ("expires",)
+
+    def __init__(self, expires: float | None):
+        self.expires = expires
+
+    @property
+    def expired(self) -> bool:
+        return self.expires is not None and time.monotonic() >= self.expires
+
+    def cap(self, timeout: float) -> float:
+        # Cut the timeout of a single operation short to the time remaining (the error
+        # gets converted to a DeliveryError like any other error from the operation)
+        if self.expires is None:
+            return timeout
+
+        remaining = self.expires - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("delivery deadline exceeded")
+
+        return min(timeout, remaining)
+
+    async def wait(self, awaitable: Awaitable[T]) -> T:
+        if self.expires is None:
+            return await awaitable
+
+        try:
+            return await wait_for(awaitable, max(self.expires - time.monotonic(), 0))
+        except asyncio.TimeoutError:
+            raise DeliveryError("delivery deadline exceeded") from None
+
+
+_no_deadline = _Deadline(None)
+
+
+class _BaseSMTPMailer(Mailer):
+    """
+    Sends messages over aiosmtplib connections, honoring the ESMTP extensions
+    described in :class:`SMTPMailer`.
+    """
+
+    def __init__(
+        self,
+        *,
+        timeout: float = 10,
+        command_timeout: float | None = None,
+        min_data_rate: float | None = None,
+        chunk_size: int = 1048576,
+        message_defaults: dict[str, Any] | None = None,
+    ):
+        super().__init__(message_defaults or {})
+        if min_data_rate is not None and min_data_rate <= 0:
+            raise ValueError("min_data_rate must be positive")
+
+        self.timeout = timeout
+        self.command_timeout = (
+            command_timeout if command_timeout is not None else timeout
+        )
+        self.min_data_rate = min_data_rate
+        self.chunk_size = chunk_size
+
+    def _get_data_timeout(self, size: int) -> float:
+        # Give larger uploads more time, as long as they proceed at the minimum rate
+        if self.min_data_rate is None:
+            return self.command_timeout
+
+        return self.command_timeout + size / self.min_data_rate
+
+    async def _send_message(
+        self,
+        smtp: SMTP,
+        message: EmailMessage,
+        recipients: list[str] | None = None,
+        deadline: _Deadline = _no_deadline,
+    ) -> int:
+        extensions = smtp.esmtp_extensions
+        utf8 = "smtputf8" in extensions
+        eightbit = "8bitmime" in extensions
+        chunking = "chunking" in extensions
+        try:
+            # Don't bother serializing and signing a message that can't be sent anymore
+            if deadline.expired:
+                raise TimeoutError("delivery deadline exceeded")
+
+            sender = extract_sender(message)
+            if recipients is None:
+                recipients = extract_recipients(message)
+
+            if sender is None:
+                raise ValueError("No From header provided in message")
+
+            with self.trace("smtp.serialize"):
+                data = flatten_message(
+                    message, utf8=utf8, cte_type="8bit" if eightbit else "7bit"
+                )
+
+            data = await self.sign_message(data)
+        except Exception as e:
+            raise DeliveryError(str(e), message) from e
+
+        mail_options = []
+        if chunking and "binarymime" in extensions:
+            mail_options.append("BODY=BINARYMIME")
+        elif eightbit:
+            mail_options.append("BODY=8BITMIME")
+
+        if utf8:
+            headers_end = data.find(b"\r\n\r\n")
+            if not data[:headers_end].isascii():
+                mail_options.append("SMTPUTF8")
+
+        if "size" in extensions:
+            max_size = int(extensions["size"] or 0)
+            if max_size and len(data) > max_size:
+                raise DeliveryError(
+                    f"message size ({len(data)} bytes) exceeds the server's limit "
+                    f"({max_size} bytes)",
+                    message,
+                )
+
+        try:
+            await self._transmit(
+                smtp, sender, recipients, data, mail_options, chunking, deadline
+            )
+        except Exception as e:
+            raise DeliveryError(str(e), message) from e
+
+        return len(data)
+
+    async def _transmit(
+        self,
+        smtp: SMTP,
+        sender: str,
+        recipients: list[str],
+        data: bytes,
+        mail_options: list[str],
+        chunking: bool,
+        deadline: _Deadline,
+    ) -> None:
+        encoding = "utf-8" if "SMTPUTF8" in mail_options else "ascii"
+        if smtp.supports_extension("size"):
+            mail_options = [f"SIZE={len(data)}", *mail_options]
+
+        try:
+            await smtp.mail(
+                sender,
+                mail_options,
+                encoding=encoding,
+                timeout=deadline.cap(self.command_timeout),
+            )
+            refusals = []
+            for recipient in recipients:
+                try:
+                    await smtp.rcpt(
+                        recipient,
+                        encoding=encoding,
+                        timeout=deadline.cap(self.command_timeout),
+                    )
+                except SMTPRecipientRefused as exc:
+                    refusals.append(exc)
+
+            if len(refusals) == len(recipients):
+                raise SMTPRecipientsRefused(refusals)
+
+            if not chunking:
+                await smtp.data(
+                    data, timeout=deadline.cap(self._get_data_timeout(len(data)))
+                )
+                return
+
+            # BDAT sends the message as is, so unlike with DATA, there is no need to
+            # scan it for lines to dot-stuff
+            protocol = smtp.protocol
+            assert protocol is not None
+            view = memoryview(data)
+            for offset in range(0, len(view), self.chunk_size):
+                chunk = view[offset : offset + self.chunk_size]
+                last = " LAST" if offset + self.chunk_size >= len(view) else ""
+                protocol.write(f"BDAT {len(chunk)}{last}\r\n".encode("ascii"))
+                protocol.write(chunk)  # type: ignore[arg-type]
+                response = await protocol.read_response(
+                    timeout=deadline.cap(self._get_data_timeout(len(chunk)))
+                )
+                if response.code != SMTPStatus.completed:
+                    raise SMTPDataError(response.code, response.message)
+        except (SMTPResponseException, SMTPRecipientsRefused):
+            try:
+                await smtp.rset(timeout=deadline.cap(self.command_timeout))
+            except (ConnectionError, SMTPResponseException, TimeoutError):
+                pass
+
+            raise
+
+
+class SMTPMailer(_BaseSMTPMailer):
     """
     A mailer that uses `aiosmtplib`_ to send mails.
 
+    The ESMTP extensions advertised by the server are honored as follows:
+
+    * ``SIZE``: messages larger than the server's limit are rejected locally with a
+      :exc:`~asphalt.mailer.api.DeliveryError` before any of their data is uploaded
+    * ``8BITMIME``: message bodies are sent without re-encoding them, and messages
+      created afterwards with :meth:`~asphalt.mailer.api.Mailer.create_message` get
+      ``8bit`` bodies where possible
+    * ``SMTPUTF8``: headers are sent as UTF-8 rather than as encoded words
+    * ``CHUNKING``: messages are sent in ``BDAT`` chunks of at most ``chunk_size``
+      bytes instead of with ``DATA``, which avoids having to dot-stuff the message
+    * ``BINARYMIME``: messages sent with ``BDAT`` are declared as ``BINARYMIME``,
+      allowing parts with the ``binary`` content transfer encoding
+
+    Deliveries are made on *lanes*, each of which has its own set of connections that no
+    other lane can use. This way, urgent mail (like password reset links) can be kept
+    from queuing behind a large bulk delivery by giving it its own lane, and then
+    passing that lane's name as ``lane`` to :meth:`deliver` or :meth:`deliver_iter`.
+    Each :meth:`deliver` or :meth:`deliver_iter` call holds a single connection of its
+    lane until it's finished.
+
+    Instead of always using every connection of a lane, the mailer can adapt the number
+    of concurrent deliveries on each lane to what the server can handle, by passing
+    options for an :class:`~asphalt.mailer.concurrency.AdaptiveLimiter` as
+    ``concurrency``. The limit then lowers when deliveries time out, get transient
+    (``4xx``) errors or slow down, and grows back as long as they don't, but never
+    exceeds the number of connections of the lane. The limiter of each lane can be
+    inspected in :attr:`limiters`.
+
+    Each step of a delivery has its own timeout: ``connect_timeout`` for establishing
+    the connection, ``tls_timeout`` for the TLS handshake, ``auth_timeout`` for logging
+    in and ``command_timeout`` for each of the other commands. Those left out default to
+    ``timeout``. Uploading the message data is allowed ``command_timeout`` seconds plus
+    the time it takes at ``min_data_rate`` bytes per second, so large messages aren't
+    cut off while a stalled upload of a small one still is. On top of these, the time
+    of a whole :meth:`deliver` or :meth:`deliver_iter` call, including the time spent
+    waiting for a connection, can be limited with ``delivery_timeout`` or the
+    ``deadline`` argument. Each step is then cut short to the time remaining, and once
+    the deadline passes, the remaining messages fail with a
+    :exc:`~asphalt.mailer.api.DeliveryError`.
+
+    Several mailers delivering through the same server (like one per tenant, each with
+    its own ``message_defaults``) can share a single set of connections by passing the
+    first mailer (or its resource name) as ``connections_from`` to the others. Their
+    deliveries then go through the lanes, connections and concurrency limiters of that
+    mailer, using its connection settings and timeouts (except ``delivery_timeout``),
+    while everything else about the messages (defaults, DKIM signing, journal and so
+    on) stays specific to each mailer.
+
     The default port is chosen as follows:
 
+    * 465: if ``implicit_tls`` is ``True``
     * 587: if ``username`` and ``password`` have been defined and ``tls`` is ``True``
     * 25: in all other cases
 
     :param host: host name of the SMTP server
     :param port: override the default port (see above)
-    :param tls: whether to initiate TLS using STARTTLS once connected (defaults to
-        ``True`` if ``username`` and ``password`` have been defined)
+    :param tls: ``True`` to require TLS using STARTTLS once connected, ``False`` to
+        never use STARTTLS, or ``None`` to use it whenever the server offers it
+        (defaults to ``True`` if ``username`` and ``password`` have been defined,
+        unless ``implicit_tls`` is ``True``)
+    :param implicit_tls: whether to negotiate TLS immediately upon connecting
+        (SMTPS), skipping the STARTTLS upgrade (mutually exclusive with ``tls``)
     :param tls_context: either an :class:`~ssl.SSLContext` instance or the resource name
         of one
     :param username: username to authenticate as
     :param password: password to authenticate with
-    :param timeout: timeout (in seconds) for all network operations
+    :param timeout: default timeout (in seconds) for network operations
+    :param connect_timeout: timeout (in seconds) for establishing a connection
+    :param tls_timeout: timeout (in seconds) for the TLS handshake
+    :param auth_timeout: timeout (in seconds) for logging in
+    :param command_timeout: timeout (in seconds) for other SMTP commands
+    :param min_data_rate: the slowest upload rate (in bytes per second) to allow for
+        when sending message data (``None`` to allow ``command_timeout`` regardless of
+        the size of the message)
+    :param delivery_timeout: maximum time (in seconds) a single :meth:`deliver` or
+        :meth:`deliver_iter` call may take
+    :param chunk_size: maximum size (in bytes) of a single ``BDAT`` chunk
+    :param connections_from: another SMTP mailer (or the resource name of one) whose
+        connections to use instead of opening its own (the connection, timeout (except
+        ``delivery_timeout``), ``chunk_size``, lane and concurrency options of this
+        mailer are then ignored)
+    :param lanes: a mapping of lane names to the number of connections reserved for each
+        lane (defaults to a single ``default`` lane with one connection); must include
+        a ``default`` lane, which is used when no lane is specified
+    :param concurrency: keyword arguments passed to
+        :class:`~asphalt.mailer.concurrency.AdaptiveLimiter` to create a limiter for
+        each lane
     :param message_defaults: default values for omitted keyword arguments of
         :meth:`~asphalt.mailer.api.Mailer.create_message`
 
+    :ivar limiters: the concurrency limiters of each lane, if ``concurrency`` was
+        given
+    :vartype limiters: dict[str, ~asphalt.mailer.concurrency.AdaptiveLimiter]
+
     .. _aiosmtplib: https://github.com/cole/aiosmtplib
     """
 
-    _smtp: SMTP
+    _pools: dict[str, Queue[SMTP]]
 
     def __init__(
         self,
@@ -46,58 +358,277 @@ class SMTPMailer(Mailer):
         host: str = "localhost",
         port: int | None = None,
         tls: bool | None = None,
+        implicit_tls: bool = False,
         tls_context: str | SSLContext | None = None,
         username: str | None = None,
         password: str | None = None,
         timeout: float = 10,
+        connect_timeout: float | None = None,
+        tls_timeout: float | None = None,
+        auth_timeout: float | None = None,
+        command_timeout: float | None = None,
+        min_data_rate: float | None = None,
+        delivery_timeout: float | None = None,
+        chunk_size: int = 1048576,
+        connections_from: SMTPMailer | str | None = None,
+        lanes: dict[str, int] | None = None,
+        concurrency: dict[str, Any] | None = None,
         message_defaults: dict[str, Any] | None = None,
     ):
-        super().__init__(message_defaults or {})
+        super().__init__(
+            timeout=timeout,
+            command_timeout=command_timeout,
+            min_data_rate=min_data_rate,
+            chunk_size=chunk_size,
+            message_defaults=message_defaults,
+        )
+        if implicit_tls and tls:
+            raise ValueError("tls and implicit_tls are mutually exclusive")
+
+        self.connect_timeout = (
+            connect_timeout if connect_timeout is not None else timeout
+        )
+        self.tls_timeout = tls_timeout if tls_timeout is not None else timeout
+        self.auth_timeout = auth_timeout if auth_timeout is not None else timeout
+        self.delivery_timeout = delivery_timeout
+
         self.host = host
-        self.tls = tls if tls is not None else bool(username and password)
-        self.port = port or (587 if username and password and self.tls else 25)
+        self.implicit_tls = implicit_tls
+        if implicit_tls:
+            self.tls: bool | None = False
+            self.port = port or 465
+        else:
+            self.tls = tls if tls is not None else (bool(username and password) or None)
+            self.port = port or (587 if username and password and self.tls else 25)
+
         self.tls_context = tls_context
         self.username = username
         self.password = password
-        self.timeout = timeout
+        self.connections_from = connections_from
+        self._transport = self
+        self.lanes = lanes or {"default": 1}
+        if "default" not in self.lanes:
+            raise ValueError("lanes must include a 'default' lane")
+
+        for lane, connections in self.lanes.items():
+            if connections < 1:
+                raise ValueError(
+                    f"lane {lane!r} must have at least one connection reserved"
+                )
+
+        self.limiters: dict[str, AdaptiveLimiter] = {}
+        if concurrency is not None:
+            for lane, connections in self.lanes.items():
+                max_limit = min(concurrency.get("max_limit", connections), connections)
+                self.limiters[lane] = AdaptiveLimiter(
+                    **{**concurrency, "max_limit": max_limit}
+                )
 
     async def start(self) -> None:
+        ctx = current_context()
+        if isinstance(self.connections_from, str):
+            self.connections_from = await ctx.request_resource(
+                SMTPMailer, self.connections_from
+            )
+
+        if self.connections_from is not None:
+            # The other mailer has been started already, and owns the connections
+            self._transport = self.connections_from
+            self.host = self._transport.host
+            self.port = self._transport.port
+            self.lanes = self._transport.lanes
+            self.limiters = self._transport.limiters
+            self.timeout = self._transport.timeout
+            self.connect_timeout = self._transport.connect_timeout
+            self.tls_timeout = self._transport.tls_timeout
+            self.auth_timeout = self._transport.auth_timeout
+            self.command_timeout = self._transport.command_timeout
+            self.min_data_rate = self._transport.min_data_rate
+            self.chunk_size = self._transport.chunk_size
+            return
+
         if isinstance(self.tls_context, str):
             self.tls_context = require_resource(SSLContext, self.tls_context)
 
-        self._smtp = SMTP(
-            hostname=self.host,
-            port=self.port,
-            tls_context=self.tls_context,
-            timeout=self.timeout,
-        )
-        current_context().add_teardown_callback(self._smtp.close)
+        self._pools = {}
+        for lane, connections in self.lanes.items():
+            pool: Queue[SMTP] = Queue()
+            for _ in range(connections):
+                smtp = SMTP(
+                    hostname=self.host,
+                    port=self.port,
+                    use_tls=self.implicit_tls,
+                    tls_context=self.tls_context,
+                    timeout=self.timeout,
+                )
+                ctx.add_teardown_callback(smtp.close)
+                pool.put_nowait(smtp)
+
+            self._pools[lane] = pool
+
+    def _get_deadline(self, deadline: float | None) -> _Deadline:
+        if self.delivery_timeout is not None:
+            expires = time.monotonic() + self.delivery_timeout
+            deadline = expires if deadline is None else min(deadline, expires)
 
-    async def deliver(self, messages: EmailMessage | Iterable[EmailMessage]) -> None:
-        if isinstance(messages, EmailMessage):
-            messages = [messages]
+        return _Deadline(deadline)
 
+    @asynccontextmanager
+    async def _connect(self, lane: str, deadline: _Deadline) -> AsyncIterator[SMTP]:
         try:
-            try:
-                await self._smtp.connect()
+            pool = self._pools[lane]
+        except KeyError:
+            raise ValueError(f"no such lane: {lane!r}") from None
 
-                # Authenticate if needed
-                if self.username is not None and self.password is not None:
-                    await self._smtp.login(self.username, self.password)
-            except Exception as e:
-                raise DeliveryError(str(e)) from e
+        limiter = self.limiters.get(lane)
+        if limiter is not None:
+            await deadline.wait(limiter.acquire())
 
-            for message in messages:
+        try:
+            smtp = await deadline.wait(pool.get())
+            try:
+                started = time.monotonic()
                 try:
-                    await self._smtp.send_message(message)
+                    # With implicit TLS, the handshake is part of connecting
+                    connect_timeout = self.connect_timeout
+                    if self.implicit_tls:
+                        connect_timeout += self.tls_timeout
+
+                    with self.trace("smtp.connect"):
+                        await smtp.connect(
+                            timeout=deadline.cap(connect_timeout), start_tls=False
+                        )
+                        await smtp.ehlo(timeout=deadline.cap(self.command_timeout))
+
+                    if self.tls or (
+                        self.tls is None and smtp.supports_extension("starttls")
+                    ):
+                        with self.trace("smtp.starttls"):
+                            await smtp.starttls(timeout=deadline.cap(self.tls_timeout))
+                            await smtp.ehlo(timeout=deadline.cap(self.command_timeout))
+
+                    # Authenticate if needed
+                    if self.username is not None and self.password is not None:
+                        with self.trace("smtp.login"):
+                            await smtp.login(
+                                self.username,
+                                self.password,
+                                timeout=deadline.cap(self.auth_timeout),
+                            )
                 except Exception as e:
-                    raise DeliveryError(str(e), message) from e
+                    if limiter is not None and _is_overload(e) and not deadline.expired:
+                        limiter.record(started, overloaded=True)
+
+                    raise DeliveryError(str(e)) from e
+
+                yield smtp
+            finally:
+                # The connection must go back to the pool no matter how QUIT goes, or
+                # the lane would lose it for good
+                try:
+                    if smtp.is_connected:
+                        await smtp.quit(timeout=deadline.cap(self.command_timeout))
+                except (ConnectionError, SMTPException, TimeoutError):
+                    smtp.close()
+                except BaseException:
+                    smtp.close()
+                    raise
+                finally:
+                    pool.put_nowait(smtp)
         finally:
-            if self._smtp.is_connected:
+            if limiter is not None:
+                limiter.release()
+
+    async def _deliver_message(
+        self,
+        smtp: SMTP,
+        message: EmailMessage,
+        limiter: AdaptiveLimiter | None,
+        deadline: _Deadline,
+    ) -> None:
+        if not await self.claim_message(message):
+            return
+
+        started = time.monotonic()
+        try:
+            with self.trace("smtp.send"):
+                size = await self._send_message(smtp, message, deadline=deadline)
+        except BaseException as exc:
+            self.release_message(message)
+            self.record_delivery(message, started, status=_get_status(exc), error=exc)
+            if limiter is not None and isinstance(exc, DeliveryError):
+                # Only failures reported by the server say anything about its load, and
+                # timeouts cut short by the deadline don't count
+                if _is_overload(exc.__cause__) and not deadline.expired:
+                    limiter.record(started, overloaded=True)
+                elif isinstance(exc.__cause__, SMTPResponseException):
+                    limiter.record(started)
+
+            raise
+
+        self.record_delivery(
+            message, started, status=SMTPStatus.completed.value, size=size
+        )
+        self.complete_message(message)
+        if limiter is not None:
+            limiter.record(started)
+
+    async def deliver(
+        self,
+        messages: MessagesType,
+        *,
+        lane: str = "default",
+        deadline: float | None = None,
+    ) -> None:
+        """
+        Deliver the given message(s).
+
+        :param messages: the message, or an iterable or asynchronous iterable of
+            messages to deliver
+        :param lane: name of the lane to deliver the message(s) on
+        :param deadline: the value of :func:`time.monotonic` by which the call must be
+            finished (if ``delivery_timeout`` is also set, whichever comes first
+            applies)
+
+        """
+        limiter = self.limiters.get(lane)
+        call_deadline = self._get_deadline(deadline)
+        async with self._transport._connect(lane, call_deadline) as smtp:
+            async for message in iterate_messages(messages):
+                async with self.reserve_bytes(message):
+                    await self._deliver_message(smtp, message, limiter, call_deadline)
+
+    async def deliver_iter(
+        self,
+        messages: MessagesType,
+        *,
+        lane: str = "default",
+        deadline: float | None = None,
+    ) -> AsyncIterator[DeliveryResult]:
+        """
+        Deliver the given message(s), yielding the outcome of each one as it completes.
+
+        :param messages: the message, or an iterable or asynchronous iterable of
+            messages to deliver
+        :param lane: name of the lane to deliver the message(s) on
+        :param deadline: the value of :func:`time.monotonic` by which the call must be
+            finished (if ``delivery_timeout`` is also set, whichever comes first
+            applies)
+
+        """
+        limiter = self.limiters.get(lane)
+        call_deadline = self._get_deadline(deadline)
+        async with self._transport._connect(lane, call_deadline) as smtp:
+            async for message in iterate_messages(messages):
                 try:
-                    await self._smtp.quit()
-                except (ConnectionError, SMTPTimeoutError):  # pragma: nocover
-                    self._smtp.close()
+                    async with self.reserve_bytes(message):
+                        await self._deliver_message(
+                            smtp, message, limiter, call_deadline
+                        )
+                except DeliveryError as exc:
+                    yield DeliveryResult(message, exc)
+                else:
+                    yield DeliveryResult(message)
 
     def __repr__(self) -> str:
         return f"{self.__class__.__name__}(host={self.host!r}, port={self.port})"
@@ -0,0 +1,351 @@
+"""Deferred delivery of messages."""
+
+from __future__ import annotations
+
+import heapq
+import logging
+import struct
+import time
+import zlib
+from asyncio import (
+    Event,
+    Lock,
+    Semaphore,
+    Task,
+    create_task,
+    current_task,
+    gather,
+    get_running_loop,
+    sleep,
+)
+from email import message_from_bytes, policy
+from itertools import count
+from pathlib import Path
+from typing import IO, TYPE_CHECKING, Tuple
+
+from .idempotency import get_idempotency_key, set_idempotency_key
+from .utils import iterate_messages
+
+if TYPE_CHECKING:
+    from .api import Mailer, MessagesType
+
+__all__ = ["DeliveryScheduler"]
+
+logger = logging.getLogger(__name__)
+
+# (due time, sequence number, serialized message, idempotency key, compressed)
+_Entry = Tuple[float, int, bytes, str, bool]
+
+# Journal records: a message was scheduled (A, or Z if the message is compressed), or a
+# scheduled message was released (R)
+_added = struct.Struct(">cdQII")
+_released = struct.Struct(">cQ")
+
+
+class DeliveryScheduler:
+    """
+    Holds messages until they're due for delivery, and then delivers them with a
+    mailer.
+
+    Pending messages are kept serialized in a heap ordered by their due time, which is
+    watched by a single background task. This keeps the memory and CPU overhead of each
+    pending message low even with millions of them. Unless ``compression_level`` is
+    ``None``, the serialized messages are also compressed with zlib, and only
+    decompressed and parsed again right before they're delivered. A typical message
+    with an attachment takes a few kilobytes this way, compared to over a hundred as an
+    :class:`~email.message.EmailMessage`.
+
+    To keep a large batch of messages scheduled for the same time from hitting the mail
+    server all at once, due messages are released at most ``release_rate`` messages per
+    second, with at most ``max_concurrency`` deliveries in progress at once. Messages
+    that fail to be delivered are logged and discarded.
+
+    If ``path`` is given, scheduled messages are also written to that file, and
+    messages still pending when the application stops are loaded from it on the next
+    start. The file is compacted when it's loaded and truncated whenever no messages are
+    pending.
+
+    The scheduler is normally created by the component (configured with the
+    ``scheduler`` option) and closed when the context is torn down. A mailer created
+    outside of the component needs one set as its ``scheduler`` attribute before
+    :meth:`~asphalt.mailer.api.Mailer.deliver_at` can be used.
+
+    :param mailer: the mailer to deliver the messages with
+    :param release_rate: maximum number of due messages to release per second
+        (``None`` for no limit)
+    :param max_concurrency: maximum number of deliveries in progress at once
+    :param path: path to a file for persisting the pending messages
+    :param compression_level: zlib compression level (1-9) for the pending messages, or
+        ``None`` to store them uncompressed
+    """
+
+    __slots__ = (
+        "mailer",
+        "release_rate",
+        "max_concurrency",
+        "path",
+        "compression_level",
+        "_heap",
+        "_pending_bytes",
+        "_counter",
+        "_file",
+        "_file_lock",
+        "_wakeup",
+        "_task",
+        "_deliveries",
+        "_semaphore",
+    )
+
+    def __init__(
+        self,
+        mailer: Mailer,
+        *,
+        release_rate: float | None = 100,
+        max_concurrency: int = 10,
+        path: str | Path | None = None,
+        compression_level: int | None = 6,
+    ):
+        if release_rate is not None and release_rate <= 0:
+            raise ValueError("release_rate must be positive")
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        if compression_level is not None and not 1 <= compression_level <= 9:
+            raise ValueError("compression_level must be between 1 and 9")
+
+        self.mailer = mailer
+        self.release_rate = release_rate
+        self.max_concurrency = max_concurrency
+        self.path = Path(path) if path is not None else None
+        self.compression_level = compression_level
+        self._heap: list[_Entry] = []
+        self._pending_bytes = 0
+        self._counter = count()
+        self._file: IO[bytes] | None = None
+        self._file_lock = Lock()
+        self._wakeup = Event()
+        self._task: Task[None] | None = None
+        self._deliveries: set[Task[None]] = set()
+        self._semaphore = Semaphore(max_concurrency)
+        if self.path is not None:
+            self._load(self.path)
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    @property
+    def pending_bytes(self) -> int:
+        """The total size of the pending messages, as stored in memory."""
+        return self._pending_bytes
+
+    def _load(self, path: Path) -> None:
+        entries: dict[int, _Entry] = {}
+        try:
+            file = path.open("rb")
+        except FileNotFoundError:
+            pass
+        else:
+            with file:
+                while record_type := file.read(1):
+                    if record_type in (b"A", b"Z"):
+                        header = record_type + file.read(_added.size - 1)
+                        if len(header) < _added.size:
+                            break
+
+                        _, due, seq, key_length, data_length = _added.unpack(header)
+                        key = file.read(key_length)
+                        data = file.read(data_length)
+                        if len(data) < data_length:
+                            break  # a partially written last record
+
+                        compressed = record_type == b"Z"
+                        entries[seq] = due, seq, data, key.decode("utf-8"), compressed
+                    elif record_type == b"R":
+                        header = record_type + file.read(_released.size - 1)
+                        if len(header) < _released.size:
+                            break
+
+                        entries.pop(_released.unpack(header)[1], None)
+                    else:
+                        break
+
+        # Renumber the entries, keeping their order, and compact the file
+        self._heap = [
+            (due, seq, data, key, compressed)
+            for seq, (due, _, data, key, compressed) in enumerate(
+                sorted(entries.values())
+            )
+        ]
+        self._counter = count(len(self._heap))
+        self._pending_bytes = sum(len(entry[2]) for entry in self._heap)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + ".tmp")
+        with tmp_path.open("wb") as tmp_file:
+            for entry in self._heap:
+                tmp_file.write(self._encode_added(entry))
+
+        tmp_path.replace(path)
+        self._file = path.open("ab")
+
+    @staticmethod
+    def _encode_added(entry: _Entry) -> bytes:
+        due, seq, data, key, compressed = entry
+        encoded_key = key.encode("utf-8")
+        return (
+            _added.pack(
+                b"Z" if compressed else b"A", due, seq, len(encoded_key), len(data)
+            )
+            + encoded_key
+            + data
+        )
+
+    def _write(self, records: list[bytes], truncate: bool) -> None:
+        assert self._file is not None
+        if truncate:
+            self._file.truncate(0)
+        else:
+            self._file.write(b"".join(records))
+
+        self._file.flush()
+
+    async def start(self) -> None:
+        """Start releasing due messages, including any loaded from the file."""
+        if self._task is None:
+            self._task = create_task(self._run())
+
+    async def schedule(self, messages: MessagesType, when: float) -> None:
+        """
+        Schedule messages to be delivered at the given time.
+
+        The messages are serialized right away, so changes made to them afterwards have
+        no effect on what gets delivered.
+
+        :param messages: the message, or an iterable or asynchronous iterable of
+            messages to deliver
+        :param when: the time (as a UNIX timestamp) to deliver the messages at
+
+        """
+        entries: list[_Entry] = []
+        async for message in iterate_messages(messages):
+            key = get_idempotency_key(message) or ""
+            data = message.as_bytes()
+            if self.compression_level is not None:
+                data = zlib.compress(data, self.compression_level)
+
+            entries.append(
+                (
+                    when,
+                    next(self._counter),
+                    data,
+                    key,
+                    self.compression_level is not None,
+                )
+            )
+
+        async with self._file_lock:
+            if self._file is not None:
+                records = [self._encode_added(entry) for entry in entries]
+                await get_running_loop().run_in_executor(
+                    None, self._write, records, False
+                )
+
+            for entry in entries:
+                heapq.heappush(self._heap, entry)
+                self._pending_bytes += len(entry[2])
+
+        await self.start()
+        self._wakeup.set()
+
+    async def _run(self) -> None:
+        if self._heap:
+            logger.info("Loaded %d pending scheduled messages", len(self._heap))
+
+        released_at = float("-inf")
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                # Wake up early if an earlier message gets scheduled
+                self._wakeup.clear()
+                handle = get_running_loop().call_later(delay, self._wakeup.set)
+                try:
+                    await self._wakeup.wait()
+                finally:
+                    handle.cancel()
+
+                continue
+
+            if self.release_rate is not None:
+                # Spread out the release of a batch of due messages
+                delay = released_at + 1 / self.release_rate - time.monotonic()
+                if delay > 0:
+                    await sleep(delay)
+
+                released_at = time.monotonic()
+
+            await self._semaphore.acquire()
+            entry = heapq.heappop(self._heap)
+            self._pending_bytes -= len(entry[2])
+            task = create_task(self._deliver(entry))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+
+    async def _deliver(self, entry: _Entry) -> None:
+        due, seq, data, key, compressed = entry
+        try:
+            if compressed:
+                data = zlib.decompress(data)
+
+            message = message_from_bytes(data, policy=policy.default)
+            if key:
+                set_idempotency_key(message, key)
+
+            try:
+                await self.mailer.deliver(message)
+            except Exception:
+                logger.exception(
+                    "Error delivering a scheduled message (Subject: %s)",
+                    message["Subject"],
+                )
+        finally:
+            self._semaphore.release()
+
+        async with self._file_lock:
+            if self._file is not None:
+                # Once nothing is pending or being delivered, the whole file can be
+                # discarded
+                truncate = not self._heap and not self._deliveries - {current_task()}
+                records = [_released.pack(b"R", seq)]
+                await get_running_loop().run_in_executor(
+                    None, self._write, records, truncate
+                )
+
+    async def close(self) -> None:
+        """
+        Stop releasing due messages, and wait for deliveries in progress to finish.
+
+        Messages still pending are lost unless the scheduler has a ``path``.
+
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except BaseException:
+                pass
+
+            self._task = None
+
+        if self._deliveries:
+            await gather(*self._deliveries, return_exceptions=True)
+
+        if self._file is not None:
+            async with self._file_lock:
+                self._file.close()
+                self._file = None
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(mailer={self.mailer!r}, pending={len(self)})"
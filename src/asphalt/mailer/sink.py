@@ -0,0 +1,468 @@
+"""
+A local SMTP server which accepts and discards all mail, for load testing.
+
+The sink is meant as an offline stand-in for a real mail relay when measuring the
+throughput of :class:`~asphalt.mailer.mailers.smtp.SMTPMailer` configurations. It can
+simulate slow servers (per-command latency), rate limiting and connection limits, and
+it keeps statistics on the received messages.
+
+This module requires aiosmtpd, which can be installed with the ``sink`` extra
+(``pip install asphalt-mailer[sink]``). The sink can also be run from the command line::
+
+    python -m asphalt.mailer.sink --port 2525 --latency DATA=0.05 --max-connections 20
+"""
+
+from __future__ import annotations
+
+import argparse
+import ssl
+import warnings
+from array import array
+from asyncio import AbstractServer, get_running_loop, run, sleep
+from collections.abc import Awaitable, Callable, Mapping
+from math import ceil
+from time import monotonic
+from types import TracebackType
+from typing import Any
+
+from aiosmtpd.smtp import SMTP, AuthResult, Envelope, LoginPassword, Session
+
+__all__ = ["SinkStatistics", "SMTPSink"]
+
+
+class SinkStatistics:
+    """
+    Statistics on the mail received by an :class:`SMTPSink`.
+
+    The latency of a message is the time from the acceptance of its ``MAIL`` command to
+    the end of its ``DATA`` command, as seen by the server.
+
+    :ivar int messages: number of messages accepted
+    :ivar int recipients: total number of recipients of the accepted messages
+    :ivar int bytes: total size of the accepted messages
+    :ivar int connections: number of connections accepted
+    :ivar int rejected_connections: number of connections rejected due to the
+        connection limit
+    :ivar int throttled: number of ``MAIL`` commands rejected due to the rate limit
+    :ivar float started_at: the value of :func:`time.monotonic` when the statistics
+        were last reset
+    """
+
+    __slots__ = (
+        "messages",
+        "recipients",
+        "bytes",
+        "connections",
+        "rejected_connections",
+        "throttled",
+        "started_at",
+        "_latencies",
+    )
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        """Reset all the counters to zero."""
+        self.messages = self.recipients = self.bytes = 0
+        self.connections = self.rejected_connections = self.throttled = 0
+        self.started_at = monotonic()
+        self._latencies = array("d")
+
+    def add_message(self, size: int, recipients: int, latency: float) -> None:
+        self.messages += 1
+        self.recipients += recipients
+        self.bytes += size
+        self._latencies.append(latency)
+
+    @property
+    def messages_per_second(self) -> float:
+        """The average number of messages accepted per second since the last reset."""
+        elapsed = monotonic() - self.started_at
+        return self.messages / elapsed if elapsed > 0 else 0.0
+
+    def percentile(self, percent: float) -> float:
+        """
+        Return the given percentile of the message latencies (in seconds).
+
+        :param percent: the percentile (0-100) to compute, using the nearest-rank method
+        :return: the latency, or 0 if no messages have been received
+
+        """
+        if not 0 <= percent <= 100:
+            raise ValueError("percent must be between 0 and 100")
+
+        if not self._latencies:
+            return 0.0
+
+        latencies = sorted(self._latencies)
+        rank = max(ceil(percent / 100 * len(latencies)), 1)
+        return latencies[rank - 1]
+
+    def summary(self) -> str:
+        """Return a one-line, human readable summary of the statistics."""
+        return (
+            f"{self.messages} messages ({self.messages_per_second:.1f}/s, "
+            f"{self.bytes} bytes), latency p50={self.percentile(50) * 1000:.1f} ms "
+            f"p90={self.percentile(90) * 1000:.1f} ms "
+            f"p99={self.percentile(99) * 1000:.1f} ms, "
+            f"{self.connections} connections ({self.rejected_connections} rejected), "
+            f"{self.throttled} throttled"
+        )
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.__class__.__name__}(messages={self.messages}, "
+            f"connections={self.connections})"
+        )
+
+
+class _SinkSMTP(SMTP):
+    def __init__(self, sink: SMTPSink, **kwargs: Any):
+        super().__init__(sink, **kwargs)
+        self.sink = sink
+        self.transaction_started = 0.0
+        for command, latency in sink.latency.items():
+            method = self._smtp_methods.get(command)
+            if method is not None and command != "DATA":
+                self._smtp_methods[command] = self._delay(method, latency)
+
+    @staticmethod
+    def _delay(
+        method: Callable[[str | None], Awaitable[None]], latency: float
+    ) -> Callable[[str | None], Awaitable[None]]:
+        async def delayed(arg: str | None) -> None:
+            await sleep(latency)
+            await method(arg)
+
+        return delayed
+
+    async def _handle_client(self) -> None:
+        sink = self.sink
+        if (
+            sink.max_connections is not None
+            and sink.active_connections >= sink.max_connections
+        ):
+            sink.statistics.rejected_connections += 1
+            await self.push("421 4.7.0 Too many connections, try again later")
+            assert self.transport is not None
+            self.transport.close()
+            return
+
+        sink.active_connections += 1
+        sink.statistics.connections += 1
+        try:
+            await super()._handle_client()
+        finally:
+            sink.active_connections -= 1
+
+
+class SMTPSink:
+    """
+    An SMTP server which accepts all mail and discards it after updating its
+    statistics.
+
+    The server is started and stopped by using the sink as an asynchronous context
+    manager::
+
+        async with SMTPSink(latency={"DATA": 0.05}) as sink:
+            mailer = SMTPMailer(host="localhost", port=sink.port, tls=False)
+            ...
+            print(sink.statistics.summary())
+
+    The latency of ``DATA`` is applied after the message content has been received,
+    and the latency of other commands before the command is processed.
+
+    :param host: the host name or IP address to listen on
+    :param port: the port to listen on (0 to pick a free port)
+    :param tls_context: an SSL context for either ``STARTTLS`` or implicit TLS (when
+        omitted, TLS is not supported)
+    :param implicit_tls: ``True`` to require TLS from the start of the connection
+        instead of offering ``STARTTLS``
+    :param credentials: a mapping of user names to passwords; if given, clients are
+        required to authenticate
+    :param latency: a mapping of SMTP commands (like ``MAIL`` or ``DATA``) to the
+        number of seconds to wait before responding to them
+    :param max_rate: maximum number of messages to accept per second; ``MAIL`` commands
+        exceeding the rate are rejected with ``throttle_response``
+    :param throttle_response: the response to send to rejected ``MAIL`` commands
+    :param max_connections: maximum number of concurrent connections; excess
+        connections receive a ``421`` response and are closed
+    :param data_size_limit: the maximum message size advertised via the ``SIZE``
+        extension
+
+    :ivar int port: the port the server is listening on
+    :ivar SinkStatistics statistics: statistics on the received mail
+    :ivar int active_connections: the current number of open connections
+    """
+
+    __slots__ = (
+        "host",
+        "port",
+        "tls_context",
+        "implicit_tls",
+        "credentials",
+        "latency",
+        "max_rate",
+        "throttle_response",
+        "max_connections",
+        "data_size_limit",
+        "statistics",
+        "active_connections",
+        "_tokens",
+        "_tokens_updated",
+        "_server",
+    )
+
+    def __init__(
+        self,
+        *,
+        host: str = "localhost",
+        port: int = 0,
+        tls_context: ssl.SSLContext | None = None,
+        implicit_tls: bool = False,
+        credentials: Mapping[str, str] | None = None,
+        latency: Mapping[str, float] | None = None,
+        max_rate: float | None = None,
+        throttle_response: str = "451 4.7.1 Rate limit exceeded, try again later",
+        max_connections: int | None = None,
+        data_size_limit: int = 33554432,
+    ):
+        if implicit_tls and tls_context is None:
+            raise ValueError("implicit_tls requires a TLS context")
+
+        self.host = host
+        self.port = port
+        self.tls_context = tls_context
+        self.implicit_tls = implicit_tls
+        self.credentials = dict(credentials) if credentials else None
+        self.latency = {
+            command.upper(): seconds for command, seconds in (latency or {}).items()
+        }
+        self.max_rate = max_rate
+        self.throttle_response = throttle_response
+        self.max_connections = max_connections
+        self.data_size_limit = data_size_limit
+        self.statistics = SinkStatistics()
+        self.active_connections = 0
+        self._tokens = 0.0
+        self._tokens_updated = 0.0
+        self._server: AbstractServer | None = None
+
+    async def __aenter__(self) -> SMTPSink:
+        self._tokens = max(self.max_rate or 0, 1)
+        self._tokens_updated = monotonic()
+        self.statistics.reset()
+        if self.implicit_tls:
+            server_kwargs: dict[str, Any] = {}
+            ssl_context = self.tls_context
+        else:
+            server_kwargs = {"tls_context": self.tls_context}
+            ssl_context = None
+
+        if self.credentials is not None:
+            # aiosmtpd does not know about implicit TLS, so it must be told not to
+            # require STARTTLS before AUTH
+            server_kwargs.update(
+                auth_required=True,
+                auth_require_tls=ssl_context is None and self.tls_context is not None,
+                authenticator=self._authenticate,
+            )
+
+        def create_protocol() -> _SinkSMTP:
+            with warnings.catch_warnings():
+                # Silence the warning about not requiring TLS for AUTH
+                warnings.simplefilter("ignore")
+                return _SinkSMTP(
+                    self,
+                    hostname=self.host,
+                    data_size_limit=self.data_size_limit,
+                    enable_SMTPUTF8=True,
+                    **server_kwargs,
+                )
+
+        self._server = await get_running_loop().create_server(
+            create_protocol,
+            self.host,
+            self.port,
+            ssl=ssl_context,
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_val: BaseException | None,
+        exc_tb: TracebackType | None,
+    ) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def serve_forever(self) -> None:
+        """Serve clients until cancelled."""
+        assert self._server is not None, "the sink has not been started"
+        await self._server.serve_forever()
+
+    def _authenticate(
+        self,
+        server: SMTP,
+        session: Session,
+        envelope: Envelope,
+        mechanism: str,
+        auth_data: Any,
+    ) -> AuthResult:
+        assert self.credentials is not None
+        if isinstance(auth_data, LoginPassword):
+            username = auth_data.login.decode("utf-8", errors="replace")
+            password = auth_data.password.decode("utf-8", errors="replace")
+            if self.credentials.get(username) == password:
+                return AuthResult(success=True)
+
+        return AuthResult(success=False, handled=False)
+
+    def _take_token(self) -> bool:
+        if self.max_rate is None:
+            return True
+
+        now = monotonic()
+        self._tokens = min(
+            self._tokens + (now - self._tokens_updated) * self.max_rate,
+            max(self.max_rate, 1),
+        )
+        self._tokens_updated = now
+        if self._tokens < 1:
+            return False
+
+        self._tokens -= 1
+        return True
+
+    async def handle_MAIL(
+        self,
+        server: _SinkSMTP,
+        session: Session,
+        envelope: Envelope,
+        address: str,
+        mail_options: list[str],
+    ) -> str:
+        if not self._take_token():
+            self.statistics.throttled += 1
+            return self.throttle_response
+
+        server.transaction_started = monotonic()
+        envelope.mail_from = address
+        envelope.mail_options.extend(mail_options)
+        return "250 OK"
+
+    async def handle_DATA(
+        self, server: _SinkSMTP, session: Session, envelope: Envelope
+    ) -> str:
+        latency = self.latency.get("DATA")
+        if latency:
+            await sleep(latency)
+
+        self.statistics.add_message(
+            len(envelope.original_content or b""),
+            len(envelope.rcpt_tos),
+            monotonic() - server.transaction_started,
+        )
+        return "250 OK"
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(host={self.host!r}, port={self.port})"
+
+
+def _parse_latency(value: str) -> tuple[str, float]:
+    command, sep, seconds = value.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError(f"expected COMMAND=SECONDS, got {value!r}")
+
+    return command.upper(), float(seconds)
+
+
+def _parse_credentials(value: str) -> tuple[str, str]:
+    username, sep, password = value.partition(":")
+    if not sep:
+        raise argparse.ArgumentTypeError(f"expected USER:PASSWORD, got {value!r}")
+
+    return username, password
+
+
+async def _serve(args: argparse.Namespace) -> None:
+    tls_context: ssl.SSLContext | None = None
+    if args.certfile:
+        tls_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        tls_context.load_cert_chain(args.certfile, args.keyfile)
+
+    sink = SMTPSink(
+        host=args.host,
+        port=args.port,
+        tls_context=tls_context,
+        implicit_tls=args.implicit_tls,
+        credentials=dict(args.user) if args.user else None,
+        latency=dict(args.latency),
+        max_rate=args.max_rate,
+        max_connections=args.max_connections,
+    )
+    async with sink:
+        print(f"Listening on {sink.host}:{sink.port}", flush=True)
+        while True:
+            await sleep(args.interval)
+            print(sink.statistics.summary(), flush=True)
+            sink.statistics.reset()
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Run an SMTP server which accepts and discards all mail"
+    )
+    parser.add_argument("--host", default="localhost", help="address to listen on")
+    parser.add_argument("--port", type=int, default=2525, help="port to listen on")
+    parser.add_argument("--certfile", help="certificate (chain) file for TLS")
+    parser.add_argument("--keyfile", help="private key file for TLS")
+    parser.add_argument(
+        "--implicit-tls", action="store_true", help="use implicit TLS, not STARTTLS"
+    )
+    parser.add_argument(
+        "--user",
+        action="append",
+        type=_parse_credentials,
+        metavar="USER:PASSWORD",
+        help="require authentication, accepting these credentials",
+    )
+    parser.add_argument(
+        "--latency",
+        action="append",
+        type=_parse_latency,
+        default=[],
+        metavar="COMMAND=SECONDS",
+        help="delay the responses to the given command",
+    )
+    parser.add_argument(
+        "--max-rate", type=float, help="maximum number of messages per second"
+    )
+    parser.add_argument(
+        "--max-connections", type=int, help="maximum number of concurrent connections"
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=5,
+        help="interval (in seconds) between statistics reports",
+    )
+    args = parser.parse_args(argv)
+    if args.keyfile and not args.certfile:
+        parser.error("--keyfile requires --certfile")
+    elif args.implicit_tls and not args.certfile:
+        parser.error("--implicit-tls requires --certfile")
+
+    try:
+        run(_serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
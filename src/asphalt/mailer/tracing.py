@@ -0,0 +1,378 @@
+"""
+Lightweight tracing of mailer operations.
+
+A :class:`Tracer` set as the :attr:`~asphalt.mailer.api.Mailer.tracer` of a mailer (or
+configured with the ``tracing`` component option) times the operations of the mailer
+as *spans*: building messages, encoding attachments, signing and serializing messages,
+setting up connections and sending each message. Spans opened while another span is
+open become its children, so wrapping your own code in
+:meth:`~asphalt.mailer.api.Mailer.trace` groups the mailer operations it performs.
+
+Only a ``sample_rate`` fraction of the top level spans (along with their children) are
+recorded. The recorded spans are aggregated in :meth:`Tracer.summary`, and passed to the
+``handler`` callback, if one was given, for exporting them elsewhere. When a mailer has
+no tracer, tracing costs no more than an attribute lookup per operation.
+
+The tracer can also watch the event loop for stalls (with ``lag_threshold``). When the
+loop has been blocked for longer than that, a warning is logged listing the mailer
+operations that ran during the stall, and an ``event_loop_lag`` span is recorded.
+"""
+
+from __future__ import annotations
+
+import logging
+import random
+import time
+from asyncio import Task, create_task, sleep
+from collections import deque
+from collections.abc import Callable
+from contextvars import ContextVar, Token
+from itertools import count
+from types import TracebackType
+from typing import Any, NamedTuple
+
+__all__ = ["Span", "SpanRecord", "SpanStats", "Tracer", "child_span"]
+
+logger = logging.getLogger(__name__)
+
+_current_span: ContextVar[Span | None] = ContextVar("asphalt_mailer_span", default=None)
+
+
+class SpanRecord(NamedTuple):
+    """
+    A finished span, as passed to the ``handler`` of a :class:`Tracer`.
+
+    :ivar name: name of the operation
+    :ivar trace_id: identifies the top level span this span belongs to
+    :ivar parent: name of the parent span, or ``None`` for a top level span
+    :ivar timestamp: when the span started (as a UNIX timestamp)
+    :ivar duration: how long the span took (in seconds)
+    :ivar cpu_time: CPU time used by the thread while the span was open (in seconds;
+        for spans that wait for I/O, this includes the time used by other tasks)
+    :ivar error: the exception the operation failed with, if any
+    :ivar attributes: extra information given when the span was opened
+    """
+
+    name: str
+    trace_id: int
+    parent: str | None
+    timestamp: float
+    duration: float
+    cpu_time: float
+    error: BaseException | None
+    attributes: dict[str, Any]
+
+
+class SpanStats(NamedTuple):
+    """
+    Aggregated timings of the recorded spans of one operation.
+
+    :ivar calls: number of recorded spans
+    :ivar total_time: sum of the durations of the spans (in seconds)
+    :ivar cpu_time: sum of the CPU time used while the spans were open (in seconds)
+    :ivar max_time: duration of the longest span (in seconds)
+    """
+
+    calls: int
+    total_time: float
+    cpu_time: float
+    max_time: float
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self) -> _NullSpan:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_val: BaseException | None,
+        exc_tb: TracebackType | None,
+    ) -> None:
+        pass
+
+
+_null_span = _NullSpan()
+
+
+class Span:
+    """
+    An operation being timed.
+
+    Spans are created with :meth:`Tracer.span` (or
+    :meth:`~asphalt.mailer.api.Mailer.trace`) and used as context managers. A span that
+    wasn't sampled is still entered and exited like the others (so its children aren't
+    sampled either), but isn't recorded.
+
+    :ivar name: name of the operation
+    :ivar attributes: extra information about the operation
+    :ivar sampled: ``True`` if the span will be recorded
+    """
+
+    __slots__ = (
+        "tracer",
+        "name",
+        "attributes",
+        "sampled",
+        "trace_id",
+        "parent",
+        "_token",
+        "_timestamp",
+        "_started",
+        "_cpu_started",
+    )
+
+    def __init__(
+        self,
+        tracer: Tracer,
+        name: str,
+        attributes: dict[str, Any],
+        parent: Span | None,
+        sampled: bool,
+        trace_id: int,
+    ):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.parent = parent
+        self.sampled = sampled
+        self.trace_id = trace_id
+
+    def __enter__(self) -> Span:
+        self._token: Token[Span | None] = _current_span.set(self)
+        if self.sampled:
+            self._timestamp = time.time()
+            self._cpu_started = time.thread_time()
+
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_val: BaseException | None,
+        exc_tb: TracebackType | None,
+    ) -> None:
+        ended = time.perf_counter()
+        _current_span.reset(self._token)
+        self.tracer._finish(self, ended, exc_val)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(name={self.name!r}, sampled={self.sampled})"
+
+
+def child_span(name: str, **attributes: Any) -> Span | _NullSpan:
+    """
+    Open a span as a child of the current span.
+
+    Unlike :meth:`Tracer.span`, this doesn't need a tracer, but does nothing unless a
+    span is already open. It's meant for code that has no access to a mailer, like
+    :meth:`~asphalt.mailer.api.Mailer.add_attachment`.
+
+    :param name: name of the operation
+    :param attributes: extra information about the operation
+    :return: a context manager
+
+    """
+    parent = _current_span.get()
+    if parent is None:
+        return _null_span
+
+    return parent.tracer.span(name, **attributes)
+
+
+class Tracer:
+    """
+    Times mailer operations as spans, sampling a fraction of them.
+
+    :param sample_rate: the fraction (0-1) of top level spans to record
+    :param handler: a callable that is called with a :class:`SpanRecord` for every
+        recorded span
+    :param lag_threshold: if set, log a warning whenever the event loop is blocked for
+        longer than this (in seconds)
+    :param lag_interval: how often (in seconds) to check the event loop for stalls
+    :param seed: seed for the random number generator used for sampling
+    """
+
+    __slots__ = (
+        "sample_rate",
+        "handler",
+        "lag_threshold",
+        "lag_interval",
+        "_random",
+        "_trace_ids",
+        "_stats",
+        "_recent",
+        "_probe_task",
+    )
+
+    def __init__(
+        self,
+        sample_rate: float = 1,
+        *,
+        handler: Callable[[SpanRecord], Any] | None = None,
+        lag_threshold: float | None = None,
+        lag_interval: float = 0.05,
+        seed: int | None = None,
+    ):
+        if not 0 <= sample_rate <= 1:
+            raise ValueError("sample_rate must be between 0 and 1")
+        if lag_threshold is not None and lag_threshold <= 0:
+            raise ValueError("lag_threshold must be positive")
+        if lag_interval <= 0:
+            raise ValueError("lag_interval must be positive")
+
+        self.sample_rate = sample_rate
+        self.handler = handler
+        self.lag_threshold = lag_threshold
+        self.lag_interval = lag_interval
+        self._random = random.Random(seed).random
+        self._trace_ids = count(1)
+        # operation name -> [count, total time, CPU time, max time]
+        self._stats: dict[str, list[Any]] = {}
+        # (started, ended, name) of recently finished spans, for attributing stalls
+        self._recent: deque[tuple[float, float, str]] = deque(maxlen=1000)
+        self._probe_task: Task[None] | None = None
+
+    def span(self, name: str, **attributes: Any) -> Span:
+        """
+        Open a span, as a child of the current span if there is one.
+
+        Top level spans are sampled at :attr:`sample_rate`, and child spans are sampled
+        if their parent was.
+
+        :param name: name of the operation
+        :param attributes: extra information about the operation
+        :return: a span, to be used as a context manager
+
+        """
+        parent = _current_span.get()
+        if parent is None:
+            sampled = self.sample_rate >= 1 or self._random() < self.sample_rate
+            return Span(self, name, attributes, None, sampled, next(self._trace_ids))
+
+        return Span(self, name, attributes, parent, parent.sampled, parent.trace_id)
+
+    def _finish(self, span: Span, ended: float, error: BaseException | None) -> None:
+        if self.lag_threshold is not None:
+            self._recent.append((span._started, ended, span.name))
+
+        if span.sampled:
+            cpu_time = time.thread_time() - span._cpu_started
+            self._record(
+                SpanRecord(
+                    span.name,
+                    span.trace_id,
+                    span.parent.name if span.parent is not None else None,
+                    span._timestamp,
+                    ended - span._started,
+                    cpu_time,
+                    error,
+                    span.attributes,
+                )
+            )
+
+    def _record(self, record: SpanRecord) -> None:
+        stats = self._stats.get(record.name)
+        if stats is None:
+            self._stats[record.name] = [
+                1,
+                record.duration,
+                record.cpu_time,
+                record.duration,
+            ]
+        else:
+            stats[0] += 1
+            stats[1] += record.duration
+            stats[2] += record.cpu_time
+            stats[3] = max(stats[3], record.duration)
+
+        if self.handler is not None:
+            try:
+                self.handler(record)
+            except Exception:
+                logger.exception("Error in span handler")
+
+    def summary(self) -> dict[str, SpanStats]:
+        """
+        Return the aggregated timings of the recorded spans of each operation.
+
+        :return: a dictionary of operation names to their statistics
+
+        """
+        return {name: SpanStats(*stats) for name, stats in self._stats.items()}
+
+    def reset(self) -> None:
+        """Discard the aggregated timings."""
+        self._stats.clear()
+
+    async def start(self) -> None:
+        """Start watching the event loop for stalls, if ``lag_threshold`` was set."""
+        if self.lag_threshold is not None and self._probe_task is None:
+            self._probe_task = create_task(self._probe())
+
+    async def _probe(self) -> None:
+        assert self.lag_threshold is not None
+        while True:
+            slept = time.perf_counter()
+            await sleep(self.lag_interval)
+            now = time.perf_counter()
+            lag = now - slept - self.lag_interval
+            if lag >= self.lag_threshold:
+                self._report_lag(slept, now, lag)
+
+    def _report_lag(self, window_start: float, now: float, lag: float) -> None:
+        # Blame the operations that started and finished while the loop was stalled
+        operations: dict[str, list[float]] = {}
+        for started, ended, name in self._recent:
+            if started >= window_start and ended <= now:
+                entry = operations.setdefault(name, [0, 0.0])
+                entry[0] += 1
+                entry[1] += ended - started
+
+        culprits = sorted(operations.items(), key=lambda item: -item[1][1])
+        if culprits:
+            logger.warning(
+                "Event loop was blocked for %.0f ms; mailer operations during that "
+                "time: %s",
+                lag * 1000,
+                ", ".join(
+                    f"{name} ({duration * 1000:.1f} ms in {calls} call(s))"
+                    for name, (calls, duration) in culprits
+                ),
+            )
+        else:
+            logger.warning(
+                "Event loop was blocked for %.0f ms; no mailer operations ran during "
+                "that time",
+                lag * 1000,
+            )
+
+        self._record(
+            SpanRecord(
+                "event_loop_lag",
+                next(self._trace_ids),
+                None,
+                time.time() - lag,
+                lag,
+                0.0,
+                None,
+                {name: duration for name, (calls, duration) in culprits},
+            )
+        )
+
+    async def close(self) -> None:
+        """Stop watching the event loop."""
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            try:
+                await self._probe_task
+            except BaseException:
+                pass
+
+            self._probe_task = None
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(sample_rate={self.sample_rate})"
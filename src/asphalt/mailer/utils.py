@@ -1,9 +1,21 @@
 from __future__ import annotations
 
+from collections.abc import AsyncIterable, AsyncIterator, Iterable
 from email.headerregistry import UniqueAddressHeader
-from email.message import EmailMessage
+from email.message import EmailMessage, Message
+from email.policy import Policy
+from mimetypes import guess_type
 from typing import cast
 
+#: maximum length of a line (in bytes, excluding the line separator) allowed by
+#: :rfc:`5322` in a message that is not transferred as binary
+MAX_LINE_LENGTH = 998
+
+_ascii_bytes = bytes(range(128))
+
+# Set on messages whose serialized size is known exactly (like ones read from a file)
+_size_attribute = "_asphalt_mailer_size"
+
 
 def get_recipients(message: EmailMessage) -> list[str]:
     """
@@ -23,3 +35,124 @@ def get_recipients(message: EmailMessage) -> list[str]:
                 recipients.append(addr.addr_spec)
 
     return recipients
+
+
+def estimate_size(message: EmailMessage) -> int:
+    """
+    Return an estimate of the size (in bytes) of the given message once serialized.
+
+    The estimate is computed from the lengths of the headers and the (already encoded)
+    payloads of the message parts, without serializing the message, so it reflects any
+    changes made to the message up to this point.
+
+    This function is meant to be used by :class:`~asphalt.mailer.api.Mailer`
+    implementations.
+
+    :param message: the message
+
+    """
+    size = getattr(message, _size_attribute, None)
+    return size if size is not None else _estimate_size(message)
+
+
+def _estimate_size(part: Message) -> int:
+    size = sum(len(name) + len(value) + 4 for name, value in part.raw_items()) + 2
+    payload = part.get_payload()
+    if isinstance(payload, list):
+        # Add some room for the MIME boundary lines
+        subparts = cast("list[Message]", payload)
+        size += sum(_estimate_size(subpart) + 80 for subpart in subparts)
+    elif payload:
+        text = cast(str, payload)
+        if text.isascii():
+            size += len(text)
+        else:
+            # 8-bit payloads are held as text, so count the bytes they're encoded to
+            charset = part.get_content_charset() or "utf-8"
+            try:
+                size += len(text.encode(charset, "surrogateescape"))
+            except (LookupError, UnicodeError):
+                size += len(text.encode("utf-8", "surrogateescape"))
+
+    return size
+
+
+def _create_attachment(
+    content: bytes, filename: str, mimetype: str | None, policy: Policy
+) -> EmailMessage:
+    if not mimetype:
+        mimetype, _encoding = guess_type(filename, False)
+        if not mimetype:
+            mimetype = "application/octet-stream"
+
+    maintype, subtype = mimetype.split("/", 1)
+    if not maintype or not subtype:
+        raise ValueError('mimetype must be a string in the "maintype/subtype" format')
+
+    part = EmailMessage(policy=policy)
+    part.set_content(content, maintype=maintype, subtype=subtype, filename=filename)
+    return part
+
+
+def _attach(message: EmailMessage, part: EmailMessage) -> None:
+    if message.get_content_type() != "multipart/mixed":
+        message.make_mixed()
+
+    message.attach(part)
+
+
+def get_transfer_encoding(text: str, charset: str, allow_8bit: bool = True) -> str:
+    """
+    Return the most compact content transfer encoding for the given text body.
+
+    Text that fits in 7 bits is sent as-is. Other text is sent unencoded as ``8bit`` if
+    ``allow_8bit`` is ``True``. Otherwise, the choice between ``quoted-printable`` and
+    ``base64`` is made based on the share of bytes that would need escaping.
+
+    :param text: the text body
+    :param charset: the character encoding the body will be encoded with
+    :param allow_8bit: ``True`` if the transport accepts 8-bit message bodies
+    :return: one of ``7bit``, ``8bit``, ``quoted-printable`` or ``base64``
+
+    """
+    if "\n".encode(charset) != b"\n":
+        # Character sets like UTF-16 cannot be sent unencoded
+        return "base64"
+
+    data = text.encode(charset)
+    longest_line = max((len(line) for line in data.splitlines()), default=0)
+    if data.isascii():
+        return "7bit" if longest_line <= MAX_LINE_LENGTH else "quoted-printable"
+    elif allow_8bit and longest_line <= MAX_LINE_LENGTH and b"\0" not in data:
+        return "8bit"
+
+    # Quoted-printable triples the size of every non-ASCII byte, while base64 adds a
+    # flat one third to the size of the whole body
+    escaped_bytes = len(data.translate(None, _ascii_bytes))
+    return "quoted-printable" if escaped_bytes * 6 < len(data) else "base64"
+
+
+async def iterate_messages(
+    messages: EmailMessage | Iterable[EmailMessage] | AsyncIterable[EmailMessage],
+) -> AsyncIterator[EmailMessage]:
+    """
+    Iterate over a single message, or an iterable or asynchronous iterable of messages.
+
+    The messages are consumed lazily, one at a time, so asynchronous sources like
+    database cursors can be streamed through a mailer without materializing them.
+
+    This function is meant to be used by :class:`~asphalt.mailer.api.Mailer`
+    implementations.
+
+    :param messages: the message(s) passed to
+        :meth:`~asphalt.mailer.api.Mailer.deliver`
+
+    """
+    if isinstance(messages, EmailMessage):
+        yield messages
+    elif isinstance(messages, AsyncIterable):
+        async for message in messages:
+            yield message
+    else:
+        for message in messages:
+            yield message
@@ -1,6 +1,66 @@
+from __future__ import annotations
+
+import time
+from email.message import EmailMessage
+from typing import Any
+
 import pytest
 
 
+class FakeClock:
+    """Replaces the given function of the :mod:`time` module with a settable clock."""
+
+    def __init__(self, monkeypatch: pytest.MonkeyPatch, function: str = "monotonic"):
+        self.now = 1000000.0
+        monkeypatch.setattr(time, function, lambda: self.now)
+
+
+def create_message(
+    *to: str,
+    subject: str = "Test",
+    sender: str = "foo@bar.baz",
+    bcc: str | None = None,
+    body: str = "Hello",
+    message_id: str | None = None,
+) -> EmailMessage:
+    message = EmailMessage()
+    message["Subject"] = subject
+    message["From"] = sender
+    message["To"] = ", ".join(to or ["test@domain.country"])
+    if bcc:
+        message["Bcc"] = bcc
+    if message_id:
+        message["Message-ID"] = message_id
+
+    message.set_content(body)
+    return message
+
+
+def create_messages(count: int, *to: str, **kwargs: Any) -> list[EmailMessage]:
+    return [
+        create_message(
+            *to,
+            **{
+                "subject": f"message {i}",
+                "body": f"message {i}",
+                "message_id": f"<{i}@bar.baz>",
+                **kwargs,
+            },
+        )
+        for i in range(count)
+    ]
+
+
 @pytest.fixture
 def anyio_backend() -> str:
     return "asyncio"
+
+
+@pytest.fixture
+def clock(request: pytest.FixtureRequest, monkeypatch: pytest.MonkeyPatch) -> FakeClock:
+    """
+    Patch :func:`time.monotonic`, or the function of the :mod:`time` module named by
+    the (indirect) parameter of this fixture, to return ``clock.now``.
+
+    """
+    return FakeClock(monkeypatch, getattr(request, "param", "monotonic"))
@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import mailbox
+from asyncio import wait_for
+from copy import deepcopy
+from email.message import EmailMessage
+from pathlib import Path
+from typing import cast
+
+import pytest
+from asphalt.mailer.api import DeliveryError
+from asphalt.mailer.dkim import DKIMSigner
+from asphalt.mailer.idempotency import IdempotencyCache, set_idempotency_key
+from asphalt.mailer.mailers.file import FileMailer
+from conftest import create_messages
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(
+    params=[pytest.param(True, id="fsync"), pytest.param(False, id="nofsync")]
+)
+def fsync(request: pytest.FixtureRequest) -> bool:
+    return bool(request.param)
+
+
+async def test_deliver_maildir(tmp_path: Path, fsync: bool) -> None:
+    mailer = FileMailer(path=tmp_path / "maildir", batch_size=2, fsync=fsync)
+    await mailer.start()
+    await mailer.deliver(
+        create_messages(5, bcc="testbcc@domain.country", body="From the sender")
+    )
+
+    maildir = mailbox.Maildir(tmp_path / "maildir", create=False)
+    messages = sorted(maildir, key=lambda msg: msg["Subject"])
+    assert [msg["Subject"] for msg in messages] == [f"message {i}" for i in range(5)]
+    assert all(msg["Bcc"] is None for msg in messages)
+    assert messages[0].get_payload() == "From the sender\n"
+    assert not list(tmp_path.joinpath("maildir", "tmp").iterdir())
+
+
+async def test_deliver_mbox(tmp_path: Path, fsync: bool) -> None:
+    mailer = FileMailer(
+        path=tmp_path / "mail" / "mbox", format="mbox", batch_size=2, fsync=fsync
+    )
+    await mailer.start()
+    kwargs = {"bcc": "testbcc@domain.country", "body": "From the sender"}
+    await mailer.deliver(create_messages(3, **kwargs))
+    await mailer.deliver(create_messages(1, **kwargs))
+
+    messages = list(mailbox.mbox(tmp_path / "mail" / "mbox", create=False))
+    assert [msg["Subject"] for msg in messages] == [
+        "message 0",
+        "message 1",
+        "message 2",
+        "message 0",
+    ]
+    assert all(msg["Bcc"] is None for msg in messages)
+    assert messages[0].get_from().startswith("foo@bar.baz ")
+    assert messages[0].get_payload() == ">From the sender\n"
+
+
+async def test_deliver_error(tmp_path: Path, sample_message: EmailMessage) -> None:
+    mailer = FileMailer(path=tmp_path / "maildir")
+    with pytest.raises(DeliveryError) as exc:
+        await mailer.deliver(sample_message)
+
+    exc.match("No such file or directory")
+
+
+async def test_deliver_maildir_sign_error(tmp_path: Path) -> None:
+    """Test that no files are left behind if signing a message in a batch fails."""
+
+    class FailingSigner:
+        def __init__(self) -> None:
+            self.calls = 0
+
+        def sign(self, data: bytes) -> bytes:
+            self.calls += 1
+            if self.calls == 2:
+                raise ValueError("signing failed")
+
+            return data
+
+    mailer = FileMailer(path=tmp_path / "maildir", batch_size=2)
+    await mailer.start()
+    mailer.dkim_signer = cast(DKIMSigner, FailingSigner())
+    with pytest.raises(DeliveryError, match="signing failed"):
+        await mailer.deliver(create_messages(2))
+
+    assert not list((tmp_path / "maildir" / "tmp").iterdir())
+    assert not list((tmp_path / "maildir" / "new").iterdir())
+
+
+async def test_deliver_idempotency_key(tmp_path: Path) -> None:
+    mailer = FileMailer(path=tmp_path / "maildir", batch_size=2)
+    mailer.idempotency_cache = IdempotencyCache()
+    messages = create_messages(3)
+    for i, message in enumerate(messages):
+        set_idempotency_key(message, f"key{i}")
+
+    with pytest.raises(DeliveryError):
+        await mailer.deliver(messages)
+
+    await mailer.start()
+    await mailer.deliver(messages + create_messages(1))
+    await mailer.deliver(messages)
+    assert len(mailbox.Maildir(tmp_path / "maildir", create=False)) == 4
+
+
+async def test_deliver_idempotency_key_same_batch(tmp_path: Path) -> None:
+    """Test that a duplicate within the same batch is skipped instead of waited for."""
+    mailer = FileMailer(path=tmp_path / "maildir", batch_size=2)
+    mailer.idempotency_cache = IdempotencyCache()
+    message = create_messages(1)[0]
+    set_idempotency_key(message, "key")
+    await mailer.start()
+    await wait_for(mailer.deliver([message, deepcopy(message)]), 5)
+    assert len(mailbox.Maildir(tmp_path / "maildir", create=False)) == 1
+
+
+def test_bad_format(tmp_path: Path) -> None:
+    with pytest.raises(ValueError, match='format must be either "maildir" or "mbox"'):
+        FileMailer(path=tmp_path, format="foo")
+
+
+def test_repr() -> None:
+    mailer = FileMailer(path="/var/mail/archive", format="mbox")
+    assert repr(mailer) == "FileMailer('/var/mail/archive', format='mbox')"
@@ -0,0 +1,274 @@
+from __future__ import annotations
+
+import socket
+import threading
+from asyncio import CancelledError, create_task, get_running_loop, sleep
+from collections.abc import AsyncGenerator
+from email.message import EmailMessage
+from pathlib import Path
+from typing import Any, cast
+
+import pytest
+from aiosmtpd.lmtp import LMTP
+from aiosmtpd.smtp import SMTP, Envelope, Session
+from asphalt.core.context import Context
+from asphalt.mailer.api import DeliveryError
+from asphalt.mailer.journal import DeliveryJournal, read_journal
+from asphalt.mailer.mailers.lmtp import LMTPMailer
+from conftest import create_message
+
+pytestmark = pytest.mark.anyio
+
+
+class LMTPHandler:
+    def __init__(self, pipelining: bool = False) -> None:
+        self.pipelining = pipelining
+        self.connections: list[SMTP] = []
+        self.envelopes: list[Envelope] = []
+
+    async def handle_EHLO(
+        self,
+        server: SMTP,
+        session: Session,
+        envelope: Envelope,
+        hostname: str,
+        responses: list[str],
+    ) -> list[str]:
+        self.connections.append(server)
+        session.host_name = hostname
+        if self.pipelining:
+            return responses[:-1] + ["250-PIPELINING", responses[-1]]
+
+        return responses
+
+    async def handle_RCPT(
+        self,
+        server: SMTP,
+        session: Session,
+        envelope: Envelope,
+        address: str,
+        rcpt_options: list[str],
+    ) -> str:
+        if address.startswith("unknown"):
+            return "550 5.1.1 No such user"
+
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+
+    async def handle_DATA(
+        self, server: SMTP, session: Session, envelope: Envelope
+    ) -> str:
+        # LMTP servers reply once for every accepted recipient
+        if any(rcpt.startswith("slow") for rcpt in envelope.rcpt_tos):
+            await sleep(0.3)
+
+        self.envelopes.append(envelope)
+        return "\r\n".join(
+            "452 4.2.2 Mailbox full" if rcpt.startswith("full") else "250 2.0.0 OK"
+            for rcpt in envelope.rcpt_tos
+        )
+
+
+class LMTPServer(LMTP):
+    async def smtp_LHLO(self, arg: str) -> None:
+        self._handle_hooks["EHLO"] = self.event_handler.handle_EHLO
+        self._ehlo_hook_ver = "new"
+        await super().smtp_LHLO(arg)
+
+
+@pytest.fixture(params=[False, True], ids=["nopipelining", "pipelining"])
+def handler(request: pytest.FixtureRequest) -> LMTPHandler:
+    return LMTPHandler(pipelining=request.param)
+
+
+@pytest.fixture
+async def mailer(
+    free_tcp_port: int, handler: LMTPHandler
+) -> AsyncGenerator[LMTPMailer, None]:
+    server = await get_running_loop().create_server(
+        lambda: LMTPServer(handler), "localhost", free_tcp_port
+    )
+    mailer = LMTPMailer(port=free_tcp_port, local_hostname="client", timeout=1)
+    async with Context():
+        await mailer.start()
+        yield mailer
+
+    server.close()
+    await server.wait_closed()
+
+
+async def test_deliver(mailer: LMTPMailer, handler: LMTPHandler) -> None:
+    message1 = create_message("test@domain.country", body=".Hello\n.\n")
+    message2 = create_message("test2@domain.country", body="Hi")
+    message2["Bcc"] = "hidden@domain.country"
+    await mailer.deliver(message1)
+    await mailer.deliver(message2)
+
+    # The connection is kept open between deliveries
+    assert len(handler.connections) == 1
+    assert len(handler.envelopes) == 2
+    assert handler.envelopes[0].rcpt_tos == ["test@domain.country"]
+    content = cast(bytes, handler.envelopes[0].original_content)
+    assert content.endswith(b"\r\n\r\n.Hello\r\n.\r\n")
+    assert handler.envelopes[1].rcpt_tos == [
+        "test2@domain.country",
+        "hidden@domain.country",
+    ]
+    assert b"Bcc" not in cast(bytes, handler.envelopes[1].original_content)
+
+
+async def test_deliver_message_statuses(mailer: LMTPMailer) -> None:
+    message = create_message(
+        "test@domain.country", "unknown@domain.country", "full@domain.country"
+    )
+    statuses = await mailer.deliver_message(message)
+    assert statuses == {
+        "test@domain.country": (250, "2.0.0 OK"),
+        "unknown@domain.country": (550, "5.1.1 No such user"),
+        "full@domain.country": (452, "4.2.2 Mailbox full"),
+    }
+
+
+async def test_deliver_partial_failure(
+    mailer: LMTPMailer, handler: LMTPHandler
+) -> None:
+    message = create_message("test@domain.country", "full@domain.country")
+    with pytest.raises(DeliveryError) as exc:
+        await mailer.deliver(message)
+
+    assert str(exc.value) == (
+        "error sending mail message: delivery failed for full@domain.country "
+        "(452 4.2.2 Mailbox full)"
+    )
+    assert exc.value.args[1] is message
+    assert len(handler.envelopes) == 1
+
+
+async def test_deliver_journal(
+    mailer: LMTPMailer, handler: LMTPHandler, tmp_path: Path
+) -> None:
+    mailer.journal = DeliveryJournal(tmp_path / "mail.journal")
+    await mailer.deliver(create_message("test@domain.country"))
+    message = create_message("test@domain.country", "full@domain.country")
+    with pytest.raises(DeliveryError):
+        await mailer.deliver(message)
+
+    await mailer.journal.close()
+    entries = list(read_journal(tmp_path / "mail.journal"))
+    assert [(entry.recipients, entry.status, entry.error) for entry in entries] == [
+        (["test@domain.country"], 250, None),
+        (
+            ["test@domain.country", "full@domain.country"],
+            452,
+            "delivery failed for full@domain.country (452 4.2.2 Mailbox full)",
+        ),
+    ]
+
+
+async def test_deliver_all_refused(mailer: LMTPMailer, handler: LMTPHandler) -> None:
+    message = create_message("unknown@domain.country")
+    results = [result async for result in mailer.deliver_iter([message, message])]
+    expected_error = (
+        "error sending mail message: delivery failed for unknown@domain.country "
+        "(550 5.1.1 No such user)"
+    )
+    assert [str(result.error) for result in results] == [expected_error] * 2
+    assert not handler.envelopes
+
+
+async def test_deliver_duplicate_recipients(
+    mailer: LMTPMailer, handler: LMTPHandler
+) -> None:
+    """
+    Test that a recipient listed more than once gets only one RCPT, so no replies are
+    left over to be mistaken for those of the next message.
+
+    """
+    message = create_message("dup@domain.country")
+    message["Cc"] = "dup@domain.country"
+    assert await mailer.deliver_message(message) == {
+        "dup@domain.country": (250, "2.0.0 OK")
+    }
+    await mailer.deliver(create_message("test@domain.country", body="Hi"))
+    assert [envelope.rcpt_tos for envelope in handler.envelopes] == [
+        ["dup@domain.country"],
+        ["test@domain.country"],
+    ]
+
+
+async def test_reconnect(mailer: LMTPMailer, handler: LMTPHandler) -> None:
+    """Test that a new connection is made if the server closed the idle connection."""
+    await mailer.deliver(create_message("test@domain.country"))
+    transport = handler.connections[0].transport
+    assert transport is not None
+    transport.close()
+    await sleep(0.1)
+
+    await mailer.deliver(create_message("test@domain.country"))
+    assert len(handler.connections) == 2
+    assert len(handler.envelopes) == 2
+
+
+async def test_cancel_mid_transaction(mailer: LMTPMailer, handler: LMTPHandler) -> None:
+    """
+    Test that a delivery cancelled while waiting for replies doesn't leave the
+    connection in use, where the late replies would be mistaken for the next ones.
+    """
+    task = create_task(mailer.deliver(create_message("slow@domain.country")))
+    await sleep(0.1)
+    task.cancel()
+    with pytest.raises(CancelledError):
+        await task
+
+    message = create_message("unknown@domain.country", "test@domain.country")
+    assert await mailer.deliver_message(message) == {
+        "unknown@domain.country": (550, "5.1.1 No such user"),
+        "test@domain.country": (250, "2.0.0 OK"),
+    }
+    assert len(handler.connections) == 2
+
+
+async def test_unix_socket(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    def getfqdn() -> str:
+        thread_names.append(threading.current_thread().name)
+        return "client.example.org"
+
+    thread_names: list[str] = []
+    monkeypatch.setattr(socket, "getfqdn", getfqdn)
+    path = tmp_path / "lmtp.sock"
+    handler = LMTPHandler()
+    server = await get_running_loop().create_unix_server(
+        lambda: LMTPServer(handler, hostname="server"), str(path)
+    )
+    mailer = LMTPMailer(path=path)
+    async with Context():
+        await mailer.start()
+        await mailer.deliver(create_message("test@domain.country", body="Hi"))
+
+    server.close()
+    await server.wait_closed()
+    assert len(handler.envelopes) == 1
+    assert mailer.local_hostname == "client.example.org"
+    assert len(thread_names) == 1
+    assert thread_names[0] != threading.main_thread().name
+
+
+async def test_connect_error(free_tcp_port: int, sample_message: EmailMessage) -> None:
+    mailer = LMTPMailer(port=free_tcp_port, timeout=1)
+    async with Context():
+        await mailer.start()
+        with pytest.raises(DeliveryError) as exc:
+            await mailer.deliver(sample_message)
+
+    assert exc.value.args[1] is sample_message
+
+
+@pytest.mark.parametrize(
+    "kwargs, expected",
+    [
+        pytest.param({}, "LMTPMailer(host='localhost', port=24)", id="tcp"),
+        pytest.param({"path": "/run/lmtp"}, "LMTPMailer(path='/run/lmtp')", id="unix"),
+    ],
+)
+def test_repr(kwargs: dict[str, Any], expected: str) -> None:
+    assert repr(LMTPMailer(**kwargs)) == expected
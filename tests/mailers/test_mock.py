@@ -1,7 +1,17 @@
 from __future__ import annotations
 
+from asyncio import create_task, sleep, wait_for
+from collections.abc import AsyncIterator
+from email.message import EmailMessage
+from typing import Any
+
 import pytest
-from asphalt.mailer.mailers.mock import MockMailer
+from asphalt.mailer.api import DeliveryError, DeliveryResult
+from asphalt.mailer.concurrency import ByteBudget
+from asphalt.mailer.idempotency import IdempotencyCache, set_idempotency_key
+from asphalt.mailer.mailers.mock import MessageStore, MockMailer
+from asphalt.mailer.utils import estimate_size
+from conftest import create_message, create_messages
 
 pytestmark = pytest.mark.anyio
 
@@ -25,5 +35,258 @@ async def test_deliver(mailer: MockMailer) -> None:
     assert mailer.messages[1].get_content() == "message 2\n"
 
 
+async def test_deliver_async_iterable(mailer: MockMailer) -> None:
+    async def generate_messages() -> AsyncIterator[EmailMessage]:
+        for body in ("message 1", "message 2"):
+            yield mailer.create_message(plain_body=body)
+
+    await mailer.deliver(generate_messages())
+    assert [message.get_content() for message in mailer.messages] == [
+        "message 1\n",
+        "message 2\n",
+    ]
+
+
+async def test_find(mailer: MockMailer) -> None:
+    messages = create_messages(
+        3, sender="Foo Bar <FooBar@example.org>", bcc="hidden@domain.country"
+    )
+    messages[1].replace_header("To", "other@domain.country")
+    await mailer.deliver(messages)
+    assert mailer.messages.find(recipient="TEST@domain.country") == [
+        mailer.messages[0],
+        mailer.messages[2],
+    ]
+    assert mailer.messages.find(recipient="hidden@domain.country") == mailer.messages[:]
+    assert mailer.messages.find(sender="foobar@example.org") == list(mailer.messages)
+    assert mailer.messages.find(subject="message 1") == [mailer.messages[1]]
+    assert mailer.messages.find(message_id="<2@bar.baz>") == [mailer.messages[2]]
+    assert (
+        mailer.messages.find(recipient="test@domain.country", subject="message 1") == []
+    )
+    assert mailer.messages.find(recipient="nobody@example.org") == []
+    assert mailer.messages.find() == list(mailer.messages)
+
+
+async def test_max_messages() -> None:
+    mailer = MockMailer(max_messages=2)
+    await mailer.deliver(create_messages(5))
+    assert len(mailer.messages) == 2
+    assert mailer.messages.total_count == 5
+    assert [message["Subject"] for message in mailer.messages] == [
+        "message 3",
+        "message 4",
+    ]
+    assert mailer.messages[-1]["Subject"] == "message 4"
+    assert mailer.messages.find(subject="message 2") == []
+    assert len(mailer.messages.find(recipient="test@domain.country")) == 2
+
+
+async def test_max_bytes() -> None:
+    mailer = MockMailer()
+    message_size = len(create_messages(1)[0].as_bytes())
+    mailer = MockMailer(max_bytes=message_size * 3 - 1)
+    await mailer.deliver(create_messages(5))
+    assert [message["Subject"] for message in mailer.messages] == [
+        "message 3",
+        "message 4",
+    ]
+
+
+async def test_clear(mailer: MockMailer) -> None:
+    await mailer.deliver(create_messages(1))
+    mailer.messages.clear()
+    assert len(mailer.messages) == 0
+    assert mailer.messages.total_count == 0
+    assert mailer.messages.find(subject="message 0") == []
+
+
+async def test_wait_for(mailer: MockMailer) -> None:
+    await mailer.deliver(create_message(subject="message 0"))
+    assert await mailer.messages.wait_for(subject="message 0") is mailer.messages[0]
+
+    task = create_task(mailer.messages.wait_for(recipient="other@domain.country"))
+    await sleep(0)
+    await mailer.deliver(create_message(subject="message 1"))
+    assert not task.done()
+
+    await mailer.deliver(create_message("other@domain.country", subject="message 2"))
+    message = await wait_for(task, 1)
+    assert message["Subject"] == "message 2"
+
+
+async def test_failures_deterministic() -> None:
+    outcomes = []
+    for _ in range(2):
+        mailer = MockMailer(
+            failure_rate=0.5, errors=["451 try again", "550 no such user"], seed=42
+        )
+        messages = create_messages(20)
+        results = [result async for result in mailer.deliver_iter(messages)]
+        outcomes.append([str(result.error) for result in results])
+        assert len(mailer.messages) == sum(result.error is None for result in results)
+
+    assert outcomes[0] == outcomes[1]
+    assert "None" in outcomes[0]
+    assert "error sending mail message: 451 try again" in outcomes[0]
+    assert "error sending mail message: 550 no such user" in outcomes[0]
+
+
+async def test_message_failure() -> None:
+    mailer = MockMailer(failure_rate=1)
+    message = create_message()
+    with pytest.raises(DeliveryError) as exc:
+        await mailer.deliver(message)
+
+    assert exc.value.args == ("451 4.3.0 Temporary failure", message)
+    assert len(mailer.messages) == 0
+
+
+@pytest.mark.parametrize("method", ["deliver", "deliver_iter"])
+async def test_batch_failure(method: str) -> None:
+    mailer = MockMailer(batch_failure_rate=1, errors=["421 too busy"])
+    with pytest.raises(DeliveryError, match="421 too busy") as exc:
+        if method == "deliver":
+            await mailer.deliver(create_message())
+        else:
+            async for _ in mailer.deliver_iter(create_message()):
+                pass
+
+    assert exc.value.args[1] is None
+    assert len(mailer.messages) == 0
+
+
+@pytest.mark.parametrize(
+    "delay, batch_delay, expected_delays",
+    [
+        pytest.param(0.01, None, [0.01, 0.01], id="fixed_number"),
+        pytest.param(None, {"distribution": "fixed", "value": 0.5}, [0.5], id="batch"),
+        pytest.param(
+            {"distribution": "uniform", "low": 0.1, "high": 0.2},
+            None,
+            [0.11343642441124013, 0.1847433736937233],
+            id="uniform",
+        ),
+    ],
+)
+async def test_delay(
+    monkeypatch: pytest.MonkeyPatch,
+    delay: Any,
+    batch_delay: Any,
+    expected_delays: list[float],
+) -> None:
+    delays: list[float] = []
+
+    async def fake_sleep(seconds: float) -> None:
+        delays.append(seconds)
+
+    monkeypatch.setattr("asphalt.mailer.mailers.mock.sleep", fake_sleep)
+    mailer = MockMailer(delay=delay, batch_delay=batch_delay, seed=1)
+    await mailer.deliver(create_messages(2))
+    assert delays == expected_delays
+    assert len(mailer.messages) == 2
+
+
+def test_lognormal_delay_deterministic() -> None:
+    delays = []
+    for _ in range(2):
+        mailer = MockMailer(
+            delay={"distribution": "lognormal", "mu": -3, "sigma": 1}, seed=5
+        )
+        delays.append([mailer._delay(mailer._random) for _ in range(5)])  # type: ignore[misc]
+
+    assert delays[0] == delays[1]
+    assert len(set(delays[0])) == 5
+
+
+@pytest.mark.parametrize(
+    "delay, message",
+    [
+        pytest.param(
+            {"distribution": "poisson"},
+            "unknown delay distribution: 'poisson'",
+            id="unknown",
+        ),
+        pytest.param(
+            {"distribution": "uniform", "low": 1},
+            "the uniform delay distribution requires exactly these parameters: "
+            "low, high",
+            id="missing",
+        ),
+        pytest.param(
+            {"distribution": "fixed", "value": 1, "foo": 2},
+            "the fixed delay distribution requires exactly these parameters: value",
+            id="extra",
+        ),
+    ],
+)
+def test_bad_delay(delay: dict[str, Any], message: str) -> None:
+    with pytest.raises(ValueError, match=message):
+        MockMailer(delay=delay)
+
+
+async def test_idempotency_key() -> None:
+    mailer = MockMailer(failure_rate=1)
+    mailer.idempotency_cache = IdempotencyCache()
+    kwargs = {"sender": "foo@example.org", "to": "bar@example.org"}
+    with pytest.raises(DeliveryError):
+        await mailer.create_and_deliver(idempotency_key="abc", **kwargs)
+
+    # The failed delivery released the key, so a retry is delivered
+    mailer.failure_rate = 0
+    await mailer.create_and_deliver(idempotency_key="abc", **kwargs)
+    await mailer.create_and_deliver(idempotency_key="abc", **kwargs)
+    await mailer.create_and_deliver(idempotency_key="def", **kwargs)
+    await mailer.create_and_deliver(**kwargs)
+    assert len(mailer.messages) == 3
+
+    message = create_message()
+    set_idempotency_key(message, "def")
+    results = [result async for result in mailer.deliver_iter(message)]
+    assert results == [DeliveryResult(message)]
+    assert len(mailer.messages) == 3
+
+
+async def test_byte_budget() -> None:
+    """Test that deliveries wait for room in the byte budget."""
+    mailer = MockMailer(delay=0.1)
+    mailer.byte_budget = ByteBudget(15000)
+    messages = [
+        mailer.create_message(
+            subject=f"large {i}",
+            sender="foobar@example.org",
+            to="bar@example.org",
+            plain_body="x" * 10000,
+        )
+        for i in range(2)
+    ]
+    first = create_task(mailer.deliver(messages[0]))
+    await sleep(0.01)
+    assert mailer.byte_budget.in_use == estimate_size(messages[0])
+    second = create_task(mailer.deliver(messages[1]))
+    await sleep(0.01)
+    assert mailer.byte_budget.in_use == estimate_size(messages[0])
+
+    await wait_for(first, 1)
+    await sleep(0.01)
+    assert mailer.byte_budget.in_use == estimate_size(messages[1])
+    await wait_for(second, 1)
+    assert mailer.byte_budget.in_use == 0
+    assert [message["Subject"] for message in mailer.messages] == [
+        "large 0",
+        "large 1",
+    ]
+
+
+def test_no_errors() -> None:
+    with pytest.raises(ValueError, match="errors must contain at least one error"):
+        MockMailer(errors=[])
+
+
+def test_store_repr() -> None:
+    store = MessageStore(max_messages=10)
+    assert repr(store) == "MessageStore(max_messages=10, max_bytes=None)"
+
+
 def test_repr(mailer: MockMailer) -> None:
     assert repr(mailer) == "MockMailer()"
@@ -0,0 +1,291 @@
+from __future__ import annotations
+
+from asyncio import (
+    StreamReader,
+    StreamWriter,
+    gather,
+    get_running_loop,
+    sleep,
+    start_server,
+)
+from collections.abc import AsyncGenerator
+from functools import partial
+from typing import Any
+
+import pytest
+from aiosmtpd.smtp import SMTP, Envelope, Session
+from asphalt.core.context import Context
+from asphalt.mailer.api import DeliveryError
+from asphalt.mailer.mailers.mx import MXMailer, MXRecord, MXResolver
+from conftest import create_message
+
+from .test_smtp import MessageHandler
+
+pytestmark = pytest.mark.anyio
+
+
+class StaticResolver(MXResolver):
+    def __init__(self, records: dict[str, list[MXRecord]]):
+        self.records = records
+        self.lookups: list[str] = []
+
+    async def resolve_mx(self, domain: str) -> list[MXRecord]:
+        self.lookups.append(domain)
+        await sleep(0)
+        try:
+            return self.records[domain]
+        except KeyError:
+            raise LookupError(f"{domain} does not exist") from None
+
+
+class ConnectionCountingHandler(MessageHandler):
+    def __init__(self) -> None:
+        super().__init__()
+        self.connections: list[SMTP] = []
+
+    async def handle_EHLO(
+        self,
+        server: SMTP,
+        session: Session,
+        envelope: Envelope,
+        hostname: str,
+        responses: list[str],
+    ) -> list[str]:
+        self.connections.append(server)
+        session.host_name = hostname
+        return responses
+
+
+@pytest.fixture
+def resolver() -> StaticResolver:
+    return StaticResolver(
+        {
+            "one.test": [MXRecord(10, "127.0.0.1.", 300)],
+            "two.test": [MXRecord(10, "127.0.0.2", 300)],
+            "fallback.test": [
+                MXRecord(20, "127.0.0.1", 300),
+                MXRecord(10, "127.0.0.3", 300),
+            ],
+            "nomail.test": [MXRecord(0, ".", 300)],
+            "nocache.test": [MXRecord(10, "127.0.0.1", 0)],
+            "implicit.test": [],
+        }
+    )
+
+
+@pytest.fixture
+async def handlers(
+    free_tcp_port: int,
+) -> AsyncGenerator[dict[str, ConnectionCountingHandler], None]:
+    handlers = {
+        "127.0.0.1": ConnectionCountingHandler(),
+        "127.0.0.2": ConnectionCountingHandler(),
+    }
+    servers = [
+        await get_running_loop().create_server(
+            partial(SMTP, handler), host, free_tcp_port
+        )
+        for host, handler in handlers.items()
+    ]
+    yield handlers
+    for server in servers:
+        server.close()
+        await server.wait_closed()
+
+
+@pytest.fixture
+async def mailer(
+    resolver: StaticResolver, free_tcp_port: int
+) -> AsyncGenerator[MXMailer, None]:
+    mailer = MXMailer(resolver=resolver, port=free_tcp_port, timeout=1)
+    async with Context():
+        await mailer.start()
+        yield mailer
+
+
+async def test_deliver(
+    mailer: MXMailer,
+    resolver: StaticResolver,
+    handlers: dict[str, ConnectionCountingHandler],
+) -> None:
+    message = create_message("a@one.test", "b@Two.test", "c@ONE.test")
+    message["Bcc"] = "d@two.test"
+    await mailer.deliver(message)
+    await mailer.deliver(create_message("e@one.test"))
+
+    assert sorted(resolver.lookups) == ["one.test", "two.test"]
+    handler1, handler2 = handlers["127.0.0.1"], handlers["127.0.0.2"]
+    assert [envelope.rcpt_tos for envelope in handler1.envelopes] == [
+        ["a@one.test", "c@ONE.test"],
+        ["e@one.test"],
+    ]
+    assert [envelope.rcpt_tos for envelope in handler2.envelopes] == [
+        ["b@Two.test", "d@two.test"]
+    ]
+    assert "Bcc" not in handler2.messages[0]
+
+    # The connections to the mail exchangers are kept open
+    assert len(handler1.connections) == 1
+    assert len(handler2.connections) == 1
+
+
+async def test_reconnect(
+    mailer: MXMailer, handlers: dict[str, ConnectionCountingHandler]
+) -> None:
+    """Test that the message is resent if the server closed the idle connection."""
+    handler = handlers["127.0.0.1"]
+    await mailer.deliver(create_message("a@one.test"))
+    transport = handler.connections[0].transport
+    assert transport is not None
+    transport.close()
+    await sleep(0.1)
+
+    await mailer.deliver(create_message("b@one.test"))
+    assert len(handler.connections) == 2
+    assert len(handler.envelopes) == 2
+
+
+async def test_fallback(
+    mailer: MXMailer, handlers: dict[str, ConnectionCountingHandler]
+) -> None:
+    """Test that the next mail exchanger is tried if the preferred one is down."""
+    await mailer.deliver(create_message("a@fallback.test"))
+    assert len(handlers["127.0.0.1"].envelopes) == 1
+
+
+async def test_no_reachable_mail_exchanger(
+    mailer: MXMailer, handlers: dict[str, ConnectionCountingHandler]
+) -> None:
+    mailer.port += 1
+    message = create_message("a@one.test")
+    with pytest.raises(
+        DeliveryError, match="could not connect to any mail exchanger of one.test"
+    ) as exc:
+        await mailer.deliver(message)
+
+    assert exc.value.args[1] is message
+
+
+async def test_partial_failure(
+    mailer: MXMailer, handlers: dict[str, ConnectionCountingHandler]
+) -> None:
+    message = create_message("a@one.test", "b@nomail.test", "c@unknown.test")
+    with pytest.raises(DeliveryError) as exc:
+        await mailer.deliver(message)
+
+    assert exc.value.args == (
+        "nomail.test does not accept mail; unknown.test does not exist",
+        message,
+    )
+    assert len(handlers["127.0.0.1"].envelopes) == 1
+
+
+async def test_greeting_rejected(mailer: MXMailer, free_tcp_port: int) -> None:
+    """Test that an SMTP error while connecting is turned into a DeliveryError."""
+
+    async def handle(reader: StreamReader, writer: StreamWriter) -> None:
+        writer.write(b"220 mx.one.test ESMTP\r\n")
+        while await reader.readline():
+            writer.write(b"554 go away\r\n")
+
+        writer.close()
+
+    server = await start_server(handle, "127.0.0.1", free_tcp_port)
+    try:
+        with pytest.raises(
+            DeliveryError, match="^error sending mail message: 127.0.0.1: "
+        ):
+            await mailer.deliver(create_message("a@one.test"))
+    finally:
+        server.close()
+        await server.wait_closed()
+
+    assert not mailer._connections
+
+
+async def test_idle_timeout(
+    mailer: MXMailer, handlers: dict[str, ConnectionCountingHandler]
+) -> None:
+    mailer.idle_timeout = 0.1
+    await mailer.deliver(create_message("a@one.test"))
+    assert list(mailer._connections) == ["127.0.0.1"]
+    await sleep(0.3)
+    assert not mailer._connections
+
+    await mailer.deliver(create_message("b@one.test"))
+    assert len(handlers["127.0.0.1"].connections) == 2
+
+
+async def test_max_connections(
+    mailer: MXMailer, handlers: dict[str, ConnectionCountingHandler]
+) -> None:
+    mailer.max_connections = 1
+    await mailer.deliver(create_message("a@one.test"))
+    await mailer.deliver(create_message("b@two.test"))
+    assert list(mailer._connections) == ["127.0.0.2"]
+
+    await mailer.deliver(create_message("c@one.test"))
+    assert list(mailer._connections) == ["127.0.0.1"]
+    assert len(handlers["127.0.0.1"].connections) == 2
+
+
+async def test_get_mail_exchangers_cache(
+    mailer: MXMailer, resolver: StaticResolver
+) -> None:
+    results = await gather(
+        mailer.get_mail_exchangers("one.test"),
+        mailer.get_mail_exchangers("ONE.test"),
+        mailer.get_mail_exchangers("nocache.test"),
+    )
+    assert list(results) == [["127.0.0.1"], ["127.0.0.1"], ["127.0.0.1"]]
+    assert await mailer.get_mail_exchangers("one.test") == ["127.0.0.1"]
+    assert await mailer.get_mail_exchangers("nocache.test") == ["127.0.0.1"]
+    assert resolver.lookups == ["one.test", "nocache.test", "nocache.test"]
+
+
+async def test_get_mail_exchangers_max_cache_ttl(
+    mailer: MXMailer, resolver: StaticResolver
+) -> None:
+    mailer.max_cache_ttl = 0
+    await mailer.get_mail_exchangers("one.test")
+    await mailer.get_mail_exchangers("one.test")
+    assert resolver.lookups == ["one.test", "one.test"]
+
+
+async def test_get_mail_exchangers_order(mailer: MXMailer) -> None:
+    assert await mailer.get_mail_exchangers("fallback.test") == [
+        "127.0.0.3",
+        "127.0.0.1",
+    ]
+    assert await mailer.get_mail_exchangers("implicit.test") == ["implicit.test"]
+    assert await mailer.get_mail_exchangers("nomail.test") == []
+
+
+async def test_resolver_resource(resolver: StaticResolver) -> None:
+    mailer = MXMailer(resolver="mx")
+    async with Context() as ctx:
+        ctx.add_resource(resolver, "mx", types=[MXResolver])
+        await mailer.start()
+        assert mailer.resolver is resolver
+
+
+@pytest.mark.parametrize(
+    "kwargs, message",
+    [
+        pytest.param(
+            {"max_connections": 0},
+            "max_connections must be at least 1",
+            id="max_connections",
+        ),
+        pytest.param(
+            {"idle_timeout": 0}, "idle_timeout must be positive", id="idle_timeout"
+        ),
+    ],
+)
+def test_bad_arguments(kwargs: dict[str, Any], message: str) -> None:
+    with pytest.raises(ValueError, match=message):
+        MXMailer(**kwargs)
+
+
+def test_repr() -> None:
+    assert repr(MXMailer(resolver="mx")) == "MXMailer(resolver='mx')"
@@ -2,11 +2,16 @@ from __future__ import annotations
 
 import os
 import sys
+from asyncio import gather
+from copy import deepcopy
 from email.message import EmailMessage
 from pathlib import Path
+from typing import NoReturn
 
 import pytest
 from asphalt.mailer.api import DeliveryError, Mailer
+from asphalt.mailer.journal import DeliveryJournal, read_journal
+from asphalt.mailer.mailers import sendmail
 from asphalt.mailer.mailers.sendmail import SendmailMailer
 
 pytestmark = [
@@ -90,6 +95,107 @@ Test content
     )
 
 
+async def test_deliver_file(
+    mailer: SendmailMailer,
+    script: str,
+    outfile: Path,
+    sample_message: EmailMessage,
+    recipients: tuple[str, ...],
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """Test that a spooled message is passed to sendmail without reading it in."""
+
+    def read_bytes(self: Path) -> NoReturn:
+        pytest.fail("The message file was read into memory")
+
+    del sample_message["Bcc"]
+    sample_message.set_content("Test content\n" * 10000)
+    path = tmp_path / "message.eml"
+    path.write_bytes(sample_message.as_bytes())
+    monkeypatch.setattr(Path, "read_bytes", read_bytes)
+    mailer.path = script
+    mailer.journal = DeliveryJournal(tmp_path / "mail.journal")
+    await mailer.deliver_file(path, recipients)
+    await mailer.journal.close()
+
+    assert outfile.read_text() == path.read_text()
+    entries = list(read_journal(tmp_path / "mail.journal"))
+    assert entries[0].recipients == list(recipients)
+    assert entries[0].size == path.stat().st_size
+
+
+async def test_deliver_file_bcc(
+    mailer: SendmailMailer,
+    script: str,
+    outfile: Path,
+    sample_message: EmailMessage,
+    tmp_path: Path,
+) -> None:
+    """Test that a spooled message with a Bcc header is delivered without it."""
+    path = tmp_path / "message.eml"
+    path.write_bytes(sample_message.as_bytes())
+    mailer.path = script
+    await mailer.deliver_file(path)
+
+    del sample_message["Bcc"]
+    assert outfile.read_bytes() == sample_message.as_bytes()
+
+
+async def test_deliver_file_long_headers(
+    mailer: SendmailMailer,
+    script: str,
+    outfile: Path,
+    sample_message: EmailMessage,
+    recipients: tuple[str, ...],
+    tmp_path: Path,
+) -> None:
+    """Test that a blank line split between two reads still ends the headers."""
+    del sample_message["Bcc"]
+    headers, _, body = sample_message.as_bytes().partition(b"\n\n")
+    padding = b"\nX-Padding: " + b"x" * (8191 - len(headers) - 12)
+    path = tmp_path / "message.eml"
+    path.write_bytes(headers + padding + b"\n\n" + body)
+    assert path.read_bytes().index(b"\n\n") == 8191
+    mailer.path = script
+    await mailer.deliver_file(path, recipients)
+
+    assert outfile.read_bytes() == path.read_bytes()
+
+
+async def test_deliver_file_headers_too_large(
+    mailer: SendmailMailer,
+    script: str,
+    sample_message: EmailMessage,
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(sendmail, "_max_header_size", 10000)
+    del sample_message["Bcc"]
+    for i in range(200):
+        sample_message[f"X-Header-{i}"] = "x" * 70
+
+    path = tmp_path / "message.eml"
+    path.write_bytes(sample_message.as_bytes())
+    mailer.path = script
+    with pytest.raises(ValueError, match="exceed the maximum size"):
+        await mailer.deliver_file(path)
+
+
+async def test_deliver_file_error(
+    mailer: SendmailMailer,
+    fail_script: str,
+    sample_message: EmailMessage,
+    tmp_path: Path,
+) -> None:
+    del sample_message["Bcc"]
+    path = tmp_path / "message.eml"
+    path.write_bytes(sample_message.as_bytes())
+    mailer.path = fail_script
+    with pytest.raises(DeliveryError, match="This is a test error"):
+        await mailer.deliver_file(path)
+
+
 async def test_deliver_launch_error(
     mailer: SendmailMailer, sample_message: EmailMessage
 ) -> None:
@@ -112,5 +218,71 @@ async def test_deliver_error(
     assert exc.match("^error sending mail message: This is a test error")
 
 
+async def test_deliver_journal(
+    mailer: SendmailMailer,
+    script: str,
+    sample_message: EmailMessage,
+    recipients: tuple[str, ...],
+    tmp_path: Path,
+) -> None:
+    fail_script = tmp_path / "sendmail-tempfail"
+    fail_script.write_text(
+        f"""\
+#!{sys.executable}
+import sys
+
+print('Try again later', file=sys.stderr)
+sys.exit(75)
+"""
+    )
+    fail_script.chmod(0o555)
+    mailer.journal = DeliveryJournal(tmp_path / "mail.journal")
+    mailer.path = script
+    await mailer.deliver(deepcopy(sample_message))
+    mailer.path = str(fail_script)
+    with pytest.raises(DeliveryError):
+        await mailer.deliver(deepcopy(sample_message))
+
+    await mailer.journal.close()
+    entries = list(read_journal(tmp_path / "mail.journal"))
+    assert [(entry.status, entry.error) for entry in entries] == [
+        (0, None),
+        (75, "Try again later"),
+    ]
+    assert entries[0].recipients == list(recipients)
+    assert entries[0].size
+    assert entries[1].size == entries[0].size
+
+
+async def test_deliver_adaptive_concurrency(
+    tmp_path: Path, sample_message: EmailMessage
+) -> None:
+    script = tmp_path / "sendmail"
+    script.write_text(
+        f"""\
+#!{sys.executable}
+import sys
+
+if 'Subject: tempfail' in sys.stdin.read():
+    print('Try again later', file=sys.stderr)
+    sys.exit(75)
+"""
+    )
+    script.chmod(0o555)
+    mailer = SendmailMailer(
+        path=script, concurrency={"initial_limit": 2, "latency_tolerance": None}
+    )
+    assert mailer.limiter is not None
+    await gather(*[mailer.deliver(deepcopy(sample_message)) for _ in range(3)])
+    assert mailer.limiter.limit == 3
+
+    sample_message["Subject"] = "tempfail"
+    with pytest.raises(DeliveryError, match="Try again later"):
+        await mailer.deliver(sample_message)
+
+    assert mailer.limiter.limit == 1
+    assert mailer.limiter.in_flight == 0
+
+
 def test_repr(mailer: Mailer) -> None:
     assert repr(mailer) == "SendmailMailer('/usr/sbin/sendmail')"
@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import ssl
+from asyncio import sleep
+from email.message import EmailMessage
+
+import pytest
+from aiosmtplib import SMTP
+from asphalt.core.context import Context
+from asphalt.mailer.api import DeliveryError
+from asphalt.mailer.mailers.smtp import SMTPMailer
+from asphalt.mailer.sink import SinkStatistics, SMTPSink, main
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_deliver(sample_message: EmailMessage) -> None:
+    async with SMTPSink() as sink:
+        mailer = SMTPMailer(port=sink.port, tls=False, timeout=1)
+        async with Context():
+            await mailer.start()
+            await mailer.deliver([sample_message, sample_message])
+
+    statistics = sink.statistics
+    assert statistics.messages == 2
+    assert statistics.recipients == 12
+    assert statistics.bytes > 0
+    assert statistics.connections == 1
+    assert statistics.messages_per_second > 0
+    assert 0 < statistics.percentile(50) <= statistics.percentile(100)
+
+
+@pytest.mark.parametrize("implicit_tls", [False, True], ids=["starttls", "implicit"])
+async def test_tls_auth(
+    sample_message: EmailMessage,
+    server_tls_context: ssl.SSLContext,
+    client_tls_context: ssl.SSLContext,
+    implicit_tls: bool,
+) -> None:
+    async with SMTPSink(
+        tls_context=server_tls_context,
+        implicit_tls=implicit_tls,
+        credentials={"foo": "bar"},
+    ) as sink:
+        mailer = SMTPMailer(
+            port=sink.port,
+            tls=None if implicit_tls else True,
+            implicit_tls=implicit_tls,
+            tls_context="contextresource",
+            username="foo",
+            password="bar",
+            timeout=1,
+        )
+        async with Context() as ctx:
+            ctx.add_resource(client_tls_context, "contextresource")
+            await mailer.start()
+            await mailer.deliver(sample_message)
+            mailer.password = "baz"
+            with pytest.raises(
+                DeliveryError, match="Authentication credentials invalid"
+            ):
+                await mailer.deliver(sample_message)
+
+    assert sink.statistics.messages == 1
+
+
+async def test_latency(sample_message: EmailMessage) -> None:
+    async with SMTPSink(latency={"data": 0.2, "mail": 0.1}) as sink:
+        mailer = SMTPMailer(port=sink.port, tls=False, timeout=1)
+        async with Context():
+            await mailer.start()
+            await mailer.deliver(sample_message)
+
+    # The MAIL latency is incurred before the transaction starts
+    assert 0.2 <= sink.statistics.percentile(50) < 0.3
+
+
+async def test_throttling(sample_message: EmailMessage) -> None:
+    async with SMTPSink(max_rate=1) as sink:
+        mailer = SMTPMailer(port=sink.port, tls=False, timeout=1)
+        async with Context():
+            await mailer.start()
+            await mailer.deliver(sample_message)
+            with pytest.raises(DeliveryError, match="Rate limit exceeded"):
+                await mailer.deliver(sample_message)
+
+    assert sink.statistics.messages == 1
+    assert sink.statistics.throttled == 1
+
+
+async def test_connection_limit() -> None:
+    async with SMTPSink(max_connections=1) as sink:
+        async with SMTP(hostname="localhost", port=sink.port, timeout=1) as client:
+            await client.ehlo()
+            second_client = SMTP(hostname="localhost", port=sink.port, timeout=1)
+            with pytest.raises(Exception, match="Too many connections"):
+                await second_client.connect()
+
+            second_client.close()
+
+        # The slot is freed when the first client disconnects
+        await sleep(0.1)
+        async with SMTP(hostname="localhost", port=sink.port, timeout=1) as client:
+            await client.noop()
+
+    assert sink.statistics.connections == 2
+    assert sink.statistics.rejected_connections == 1
+
+
+def test_implicit_tls_without_context() -> None:
+    with pytest.raises(ValueError, match="implicit_tls requires a TLS context"):
+        SMTPSink(implicit_tls=True)
+
+
+def test_percentile() -> None:
+    statistics = SinkStatistics()
+    assert statistics.percentile(50) == 0
+    for latency in range(1, 11):
+        statistics.add_message(100, 1, latency / 10)
+
+    assert statistics.percentile(0) == 0.1
+    assert statistics.percentile(50) == 0.5
+    assert statistics.percentile(90) == 0.9
+    assert statistics.percentile(99) == 1.0
+    with pytest.raises(ValueError, match="percent must be between 0 and 100"):
+        statistics.percentile(101)
+
+    statistics.reset()
+    assert statistics.messages == 0
+    assert statistics.percentile(50) == 0
+
+
+def test_cli_bad_latency(capsys: pytest.CaptureFixture[str]) -> None:
+    with pytest.raises(SystemExit):
+        main(["--latency", "DATA"])
+
+    assert "expected COMMAND=SECONDS, got 'DATA'" in capsys.readouterr().err
+
+
+def test_repr() -> None:
+    assert repr(SMTPSink(port=2525)) == "SMTPSink(host='localhost', port=2525)"
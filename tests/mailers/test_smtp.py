@@ -1,19 +1,31 @@
 from __future__ import annotations
 
 import ssl
-from asyncio import get_running_loop
+import time
+from asyncio import Event, create_task, gather, get_running_loop, wait_for
 from base64 import b64decode
-from collections.abc import AsyncGenerator
+from collections.abc import AsyncGenerator, AsyncIterator
 from contextlib import asynccontextmanager
+from copy import deepcopy
 from email.message import EmailMessage, Message
-from typing import Any
+from pathlib import Path
+from typing import Any, cast
 
 import pytest
 from aiosmtpd.handlers import Message as AIOSMTPMessage
-from aiosmtpd.smtp import SMTP, AuthResult, Envelope, Session
+from aiosmtpd.smtp import MISSING, SMTP, AuthResult, Envelope, Session
 from asphalt.core.context import Context
-from asphalt.mailer.api import DeliveryError
+from asphalt.mailer.api import DeliveryError, DeliveryResult, Mailer
+from asphalt.mailer.dkim import DKIMSigner
+from asphalt.mailer.idempotency import IdempotencyCache, set_idempotency_key
+from asphalt.mailer.journal import DeliveryJournal, read_journal
 from asphalt.mailer.mailers.smtp import SMTPMailer
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from cryptography.hazmat.primitives.serialization import (
+    Encoding,
+    NoEncryption,
+    PrivateFormat,
+)
 
 pytestmark = pytest.mark.anyio
 
@@ -22,22 +34,106 @@ class MessageHandler(AIOSMTPMessage):
     def __init__(self, message_class: type[Message] | None = None):
         super().__init__(message_class)
         self.messages: list[Any] = []
+        self.envelopes: list[Envelope] = []
+        self.sessions: list[Session] = []
+
+    def prepare_message(self, session: Session, envelope: Envelope) -> Message:
+        self.envelopes.append(envelope)
+        self.sessions.append(session)
+        return super().prepare_message(session, envelope)
 
     def handle_message(self, message: Message) -> None:
         self.messages.append(message)
 
 
+class SevenBitHandler(MessageHandler):
+    """A message handler that keeps the server from advertising 8BITMIME."""
+
+    async def handle_EHLO(
+        self,
+        server: SMTP,
+        session: Session,
+        envelope: Envelope,
+        hostname: str,
+        responses: list[str],
+    ) -> list[str]:
+        session.host_name = hostname
+        return [response for response in responses if "8BITMIME" not in response]
+
+
+class ChunkingSMTP(SMTP):
+    """An SMTP server that additionally supports CHUNKING and BINARYMIME (RFC 3030)."""
+
+    def __init__(self, handler: AIOSMTPMessage, **kwargs: Any):
+        super().__init__(handler, **kwargs)
+        self._chunks: list[bytes] = []
+
+    async def handle_EHLO(
+        self,
+        server: SMTP,
+        session: Session,
+        envelope: Envelope,
+        hostname: str,
+        responses: list[str],
+    ) -> list[str]:
+        session.host_name = hostname
+        return responses[:-1] + ["250-CHUNKING", "250-BINARYMIME", responses[-1]]
+
+    async def smtp_EHLO(self, hostname: str) -> None:
+        self._handle_hooks["EHLO"] = self.handle_EHLO
+        self._ehlo_hook_ver = "new"
+        await super().smtp_EHLO(hostname)
+
+    async def smtp_MAIL(self, arg: str) -> None:
+        binarymime = " BODY=BINARYMIME" in arg.upper()
+        await super().smtp_MAIL(arg.replace(" BODY=BINARYMIME", ""))
+        if binarymime and self.envelope and self.envelope.mail_from:
+            self.envelope.mail_options.append("BODY=BINARYMIME")
+
+    async def smtp_BDAT(self, arg: str) -> None:
+        size, _, last = arg.partition(" ")
+        chunk = await self._reader.readexactly(int(size))
+        self._chunks.append(chunk)
+        if last.upper() != "LAST":
+            await self.push("250 OK")
+            return
+
+        assert self.envelope is not None
+        content = b"".join(self._chunks)
+        self.envelope.content = self.envelope.original_content = content
+        self._chunks.clear()
+        status = await self._call_handler_hook("DATA")
+        self._set_post_data_state()  # type: ignore[no-untyped-call]
+        await self.push("250 OK" if status is MISSING else status)
+
+
 @asynccontextmanager
 async def run_smtp_server(
-    port: int, handler: AIOSMTPMessage, server_tls_context: ssl.SSLContext | None = None
-) -> AsyncGenerator[SMTP, None]:
-    smtp = SMTP(
-        handler,
-        require_starttls=server_tls_context is not None,
-        tls_context=server_tls_context,
-    )
-    server = await get_running_loop().create_server(lambda: smtp, port=port)
-    yield smtp
+    port: int,
+    handler: AIOSMTPMessage,
+    server_tls_context: ssl.SSLContext | None = None,
+    *,
+    implicit_tls: bool = False,
+    server_class: type[SMTP] = SMTP,
+    **server_kwargs: Any,
+) -> AsyncGenerator[None, None]:
+    if implicit_tls:
+        server = await get_running_loop().create_server(
+            lambda: server_class(handler, **server_kwargs),
+            port=port,
+            ssl=server_tls_context,
+        )
+    else:
+        server = await get_running_loop().create_server(
+            lambda: server_class(
+                handler,
+                tls_context=server_tls_context,
+                **server_kwargs,
+            ),
+            port=port,
+        )
+
+    yield
     server.close()
     await server.wait_closed()
 
@@ -70,6 +166,51 @@ def test_port_selection(
     assert mailer.port == expected_port
 
 
+@pytest.mark.parametrize(
+    "username, password",
+    [
+        pytest.param("foo", "bar", id="auth"),
+        pytest.param(None, None, id="noauth"),
+    ],
+)
+def test_port_selection_implicit_tls(username: str, password: str) -> None:
+    mailer = SMTPMailer(username=username, password=password, implicit_tls=True)
+    assert mailer.port == 465
+    assert not mailer.tls
+
+
+def test_lane_without_connections() -> None:
+    with pytest.raises(
+        ValueError, match="lane 'bulk' must have at least one connection reserved"
+    ):
+        SMTPMailer(lanes={"default": 1, "bulk": 0})
+
+
+def test_lanes_without_default() -> None:
+    with pytest.raises(ValueError, match="lanes must include a 'default' lane"):
+        SMTPMailer(lanes={"urgent": 1, "bulk": 4})
+
+
+def test_implicit_tls_conflict() -> None:
+    with pytest.raises(ValueError, match="tls and implicit_tls are mutually exclusive"):
+        SMTPMailer(tls=True, implicit_tls=True)
+
+
+def test_phase_timeouts() -> None:
+    mailer = SMTPMailer(timeout=5, connect_timeout=2, command_timeout=3)
+    assert mailer.connect_timeout == 2
+    assert mailer.tls_timeout == mailer.auth_timeout == 5
+    assert mailer._get_data_timeout(1000000) == 3
+
+    mailer = SMTPMailer(command_timeout=3, min_data_rate=100000)
+    assert mailer._get_data_timeout(1000000) == 13
+
+
+def test_bad_min_data_rate() -> None:
+    with pytest.raises(ValueError, match="min_data_rate must be positive"):
+        SMTPMailer(min_data_rate=0)
+
+
 async def test_resources() -> None:
     mailer = SMTPMailer(tls_context="contextresource")
     async with Context() as ctx:
@@ -80,13 +221,18 @@ async def test_resources() -> None:
 
 
 async def test_deliver(
-    mailer: SMTPMailer, sample_message: EmailMessage, free_tcp_port: int
+    mailer: SMTPMailer,
+    sample_message: EmailMessage,
+    free_tcp_port: int,
+    server_tls_context: ssl.SSLContext,
+    tls: bool,
 ) -> None:
     handler = MessageHandler()
-    async with run_smtp_server(free_tcp_port, handler):
+    async with run_smtp_server(free_tcp_port, handler, server_tls_context):
         await mailer.deliver(sample_message)
 
     assert len(handler.messages) == 1
+    assert (handler.sessions[0].ssl is not None) is tls
     received_message = handler.messages[0]
 
     headers = dict(received_message.items())
@@ -126,24 +272,630 @@ async def test_deliver_auth(
     mailer.username = "foo"
     mailer.password = "bar"
     handler = AuthHandler()
+    async with run_smtp_server(
+        free_tcp_port, handler, server_tls_context, auth_require_tls=False
+    ):
+        await mailer.deliver(sample_message)
+
+    assert len(handler.messages) == 1
+
+
+async def test_deliver_opportunistic_tls(
+    sample_message: EmailMessage,
+    free_tcp_port: int,
+    server_tls_context: ssl.SSLContext,
+    client_tls_context: ssl.SSLContext,
+) -> None:
+    """Test that STARTTLS is used by default when the server offers it."""
+    mailer = SMTPMailer(port=free_tcp_port, timeout=1, tls_context=client_tls_context)
+    assert mailer.tls is None
+    handler = MessageHandler()
+    async with Context(), run_smtp_server(free_tcp_port, handler, server_tls_context):
+        await mailer.start()
+        await mailer.deliver(sample_message)
+
+    assert handler.sessions[0].ssl is not None
+
+
+async def test_deliver_starttls_not_offered(
+    sample_message: EmailMessage,
+    free_tcp_port: int,
+    client_tls_context: ssl.SSLContext,
+) -> None:
+    """Test that a delivery fails if TLS is required but STARTTLS is not offered."""
+    mailer = SMTPMailer(
+        port=free_tcp_port, timeout=1, tls=True, tls_context=client_tls_context
+    )
+    handler = MessageHandler()
+    async with Context(), run_smtp_server(free_tcp_port, handler):
+        await mailer.start()
+        with pytest.raises(DeliveryError, match="STARTTLS extension not supported"):
+            await mailer.deliver(sample_message)
+
+    assert not handler.messages
+
+
+async def test_deliver_implicit_tls(
+    sample_message: EmailMessage,
+    free_tcp_port: int,
+    server_tls_context: ssl.SSLContext,
+    client_tls_context: ssl.SSLContext,
+) -> None:
+    """Test that the TLS handshake is done right away when implicit TLS is enabled."""
+    mailer = SMTPMailer(
+        port=free_tcp_port,
+        timeout=1,
+        implicit_tls=True,
+        tls_context="contextresource",
+    )
+    handler = MessageHandler()
+    async with Context() as ctx:
+        ctx.add_resource(client_tls_context, "contextresource")
+        await mailer.start()
+        async with run_smtp_server(
+            free_tcp_port, handler, server_tls_context, implicit_tls=True
+        ):
+            await mailer.deliver(sample_message)
+
+    assert len(handler.messages) == 1
+
+
+async def test_deliver_dkim(
+    mailer: SMTPMailer,
+    sample_message: EmailMessage,
+    free_tcp_port: int,
+    server_tls_context: ssl.SSLContext,
+) -> None:
+    """Test that the message is signed in its final form."""
+    private_key = Ed25519PrivateKey.generate()
+    mailer.dkim_signer = DKIMSigner(
+        domain="bar.baz",
+        selector="test",
+        private_key=private_key.private_bytes(
+            Encoding.PEM, PrivateFormat.PKCS8, NoEncryption()
+        ),
+    )
+    handler = MessageHandler()
     async with run_smtp_server(free_tcp_port, handler, server_tls_context):
         await mailer.deliver(sample_message)
 
+    content = cast(bytes, handler.envelopes[0].original_content)
+    assert content.startswith(b"DKIM-Signature: v=1;")
+    assert b"h=from:to:cc:mime-version:content-type:content-transfer-encoding;" in (
+        content.replace(b"\r\n", b"")
+    )
+
+
+async def test_deliver_idempotency_key(
+    mailer: SMTPMailer,
+    sample_message: EmailMessage,
+    free_tcp_port: int,
+    server_tls_context: ssl.SSLContext,
+) -> None:
+    mailer.idempotency_cache = IdempotencyCache()
+    set_idempotency_key(sample_message, "abc")
+    with pytest.raises(DeliveryError):
+        await mailer.deliver(sample_message)
+
+    handler = MessageHandler()
+    async with run_smtp_server(free_tcp_port, handler, server_tls_context):
+        await mailer.deliver([sample_message, sample_message])
+        results = [result async for result in mailer.deliver_iter(sample_message)]
+
+    assert results == [DeliveryResult(sample_message)]
+    assert len(handler.messages) == 1
+
+
+async def test_deliver_journal(
+    mailer: SMTPMailer,
+    sample_message: EmailMessage,
+    recipients: tuple[str, ...],
+    free_tcp_port: int,
+    tmp_path: Path,
+    server_tls_context: ssl.SSLContext,
+) -> None:
+    class RejectingHandler(MessageHandler):
+        async def handle_RCPT(
+            self,
+            server: SMTP,
+            session: Session,
+            envelope: Envelope,
+            address: str,
+            rcpt_options: list[str],
+        ) -> str:
+            if address.startswith("bar"):
+                return "450 Mailbox busy"
+
+            envelope.rcpt_tos.append(address)
+            return "250 OK"
+
+    mailer.journal = DeliveryJournal(tmp_path / "mail.journal")
+    async with run_smtp_server(free_tcp_port, RejectingHandler(), server_tls_context):
+        await mailer.deliver(sample_message)
+        message = EmailMessage()
+        message["From"] = "foo@bar.baz"
+        message["To"] = "bar@example.org"
+        with pytest.raises(DeliveryError):
+            await mailer.deliver(message)
+
+    await mailer.journal.close()
+    entries = list(read_journal(tmp_path / "mail.journal"))
+    assert [(entry.backend, entry.status) for entry in entries] == [
+        ("SMTPMailer", 250),
+        ("SMTPMailer", 450),
+    ]
+    assert entries[0].error is None
+    assert "Mailbox busy" in str(entries[1].error)
+    assert entries[0].recipients == list(recipients)
+    assert entries[0].size
+    assert entries[1].size is None
+
+
+async def test_deliver_8bit(
+    mailer: SMTPMailer, free_tcp_port: int, server_tls_context: ssl.SSLContext
+) -> None:
+    """Test that 8-bit bodies are sent as-is when the server advertises 8BITMIME."""
+    handler = MessageHandler()
+    body = "Hello wörld, how are you? " * 20
+    async with run_smtp_server(free_tcp_port, handler, server_tls_context):
+        message = mailer.create_message(
+            sender="foo@bar.baz", to="test@domain.country", plain_body=body
+        )
+        assert message["Content-Transfer-Encoding"] == "8bit"
+        await mailer.deliver(message)
+
+    assert len(handler.messages) == 1
+    assert "BODY=8BITMIME" in handler.envelopes[0].mail_options
+    assert cast(bytes, handler.envelopes[0].original_content).endswith(
+        f"{body}\r\n".encode()
+    )
+    assert handler.messages[0].get_payload(decode=True).decode() == f"{body}\r\n"
+
+
+async def test_deliver_8bit_unsupported(
+    mailer: SMTPMailer, free_tcp_port: int, server_tls_context: ssl.SSLContext
+) -> None:
+    """
+    Test that 8-bit bodies are re-encoded for a server that doesn't advertise 8BITMIME,
+    without changing how the mailer creates messages for other connections.
+
+    """
+    handler = SevenBitHandler()
+    body = "Hello wörld, how are you? " * 20
+    async with run_smtp_server(free_tcp_port, handler, server_tls_context):
+        message = mailer.create_message(
+            sender="foo@bar.baz", to="test@domain.country", plain_body=body
+        )
+        await mailer.deliver(message)
+
+    assert mailer.supports_8bit
     assert len(handler.messages) == 1
+    assert "BODY=8BITMIME" not in handler.envelopes[0].mail_options
+    assert cast(bytes, handler.envelopes[0].original_content).isascii()
+    assert handler.messages[0].get_payload(decode=True).decode() == f"{body}\n"
+
+
+async def test_deliver_smtputf8(
+    mailer: SMTPMailer,
+    sample_message: EmailMessage,
+    free_tcp_port: int,
+    server_tls_context: ssl.SSLContext,
+) -> None:
+    """Test that headers are sent as raw UTF-8 when the server supports SMTPUTF8."""
+    sample_message["Subject"] = "Hellö wörld"
+    handler = MessageHandler()
+    async with run_smtp_server(
+        free_tcp_port, handler, server_tls_context, enable_SMTPUTF8=True
+    ):
+        await mailer.deliver(sample_message)
+
+    assert "SMTPUTF8" in handler.envelopes[0].mail_options
+    assert b"Subject: Hell\xc3\xb6 w\xc3\xb6rld\r\n" in cast(
+        bytes, handler.envelopes[0].original_content
+    )
+
+
+async def test_deliver_too_large(
+    mailer: SMTPMailer,
+    sample_message: EmailMessage,
+    free_tcp_port: int,
+    server_tls_context: ssl.SSLContext,
+) -> None:
+    """
+    Test that a message larger than the limit advertised by the server is rejected
+    without sending it.
+
+    """
+    handler = MessageHandler()
+    async with run_smtp_server(
+        free_tcp_port, handler, server_tls_context, data_size_limit=100
+    ):
+        with pytest.raises(DeliveryError) as exc:
+            await mailer.deliver(sample_message)
+
+    assert exc.value.args[1] is sample_message
+    exc.match(r"message size \(\d+ bytes\) exceeds the server's limit \(100 bytes\)")
+    assert not handler.envelopes
+
+
+async def test_deliver_chunking(
+    mailer: SMTPMailer,
+    sample_message: EmailMessage,
+    free_tcp_port: int,
+    server_tls_context: ssl.SSLContext,
+) -> None:
+    """Test that BDAT is used in place of DATA when the server supports CHUNKING."""
+    mailer.chunk_size = 100
+    sample_message.set_content(".dotted line\n" + ("x" * 70 + "\n") * 5)
+    handler = MessageHandler()
+    async with run_smtp_server(
+        free_tcp_port, handler, server_tls_context, server_class=ChunkingSMTP
+    ):
+        await mailer.deliver(sample_message)
+
+    assert len(handler.messages) == 1
+    envelope = handler.envelopes[0]
+    assert "BODY=BINARYMIME" in envelope.mail_options
+    assert envelope.rcpt_tos == [
+        "test@domain.country",
+        "test2@domain.country",
+        "testcc@domain.country",
+        "testcc2@domain.country",
+        "testbcc@domain.country",
+        "testbcc2@domain.country",
+    ]
+    content = cast(bytes, envelope.original_content)
+    assert b"Bcc" not in content
+    assert content.endswith(b"\r\n\r\n.dotted line\r\n" + (b"x" * 70 + b"\r\n") * 5)
+
+
+async def test_deliver_chunking_error(
+    mailer: SMTPMailer,
+    sample_message: EmailMessage,
+    free_tcp_port: int,
+    server_tls_context: ssl.SSLContext,
+) -> None:
+    """Test that errors after the last BDAT chunk are converted to DeliveryErrors."""
+
+    class BadHandler(MessageHandler):
+        async def handle_DATA(
+            self, server: SMTP, session: Session, envelope: Envelope
+        ) -> str:
+            return "554 Error: foo"
+
+    async with run_smtp_server(
+        free_tcp_port, BadHandler(), server_tls_context, server_class=ChunkingSMTP
+    ):
+        with pytest.raises(DeliveryError) as exc:
+            await mailer.deliver(sample_message)
+
+    assert exc.value.args[1] is sample_message
+    exc.match("Error: foo")
+
+
+async def test_deliver_iter(
+    mailer: SMTPMailer,
+    sample_message: EmailMessage,
+    free_tcp_port: int,
+    server_tls_context: ssl.SSLContext,
+) -> None:
+    """
+    Test that deliver_iter() reports the outcome of each message separately, sending
+    all of them over the same connection.
+
+    """
+
+    class RejectingHandler(MessageHandler):
+        def __init__(self) -> None:
+            super().__init__()
+            self.sessions: list[Session] = []
+
+        async def handle_DATA(
+            self, server: SMTP, session: Session, envelope: Envelope
+        ) -> str:
+            if b"Subject: reject" in cast(bytes, envelope.original_content):
+                return "554 Error: rejected"
+
+            self.sessions.append(session)
+            return await super().handle_DATA(server, session, envelope)
+
+    async def generate_messages() -> AsyncIterator[EmailMessage]:
+        for subject in ("accept", "reject", "accept"):
+            message = deepcopy(sample_message)
+            message["Subject"] = subject
+            yield message
+
+    handler = RejectingHandler()
+    async with run_smtp_server(free_tcp_port, handler, server_tls_context):
+        results = [result async for result in mailer.deliver_iter(generate_messages())]
+
+    assert [result.error is None for result in results] == [True, False, True]
+    assert isinstance(results[1].error, DeliveryError)
+    assert results[1].error.args[1] is results[1].message
+    assert "Error: rejected" in str(results[1].error)
+    assert len(handler.messages) == 2
+    assert handler.sessions[0] is handler.sessions[1]
+
+
+async def test_deliver_lanes(
+    sample_message: EmailMessage,
+    free_tcp_port: int,
+    client_tls_context: ssl.SSLContext,
+) -> None:
+    """
+    Test that a delivery on one lane does not have to wait for a stalled delivery on
+    another lane to finish.
+
+    """
+
+    class StallingHandler(MessageHandler):
+        def __init__(self) -> None:
+            super().__init__()
+            self.stalled = Event()
+            self.release = Event()
+
+        async def handle_DATA(
+            self, server: SMTP, session: Session, envelope: Envelope
+        ) -> str:
+            if b"Subject: bulk" in cast(bytes, envelope.original_content):
+                self.stalled.set()
+                await self.release.wait()
+
+            return await super().handle_DATA(server, session, envelope)
+
+    bulk_message = deepcopy(sample_message)
+    bulk_message["Subject"] = "bulk"
+    urgent_message = deepcopy(sample_message)
+    urgent_message["Subject"] = "urgent"
+    mailer = SMTPMailer(
+        port=free_tcp_port,
+        timeout=5,
+        tls_context=client_tls_context,
+        lanes={"default": 1, "urgent": 1},
+    )
+    handler = StallingHandler()
+    async with Context(), run_smtp_server(free_tcp_port, handler):
+        await mailer.start()
+        bulk_task = create_task(mailer.deliver(bulk_message))
+        await wait_for(handler.stalled.wait(), 5)
+        await wait_for(mailer.deliver(urgent_message, lane="urgent"), 1)
+        assert [message["Subject"] for message in handler.messages] == ["urgent"]
+
+        handler.release.set()
+        await bulk_task
+
+    assert [message["Subject"] for message in handler.messages] == [
+        "urgent",
+        "bulk",
+    ]
+
+
+async def test_deliver_adaptive_concurrency(
+    sample_message: EmailMessage,
+    free_tcp_port: int,
+    client_tls_context: ssl.SSLContext,
+) -> None:
+    """
+    Test that the concurrency limit of a lane is lowered by transient errors and raised
+    by successful deliveries.
+
+    """
+
+    class ThrottlingHandler(MessageHandler):
+        async def handle_DATA(
+            self, server: SMTP, session: Session, envelope: Envelope
+        ) -> str:
+            if b"Subject: throttle" in cast(bytes, envelope.original_content):
+                return "451 4.7.1 Rate limit exceeded"
+            elif b"Subject: reject" in cast(bytes, envelope.original_content):
+                return "554 Error: rejected"
+
+            return await super().handle_DATA(server, session, envelope)
+
+    messages = {}
+    for subject in ("throttle", "reject", "accept"):
+        messages[subject] = deepcopy(sample_message)
+        messages[subject]["Subject"] = subject
+
+    mailer = SMTPMailer(
+        port=free_tcp_port,
+        timeout=5,
+        tls_context=client_tls_context,
+        lanes={"default": 4, "bulk": 2},
+        concurrency={"initial_limit": 4, "max_limit": 3, "latency_tolerance": None},
+    )
+    assert mailer.limiters["default"].limit == 3
+    assert mailer.limiters["bulk"].max_limit == 2
+    limiter = mailer.limiters["default"]
+    handler = ThrottlingHandler()
+    async with Context(), run_smtp_server(free_tcp_port, handler):
+        await mailer.start()
+        with pytest.raises(DeliveryError, match="Rate limit exceeded"):
+            await mailer.deliver(messages["throttle"])
+
+        assert limiter.limit == 1
+        with pytest.raises(DeliveryError, match="rejected"):
+            await mailer.deliver(messages["reject"])
+
+        assert limiter.limit == 2
+        await gather(*[mailer.deliver(messages["accept"]) for _ in range(3)])
+
+    assert limiter.limit == 3
+    assert limiter.in_flight == 0
+    assert mailer.limiters["bulk"].limit == 2
+
+
+async def test_deliver_timeout(
+    sample_message: EmailMessage,
+    free_tcp_port: int,
+    client_tls_context: ssl.SSLContext,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """
+    Test that delivery_timeout bounds the whole call, cutting short a stalled upload
+    and failing the rest of the messages right away, without even serializing them.
+
+    """
+
+    class StallingHandler(MessageHandler):
+        async def handle_DATA(
+            self, server: SMTP, session: Session, envelope: Envelope
+        ) -> str:
+            await Event().wait()
+            raise AssertionError("not reached")
+
+    mailer = SMTPMailer(
+        port=free_tcp_port,
+        timeout=5,
+        delivery_timeout=0.3,
+        tls_context=client_tls_context,
+        concurrency={"latency_tolerance": None},
+    )
+    signed: list[bytes] = []
+
+    async def sign_message(data: bytes) -> bytes:
+        signed.append(data)
+        return data
+
+    monkeypatch.setattr(mailer, "sign_message", sign_message)
+    limit = mailer.limiters["default"].limit
+    async with Context(), run_smtp_server(free_tcp_port, StallingHandler()):
+        await mailer.start()
+        started = time.monotonic()
+        messages = [sample_message, deepcopy(sample_message)]
+        results = [result async for result in mailer.deliver_iter(messages)]
+
+    assert time.monotonic() - started < 1
+    assert [str(result.error) for result in results] == [
+        "error sending mail message: Timed out waiting for server response",
+        "error sending mail message: delivery deadline exceeded",
+    ]
+    assert len(signed) == 1
+
+    # Timeouts caused by the deadline don't count as a sign of overload
+    assert mailer.limiters["default"].limit == limit
+
+
+async def test_deliver_deadline_waiting(
+    sample_message: EmailMessage,
+    free_tcp_port: int,
+    client_tls_context: ssl.SSLContext,
+) -> None:
+    """Test that the deadline also applies to waiting for a free connection."""
+
+    class StallingHandler(MessageHandler):
+        def __init__(self) -> None:
+            super().__init__()
+            self.stalled = Event()
+            self.release = Event()
+
+        async def handle_DATA(
+            self, server: SMTP, session: Session, envelope: Envelope
+        ) -> str:
+            self.stalled.set()
+            await self.release.wait()
+            return await super().handle_DATA(server, session, envelope)
+
+    mailer = SMTPMailer(port=free_tcp_port, timeout=5, tls_context=client_tls_context)
+    handler = StallingHandler()
+    async with Context(), run_smtp_server(free_tcp_port, handler):
+        await mailer.start()
+        task = create_task(mailer.deliver(sample_message))
+        await wait_for(handler.stalled.wait(), 5)
+        with pytest.raises(DeliveryError, match="delivery deadline exceeded"):
+            await mailer.deliver(sample_message, deadline=time.monotonic() + 0.1)
+
+        handler.release.set()
+        await task
+
+    assert len(handler.messages) == 1
+
+
+async def test_deliver_shared_connections(
+    sample_message: EmailMessage,
+    free_tcp_port: int,
+    client_tls_context: ssl.SSLContext,
+) -> None:
+    """
+    Test that a mailer with connections_from delivers its own messages over the
+    connections of the other mailer.
+
+    """
+
+    class StallingHandler(MessageHandler):
+        def __init__(self) -> None:
+            super().__init__()
+            self.stalled = Event()
+            self.release = Event()
+
+        async def handle_DATA(
+            self, server: SMTP, session: Session, envelope: Envelope
+        ) -> str:
+            if b"Subject: stall" in cast(bytes, envelope.original_content):
+                self.stalled.set()
+                await self.release.wait()
+
+            return await super().handle_DATA(server, session, envelope)
+
+    relay = SMTPMailer(port=free_tcp_port, timeout=5, tls_context=client_tls_context)
+    tenant = SMTPMailer(
+        connections_from="relay",
+        command_timeout=1,
+        chunk_size=100,
+        message_defaults={"sender": "tenant@example.org"},
+    )
+    stalled_message = deepcopy(sample_message)
+    stalled_message["Subject"] = "stall"
+    handler = StallingHandler()
+    async with Context() as ctx, run_smtp_server(free_tcp_port, handler):
+        await relay.start()
+        ctx.add_resource(relay, "relay", types=[Mailer, SMTPMailer])
+        await tenant.start()
+        assert tenant.connections_from is relay
+        assert tenant.command_timeout == 5
+        assert tenant.chunk_size == relay.chunk_size
+        assert repr(tenant) == f"SMTPMailer(host='localhost', port={free_tcp_port})"
+
+        # The only connection is taken by the stalled delivery
+        task = create_task(relay.deliver(stalled_message))
+        await wait_for(handler.stalled.wait(), 5)
+        with pytest.raises(DeliveryError, match="delivery deadline exceeded"):
+            await tenant.deliver(
+                tenant.create_message(subject="tenant", to="someone@example.org"),
+                deadline=time.monotonic() + 0.1,
+            )
+
+        handler.release.set()
+        await task
+        await tenant.create_and_deliver(subject="tenant", to="someone@example.org")
+
+    assert [message["From"] for message in handler.messages] == [
+        "foo@bar.baz",
+        "tenant@example.org",
+    ]
+
+
+async def test_deliver_nonexistent_lane(
+    mailer: SMTPMailer, sample_message: EmailMessage
+) -> None:
+    with pytest.raises(ValueError, match="no such lane: 'foo'"):
+        await mailer.deliver(sample_message, lane="foo")
 
 
 async def test_deliver_connect_error(
     mailer: SMTPMailer, sample_message: EmailMessage, free_tcp_port: int
 ) -> None:
-    mailer._smtp.port = free_tcp_port + 1
     with pytest.raises(DeliveryError) as exc:
         await mailer.deliver(sample_message)
 
-    exc.match(f"Error connecting to localhost on port {mailer._smtp.port}")
+    exc.match(f"Error connecting to localhost on port {free_tcp_port}")
 
 
 async def test_deliver_error(
-    mailer: SMTPMailer, sample_message: EmailMessage, free_tcp_port: int
+    mailer: SMTPMailer,
+    sample_message: EmailMessage,
+    free_tcp_port: int,
+    server_tls_context: ssl.SSLContext,
 ) -> None:
     """
     Test that SMTP errors during message delivery get converted into DeliveryErrors.
@@ -155,12 +907,37 @@ async def test_deliver_error(
         ) -> str:
             return "503 Error: foo"
 
-    async with run_smtp_server(free_tcp_port, BadHandler()):
+    async with run_smtp_server(free_tcp_port, BadHandler(), server_tls_context):
         with pytest.raises(DeliveryError) as exc:
             await mailer.deliver(sample_message)
 
     exc.match("Error: foo")
 
 
+async def test_deliver_quit_rejected(
+    sample_message: EmailMessage, free_tcp_port: int
+) -> None:
+    """
+    Test that a server rejecting QUIT neither fails a delivery it already accepted nor
+    costs the lane its connection.
+
+    """
+
+    class QuitRejectingHandler(MessageHandler):
+        async def handle_QUIT(
+            self, server: SMTP, session: Session, envelope: Envelope
+        ) -> str:
+            return "554 5.0.0 No"
+
+    mailer = SMTPMailer(port=free_tcp_port, timeout=1)
+    handler = QuitRejectingHandler()
+    async with Context(), run_smtp_server(free_tcp_port, handler):
+        await mailer.start()
+        await mailer.deliver(sample_message)
+        await wait_for(mailer.deliver(sample_message), 5)
+
+    assert len(handler.messages) == 2
+
+
 def test_repr(mailer: SMTPMailer, free_tcp_port: int) -> None:
     assert repr(mailer) == f"SMTPMailer(host='localhost', port={free_tcp_port})"
@@ -1,12 +1,13 @@
 from __future__ import annotations
 
-from collections.abc import Iterable, Iterator
+from collections.abc import AsyncIterator, Iterator
 from email.headerregistry import Address
 from email.message import EmailMessage
 from typing import Any, cast
 
 import pytest
-from asphalt.mailer.api import Mailer
+from asphalt.mailer.api import DeliveryError, DeliveryResult, Mailer, MessagesType
+from asphalt.mailer.utils import iterate_messages
 
 pytestmark = pytest.mark.anyio
 
@@ -16,9 +17,12 @@ class DummyMailer(Mailer):
         super().__init__(message_defaults)
         self.messages: list[EmailMessage] = []
 
-    async def deliver(self, messages: EmailMessage | Iterable[EmailMessage]) -> None:
-        messages = [messages] if isinstance(messages, EmailMessage) else messages
-        self.messages.extend(messages)
+    async def deliver(self, messages: MessagesType) -> None:
+        async for message in iterate_messages(messages):
+            if message["Subject"] == "fail":
+                raise DeliveryError("failed", message)
+
+            self.messages.append(message)
 
 
 @pytest.fixture
@@ -86,6 +90,22 @@ def test_create_message(
         assert html_part.get_content() == "<html><body>Hello åäö</body></html>\n"
 
 
+@pytest.mark.parametrize(
+    "supports_8bit, expected_cte",
+    [
+        pytest.param(True, "8bit", id="8bit"),
+        pytest.param(False, "quoted-printable", id="7bit"),
+    ],
+)
+def test_create_message_cte(
+    mailer: DummyMailer, supports_8bit: bool, expected_cte: str
+) -> None:
+    mailer.supports_8bit = supports_8bit
+    msg = mailer.create_message(plain_body="Hello wörld, how are you? " * 10)
+    assert msg["Content-Transfer-Encoding"] == expected_cte
+    assert msg.get_content() == "Hello wörld, how are you? " * 10 + "\n"
+
+
 def test_message_defaults() -> None:
     """
     Test that message defaults are applied when the corresponding arguments have been
@@ -144,3 +164,20 @@ async def test_create_and_deliver(mailer: DummyMailer, kwargs: dict[str, Any]) -
     assert len(mailer.messages) == 1
     assert isinstance(mailer.messages[0], EmailMessage)
     assert mailer.messages[0]["From"] == "foo@bar.baz"
+
+
+async def test_deliver_iter(mailer: DummyMailer) -> None:
+    async def generate_messages() -> AsyncIterator[EmailMessage]:
+        for subject in ("first", "fail", "last"):
+            yield mailer.create_message(subject=subject)
+
+    results = [result async for result in mailer.deliver_iter(generate_messages())]
+    assert [result.message["Subject"] for result in results] == [
+        "first",
+        "fail",
+        "last",
+    ]
+    assert results[0] == DeliveryResult(mailer.messages[0])
+    assert isinstance(results[1].error, DeliveryError)
+    assert results[1].error.args[1] is results[1].message
+    assert results[2] == DeliveryResult(mailer.messages[1])
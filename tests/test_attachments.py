@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import threading
+from email import policy
+from pathlib import Path
+from typing import Any, NoReturn
+
+import pytest
+from asphalt.mailer.attachments import AttachmentLoader
+from asphalt.mailer.mailers.mock import MockMailer
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def files(tmp_path: Path) -> list[Path]:
+    paths = [tmp_path / "a.txt", tmp_path / "b.bin", tmp_path / "c.pdf"]
+    for size, path in enumerate(paths, start=1):
+        path.write_bytes(b"x" * size * 100)
+
+    return paths
+
+
+async def test_load(files: list[Path], monkeypatch: pytest.MonkeyPatch) -> None:
+    thread_names: set[str] = set()
+    load = AttachmentLoader._load
+
+    def _load(self: AttachmentLoader, *args: Any) -> Any:
+        thread_names.add(threading.current_thread().name)
+        return load(self, *args)
+
+    monkeypatch.setattr(AttachmentLoader, "_load", _load)
+    loader = AttachmentLoader(2, max_file_size=300, max_total_size=600)
+    parts = await loader.load(files, policy.default)
+    await loader.close()
+
+    assert [part.get_filename() for part in parts] == ["a.txt", "b.bin", "c.pdf"]
+    assert [part.get_content_type() for part in parts] == [
+        "text/plain",
+        "application/octet-stream",
+        "application/pdf",
+    ]
+    assert parts[2].get_content() == b"x" * 300
+    assert thread_names
+    assert all(name.startswith("asphalt-mailer-attachments") for name in thread_names)
+
+
+@pytest.mark.parametrize(
+    "kwargs, message",
+    [
+        pytest.param(
+            {"max_file_size": 299},
+            r"c\.pdf is larger than the maximum attachment size \(299 bytes\)",
+            id="file",
+        ),
+        pytest.param(
+            {"max_total_size": 599},
+            r"the attachments are larger than the maximum total size \(599 bytes\)",
+            id="total",
+        ),
+    ],
+)
+async def test_too_large(
+    files: list[Path],
+    monkeypatch: pytest.MonkeyPatch,
+    kwargs: dict[str, Any],
+    message: str,
+) -> None:
+    """Test that oversized files are rejected before any of the files are read."""
+
+    def _load(*args: Any) -> NoReturn:
+        pytest.fail("A file was read")
+
+    monkeypatch.setattr(AttachmentLoader, "_load", _load)
+    loader = AttachmentLoader(**kwargs)
+    with pytest.raises(ValueError, match=message):
+        await loader.load(files, policy.default)
+
+    await loader.close()
+
+
+async def test_file_grown(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that a file growing past the limit after its size was checked is caught."""
+    path = tmp_path / "growing.log"
+    path.write_bytes(b"x" * 100)
+    load = AttachmentLoader._load
+
+    def _load(self: AttachmentLoader, *args: Any) -> Any:
+        path.write_bytes(b"x" * 1000)
+        return load(self, *args)
+
+    monkeypatch.setattr(AttachmentLoader, "_load", _load)
+    loader = AttachmentLoader(max_file_size=500)
+    with pytest.raises(ValueError, match="is larger than the maximum attachment size"):
+        await loader.load([path], policy.default)
+
+    await loader.close()
+
+
+async def test_add_file_attachments(files: list[Path]) -> None:
+    mailer = MockMailer()
+    message = mailer.create_message(subject="foo", plain_body="Hello")
+    size = len(message.as_bytes())
+    await mailer.add_file_attachments(message, files)
+    assert mailer.attachment_loader is None
+    await mailer.deliver(message)
+
+    attachments = list(mailer.messages[0].iter_attachments())
+    assert [attachment.get_filename() for attachment in attachments] == [
+        "a.txt",
+        "b.bin",
+        "c.pdf",
+    ]
+    assert attachments[0]["Content-Disposition"] == 'attachment; filename="a.txt"'
+    assert attachments[1].get_content() == b"x" * 200
+    assert mailer.messages[0].get_content_type() == "multipart/mixed"
+    assert len(message.as_bytes()) > size + 600
+
+
+async def test_add_file_attachments_too_large(files: list[Path]) -> None:
+    mailer = MockMailer()
+    mailer.attachment_loader = AttachmentLoader(max_total_size=500)
+    message = mailer.create_message(subject="foo", plain_body="Hello")
+    with pytest.raises(ValueError):
+        await mailer.add_file_attachments(message, files)
+
+    await mailer.attachment_loader.close()
+    assert not message.is_multipart()
+
+
+@pytest.mark.parametrize(
+    "kwargs, message",
+    [
+        pytest.param(
+            {"max_workers": 0}, "max_workers must be at least 1", id="max_workers"
+        ),
+        pytest.param(
+            {"max_file_size": 0}, "max_file_size must be at least 1", id="file_size"
+        ),
+        pytest.param(
+            {"max_total_size": 0},
+            "max_total_size must be at least 1",
+            id="total_size",
+        ),
+    ],
+)
+def test_bad_arguments(kwargs: dict[str, Any], message: str) -> None:
+    with pytest.raises(ValueError, match=message):
+        AttachmentLoader(**kwargs)
+
+
+def test_repr() -> None:
+    assert repr(AttachmentLoader()) == "AttachmentLoader(max_workers=4)"
@@ -1,18 +1,33 @@
 from __future__ import annotations
 
 import logging
+from pathlib import Path
 
 import pytest
 from asphalt.core import qualified_name
 from asphalt.core.context import Context
 from asphalt.mailer.api import Mailer
+from asphalt.mailer.attachments import AttachmentLoader
 from asphalt.mailer.component import MailerComponent
+from asphalt.mailer.concurrency import ByteBudget
+from asphalt.mailer.dkim import DKIMSigner
+from asphalt.mailer.idempotency import IdempotencyCache
+from asphalt.mailer.journal import DeliveryJournal, read_journal
+from asphalt.mailer.mailers.smtp import SMTPMailer
+from asphalt.mailer.scheduler import DeliveryScheduler
+from asphalt.mailer.tracing import Tracer
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from cryptography.hazmat.primitives.serialization import (
+    Encoding,
+    NoEncryption,
+    PrivateFormat,
+)
 from pytest import LogCaptureFixture
 
 pytestmark = pytest.mark.anyio
 
 
-@pytest.mark.parametrize("backend", ["smtp", "sendmail", "mock"])
+@pytest.mark.parametrize("backend", ["smtp", "lmtp", "mx", "sendmail", "mock"])
 async def test_component(caplog: LogCaptureFixture, backend: str) -> None:
     caplog.set_level(logging.INFO, logger="asphalt.mailer.component")
     component = MailerComponent(backend=backend)
@@ -28,3 +43,140 @@ async def test_component(caplog: LogCaptureFixture, backend: str) -> None:
     assert records[0].message == (
         f"Configured mailer (default; class={qualified_name(mailer)})"
     )
+
+
+async def test_component_dkim(tmp_path: Path) -> None:
+    key_path = tmp_path / "dkim.pem"
+    key_path.write_bytes(
+        Ed25519PrivateKey.generate().private_bytes(
+            Encoding.PEM, PrivateFormat.PKCS8, NoEncryption()
+        )
+    )
+    component = MailerComponent(
+        backend="mock",
+        dkim={"domain": "example.org", "selector": "test", "private_key": key_path},
+    )
+    assert isinstance(component.mailer.dkim_signer, DKIMSigner)
+    assert component.mailer.dkim_signer.domain == "example.org"
+
+
+async def test_component_idempotency(tmp_path: Path) -> None:
+    component = MailerComponent(
+        backend="mock", idempotency={"ttl": 60, "path": tmp_path / "keys.jsonl"}
+    )
+    cache = component.mailer.idempotency_cache
+    assert isinstance(cache, IdempotencyCache)
+    assert cache.ttl == 60
+    async with Context() as ctx:
+        await component.start(ctx)
+        assert cache.claim("foo")
+
+    # The key was written when the context was torn down
+    assert '"foo"' in (tmp_path / "keys.jsonl").read_text()
+
+
+async def test_component_scheduler(tmp_path: Path) -> None:
+    component = MailerComponent(
+        backend="mock", scheduler={"release_rate": 10, "path": tmp_path / "scheduled"}
+    )
+    scheduler = component.mailer.scheduler
+    assert isinstance(scheduler, DeliveryScheduler)
+    assert scheduler.release_rate == 10
+    async with Context() as ctx:
+        await component.start(ctx)
+        assert scheduler._task is not None
+
+    assert scheduler._task is None
+    assert scheduler._file is None
+
+
+async def test_component_default_scheduler() -> None:
+    component = MailerComponent(backend="mock")
+    scheduler = component.mailer.scheduler
+    assert isinstance(scheduler, DeliveryScheduler)
+    async with Context() as ctx:
+        await component.start(ctx)
+        assert scheduler._task is not None
+
+    assert scheduler._task is None
+
+
+async def test_component_journal(tmp_path: Path) -> None:
+    path = tmp_path / "mail.journal"
+    component = MailerComponent(backend="mock", journal={"path": path})
+    journal = component.mailer.journal
+    assert isinstance(journal, DeliveryJournal)
+    async with Context() as ctx:
+        await component.start(ctx)
+        await component.mailer.create_and_deliver(
+            subject="foo", sender="a@b.c", to="d@e.f"
+        )
+
+    assert [entry.recipients for entry in read_journal(path)] == [["d@e.f"]]
+
+
+async def test_component_byte_budget() -> None:
+    component = MailerComponent(backend="mock", byte_budget=1000000)
+    other = MailerComponent(
+        backend="mock", resource_name="other", byte_budget="default"
+    )
+    async with Context() as ctx:
+        await component.start(ctx)
+        await other.start(ctx)
+        budget = ctx.require_resource(ByteBudget)
+        assert budget.max_bytes == 1000000
+        assert component.mailer.byte_budget is budget
+        assert other.mailer.byte_budget is budget
+
+
+async def test_component_shared_connections() -> None:
+    relay = MailerComponent(
+        backend="smtp", resource_name="relay", host="relay.example.org"
+    )
+    tenant = MailerComponent(
+        backend="smtp",
+        resource_name="tenant",
+        connections_from="relay",
+        message_defaults={"sender": "tenant@example.org"},
+    )
+    async with Context() as ctx:
+        await relay.start(ctx)
+        await tenant.start(ctx)
+        mailer = ctx.require_resource(Mailer, "tenant")  # type: ignore[type-abstract]
+        assert isinstance(mailer, SMTPMailer)
+        assert mailer.connections_from is relay.mailer
+        assert mailer.host == "relay.example.org"
+        assert mailer.message_defaults["sender"] == "tenant@example.org"
+
+
+async def test_component_tracing() -> None:
+    component = MailerComponent(backend="mock", tracing={"sample_rate": 0.5})
+    assert isinstance(component.mailer.tracer, Tracer)
+    assert component.mailer.tracer.sample_rate == 0.5
+    async with Context() as ctx:
+        await component.start(ctx)
+
+
+async def test_component_default_attachment_loader() -> None:
+    component = MailerComponent(backend="mock")
+    loader = component.mailer.attachment_loader
+    assert isinstance(loader, AttachmentLoader)
+    assert loader.max_workers == 4
+    async with Context() as ctx:
+        await component.start(ctx)
+        message = component.mailer.create_message(subject="foo", plain_body="Hello")
+        await component.mailer.add_file_attachments(message, [__file__])
+        assert loader._executor is not None
+
+    assert loader._executor is None
+
+
+async def test_component_attachment_loader() -> None:
+    component = MailerComponent(
+        backend="mock", attachment_loader={"max_workers": 2, "max_file_size": 1000}
+    )
+    assert isinstance(component.mailer.attachment_loader, AttachmentLoader)
+    assert component.mailer.attachment_loader.max_workers == 2
+    assert component.mailer.attachment_loader.max_file_size == 1000
+    async with Context() as ctx:
+        await component.start(ctx)
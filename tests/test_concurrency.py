@@ -0,0 +1,214 @@
+from __future__ import annotations
+
+from asyncio import CancelledError, create_task, sleep, wait_for
+
+import pytest
+from asphalt.mailer.concurrency import AdaptiveLimiter, ByteBudget
+from conftest import FakeClock
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_acquire() -> None:
+    limiter = AdaptiveLimiter(initial_limit=2)
+    await limiter.acquire()
+    async with limiter:
+        assert limiter.in_flight == 2
+        task = create_task(limiter.acquire())
+        await sleep(0)
+        assert not task.done()
+
+        limiter.release()
+        await wait_for(task, 1)
+
+    assert limiter.in_flight == 1
+
+
+async def test_acquire_cancel() -> None:
+    limiter = AdaptiveLimiter(initial_limit=1)
+    await limiter.acquire()
+    task1 = create_task(limiter.acquire())
+    task2 = create_task(limiter.acquire())
+    await sleep(0)
+    task1.cancel()
+    await sleep(0)
+
+    limiter.release()
+    await wait_for(task2, 1)
+    assert limiter.in_flight == 1
+
+
+async def test_acquire_cancel_during_release() -> None:
+    """Test that a waiter cancelled right before a release still raises cancellation."""
+    limiter = AdaptiveLimiter(initial_limit=1)
+    await limiter.acquire()
+    task = create_task(limiter.acquire())
+    await sleep(0)
+    task.cancel()
+    limiter.release()
+    with pytest.raises(CancelledError):
+        await task
+
+    assert limiter.in_flight == 0
+    await wait_for(limiter.acquire(), 1)
+    assert limiter.in_flight == 1
+
+
+def test_additive_increase(clock: FakeClock) -> None:
+    limiter = AdaptiveLimiter(initial_limit=2, max_limit=4)
+    for _ in range(3):
+        limiter.record(clock.now - 0.1)
+
+    assert limiter.limit == 3
+    for _ in range(3):
+        limiter.record(clock.now - 0.1)
+
+    assert limiter.limit == 4
+    for _ in range(10):
+        limiter.record(clock.now - 0.1)
+
+    assert limiter.limit == 4
+    assert limiter.latency == pytest.approx(0.1)
+
+
+def test_multiplicative_decrease(clock: FakeClock) -> None:
+    limiter = AdaptiveLimiter(initial_limit=16, min_limit=3)
+    started = clock.now
+    clock.now += 1
+    limiter.record(started, overloaded=True)
+    assert limiter.limit == 8
+
+    # Deliveries started before the decrease don't decrease the limit again
+    limiter.record(started, overloaded=True)
+    assert limiter.limit == 8
+
+    limiter.record(clock.now + 0.1, overloaded=True)
+    assert limiter.limit == 4
+    clock.now += 1
+    limiter.record(clock.now - 0.1, overloaded=True)
+    assert limiter.limit == 3
+
+
+def test_latency_decrease(clock: FakeClock) -> None:
+    limiter = AdaptiveLimiter(initial_limit=10, max_limit=10, latency_tolerance=2)
+    for _ in range(5):
+        limiter.record(clock.now - 0.1)
+
+    # The smoothed latency rises above twice the lowest latency
+    for _ in range(10):
+        limiter.record(clock.now - 1)
+        if limiter.limit < 10:
+            break
+
+    assert limiter.limit == 5
+
+
+def test_latency_ignored(clock: FakeClock) -> None:
+    limiter = AdaptiveLimiter(initial_limit=1, max_limit=2, latency_tolerance=None)
+    limiter.record(clock.now - 0.1)
+    limiter.record(clock.now - 10)
+    assert limiter.limit == 2
+
+
+@pytest.mark.parametrize(
+    "kwargs, message",
+    [
+        pytest.param({"min_limit": 0}, "min_limit must be at least 1", id="min"),
+        pytest.param(
+            {"min_limit": 5, "max_limit": 4},
+            "max_limit must not be lower than min_limit",
+            id="max",
+        ),
+        pytest.param({"backoff": 1}, "backoff must be between 0 and 1", id="backoff"),
+    ],
+)
+def test_bad_arguments(kwargs: dict[str, int], message: str) -> None:
+    with pytest.raises(ValueError, match=message):
+        AdaptiveLimiter(**kwargs)
+
+
+def test_repr() -> None:
+    assert repr(AdaptiveLimiter()) == "AdaptiveLimiter(limit=4, in_flight=0)"
+
+
+async def test_byte_budget() -> None:
+    budget = ByteBudget(100)
+    assert await budget.acquire(60) == 60
+    async with budget.reserve(40):
+        assert budget.in_use == 100
+        task = create_task(budget.acquire(10))
+        await sleep(0)
+        assert not task.done()
+
+    assert await wait_for(task, 1) == 10
+    budget.release(60)
+    budget.release(10)
+    assert budget.in_use == 0
+
+
+async def test_byte_budget_oversized() -> None:
+    """Test that a message larger than the whole budget can still be delivered."""
+    budget = ByteBudget(100)
+    async with budget.reserve(1000):
+        assert budget.in_use == 100
+
+    assert budget.in_use == 0
+
+
+async def test_byte_budget_small_first(clock: FakeClock) -> None:
+    """Test that small reservations can get past a large one waiting for room."""
+    budget = ByteBudget(100)
+    await budget.acquire(50)
+    large = create_task(budget.acquire(80))
+    await sleep(0)
+    assert await wait_for(budget.acquire(30), 1) == 30
+    assert not large.done()
+
+    budget.release(50)
+    budget.release(30)
+    await wait_for(large, 1)
+    assert budget.in_use == 80
+
+
+async def test_byte_budget_starvation(clock: FakeClock) -> None:
+    """
+    Test that once a large reservation has waited long enough, it's not passed anymore.
+    """
+    budget = ByteBudget(100, starvation_timeout=1)
+    await budget.acquire(50)
+    large = create_task(budget.acquire(80))
+    await sleep(0)
+    clock.now += 1
+    small = create_task(budget.acquire(10))
+    await sleep(0)
+    assert not small.done()
+
+    budget.release(50)
+    await wait_for(large, 1)
+    await wait_for(small, 1)
+    assert budget.in_use == 90
+
+
+async def test_byte_budget_cancel(clock: FakeClock) -> None:
+    budget = ByteBudget(100, starvation_timeout=1)
+    await budget.acquire(50)
+    large = create_task(budget.acquire(80))
+    await sleep(0)
+    clock.now += 1
+    small = create_task(budget.acquire(40))
+    await sleep(0)
+    assert not small.done()
+
+    # Once the large one gives up, the small one fits
+    large.cancel()
+    await wait_for(small, 1)
+    assert budget.in_use == 90
+
+
+def test_byte_budget_bad_max_bytes() -> None:
+    with pytest.raises(ValueError, match="max_bytes must be at least 1"):
+        ByteBudget(0)
+
+
+def test_byte_budget_repr() -> None:
+    assert repr(ByteBudget(100)) == "ByteBudget(max_bytes=100, in_use=0)"
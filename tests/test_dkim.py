@@ -0,0 +1,201 @@
+from __future__ import annotations
+
+import re
+from base64 import b64decode, b64encode
+from hashlib import sha256
+from pathlib import Path
+from typing import Any, Union
+
+import pytest
+from asphalt.mailer import dkim
+from asphalt.mailer.dkim import DKIMSigner
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, padding, rsa
+
+PrivateKey = Union[rsa.RSAPrivateKey, ed25519.Ed25519PrivateKey]
+
+# The example message from RFC 8463, appendix A
+MESSAGE = (
+    b"From: Joe SixPack <joe@football.example.com>\r\n"
+    b"To: Suzie Q <suzie@shopping.example.net>\r\n"
+    b"Subject: Is dinner ready?\r\n"
+    b"Date: Fri, 11 Jul 2003 21:00:37 -0700 (PDT)\r\n"
+    b"Message-ID: <20030712040037.46341.5F8J@football.example.com>\r\n"
+    b"\r\n"
+    b"Hi.\r\n"
+    b"\r\n"
+    b"We lost the game.  Are you hungry yet?\r\n"
+    b"\r\n"
+    b"Joe.\r\n"
+)
+BODY_HASH = "2jUSOH9NhtVGCQWNr9BrIAPreKQjO6Sn7XIkfJVOzv8="
+
+
+def to_pem(key: Any) -> bytes:
+    return key.private_bytes(  # type: ignore[no-any-return]
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+
+
+@pytest.fixture(
+    scope="module",
+    params=[pytest.param("rsa", id="rsa"), pytest.param("ed25519", id="ed25519")],
+)
+def private_key(request: pytest.FixtureRequest) -> PrivateKey:
+    if request.param == "rsa":
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    else:
+        return ed25519.Ed25519PrivateKey.generate()
+
+
+def verify(data: bytes, private_key: PrivateKey) -> dict[str, str]:
+    """Verify the topmost DKIM signature of the message."""
+    header_block, _, body = data.partition(b"\r\n\r\n")
+    fields = re.split(rb"\r\n(?=[^ \t])", header_block)
+    name, _, value = fields[0].partition(b":")
+    assert name == b"DKIM-Signature"
+    unfolded = re.sub(rb"\r\n", b"", value).decode()
+    tags = dict(tag.strip().split("=", 1) for tag in unfolded.split(";"))
+
+    def canonicalize(field: bytes) -> bytes:
+        name, _, value = field.partition(b":")
+        value = re.sub(rb"[ \t]+", b" ", value.replace(b"\r\n", b"")).strip()
+        return name.strip().lower() + b":" + value
+
+    remaining = fields[1:]
+    signed = b""
+    for header in tags["h"].split(":"):
+        for index in range(len(remaining) - 1, -1, -1):
+            if remaining[index].split(b":")[0].strip().lower() == header.encode():
+                signed += canonicalize(remaining.pop(index)) + b"\r\n"
+                break
+
+    signed += canonicalize(re.sub(rb"b=[^;]*$", b"b=", fields[0]))
+    signature = b64decode(re.sub(r"\s", "", tags["b"]))
+    public_key = private_key.public_key()
+    if isinstance(public_key, rsa.RSAPublicKey):
+        public_key.verify(signature, signed, padding.PKCS1v15(), hashes.SHA256())
+    else:
+        public_key.verify(signature, sha256(signed).digest())
+
+    return tags
+
+
+def test_sign(private_key: PrivateKey) -> None:
+    signer = DKIMSigner(
+        domain="football.example.com",
+        selector="brisbane",
+        private_key=to_pem(private_key),
+        identity="@football.example.com",
+    )
+    signed = signer.sign(MESSAGE, timestamp=1528637909)
+    assert signed.endswith(MESSAGE)
+    assert all(len(line) <= 78 for line in signed.split(b"\r\n"))
+
+    tags = verify(signed, private_key)
+    algorithm = (
+        "rsa-sha256" if isinstance(private_key, rsa.RSAPrivateKey) else "ed25519"
+    )
+    assert tags["a"].startswith(algorithm)
+    assert tags["c"] == "relaxed/relaxed"
+    assert tags["d"] == "football.example.com"
+    assert tags["i"] == "@football.example.com"
+    assert tags["s"] == "brisbane"
+    assert tags["t"] == "1528637909"
+    assert tags["h"] == "from:subject:date:to:message-id"
+    assert tags["bh"] == BODY_HASH
+
+
+def test_sign_relaxed(private_key: PrivateKey) -> None:
+    """Test that the signature survives whitespace changes and LF line endings."""
+    signer = DKIMSigner(
+        domain="example.com", selector="test", private_key=to_pem(private_key)
+    )
+    message = MESSAGE.replace(b"\r\n", b"\n").replace(
+        b"Subject: Is dinner ready?", b"Subject:  Is dinner\n\tready?  "
+    )
+    signed = signer.sign(message)
+    assert signed.endswith(message)
+    assert b"\r\n" not in signed
+
+    # Transmission converts the line endings and trailing whitespace may get lost
+    transmitted = signed.replace(b"\n", b"\r\n").replace(b"Joe.", b"Joe.   ")
+    assert verify(transmitted, private_key)["bh"] == BODY_HASH
+
+
+def test_sign_multiple_instances(private_key: PrivateKey) -> None:
+    signer = DKIMSigner(
+        domain="example.com",
+        selector="test",
+        private_key=to_pem(private_key),
+        headers=["From", "Received"],
+    )
+    message = b"Received: first\r\nReceived: second\r\n" + MESSAGE
+    tags = verify(signer.sign(message), private_key)
+    assert tags["h"] == "from:received:received"
+
+
+def test_body_hash_cache(monkeypatch: pytest.MonkeyPatch) -> None:
+    canonicalized: list[bytes] = []
+    canonicalize_body = dkim._canonicalize_body
+
+    def counting_canonicalize_body(body: bytes) -> bytes:
+        canonicalized.append(body)
+        return canonicalize_body(body)
+
+    monkeypatch.setattr(dkim, "_canonicalize_body", counting_canonicalize_body)
+    key = to_pem(ed25519.Ed25519PrivateKey.generate())
+    signer = DKIMSigner(
+        domain="example.com", selector="test", private_key=key, body_cache_size=1
+    )
+    signer.sign(MESSAGE)
+    signer.sign(MESSAGE.replace(b"Suzie Q", b"Suzie R"))
+    assert len(canonicalized) == 1
+
+    # Only a fixed size digest of the body is kept
+    assert [len(key) for key in signer._body_hashes] == [16]
+
+    # The cache only holds one body hash
+    signer.sign(MESSAGE.replace(b"Joe.", b"Jim."))
+    signer.sign(MESSAGE)
+    assert len(canonicalized) == 3
+
+
+def test_private_key_cache(tmp_path: Path) -> None:
+    key = to_pem(ed25519.Ed25519PrivateKey.generate())
+    key_path = tmp_path / "dkim.pem"
+    key_path.write_bytes(key)
+    signer1 = DKIMSigner(domain="example.com", selector="a", private_key=key.decode())
+    signer2 = DKIMSigner(domain="example.org", selector="b", private_key=key_path)
+    signer3 = DKIMSigner(domain="example.org", selector="b", private_key=str(key_path))
+    assert signer1._private_key is signer2._private_key is signer3._private_key
+
+
+def test_unsupported_key_type() -> None:
+    key = to_pem(ec.generate_private_key(ec.SECP256R1()))
+    with pytest.raises(ValueError, match="unsupported private key type"):
+        DKIMSigner(domain="example.com", selector="a", private_key=key)
+
+
+def test_from_not_signed() -> None:
+    key = to_pem(ed25519.Ed25519PrivateKey.generate())
+    with pytest.raises(ValueError, match="the From header must be signed"):
+        DKIMSigner(
+            domain="example.com", selector="a", private_key=key, headers=["Subject"]
+        )
+
+
+def test_empty_body_hash() -> None:
+    key = to_pem(ed25519.Ed25519PrivateKey.generate())
+    signer = DKIMSigner(domain="example.com", selector="a", private_key=key)
+    signed = signer.sign(b"From: foo@example.com\r\n\r\n")
+    empty_hash = b64encode(sha256(b"").digest())
+    assert b"bh=" + empty_hash + b";" in signed
+
+
+def test_repr() -> None:
+    key = to_pem(ed25519.Ed25519PrivateKey.generate())
+    signer = DKIMSigner(domain="example.com", selector="a", private_key=key)
+    assert repr(signer) == "DKIMSigner(domain='example.com', selector='a')"
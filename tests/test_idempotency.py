@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+import threading
+from asyncio import create_task, sleep
+from email.message import EmailMessage
+from pathlib import Path
+from typing import Any
+
+import pytest
+from asphalt.mailer.idempotency import (
+    IdempotencyCache,
+    get_idempotency_key,
+    set_idempotency_key,
+)
+from asphalt.mailer.mailers.mock import MockMailer
+from conftest import FakeClock
+
+
+def test_idempotency_key() -> None:
+    message = EmailMessage()
+    assert get_idempotency_key(message) is None
+    set_idempotency_key(message, "abc")
+    assert get_idempotency_key(message) == "abc"
+    assert "abc" not in message.as_string()
+
+
+def test_claim_release() -> None:
+    cache = IdempotencyCache()
+    assert cache.claim("a")
+    assert not cache.claim("a")
+    assert "a" in cache
+    assert "b" not in cache
+
+    cache.release("a")
+    assert "a" not in cache
+    assert cache.claim("a")
+
+
+@pytest.mark.parametrize("clock", ["time"], indirect=True)
+def test_ttl(clock: FakeClock) -> None:
+    cache = IdempotencyCache(ttl=10)
+    assert cache.claim("a")
+    clock.now += 5
+    assert cache.claim("b")
+    assert not cache.claim("a")
+
+    clock.now += 5
+    assert "a" not in cache
+    assert "b" in cache
+    assert len(cache) == 1
+    assert cache.claim("a")
+
+
+def test_max_size() -> None:
+    cache = IdempotencyCache(max_size=2)
+    for key in "abc":
+        assert cache.claim(key)
+
+    assert len(cache) == 2
+    assert "a" not in cache
+    assert not cache.claim("b")
+    assert not cache.claim("c")
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("clock", ["time"], indirect=True)
+async def test_persistence(tmp_path: Path, clock: FakeClock) -> None:
+    path = tmp_path / "keys" / "idempotency.jsonl"
+    cache = IdempotencyCache(ttl=10, path=path)
+    for key in ("a", "b", "c"):
+        assert cache.claim(key)
+        clock.now += 1
+
+    cache.release("b")
+    await cache.close()
+
+    # Simulate a crash in the middle of a write
+    with path.open("a") as f:
+        f.write('[1000020.0, "d')
+
+    clock.now += 7.5
+    cache = IdempotencyCache(ttl=10, path=path)
+    assert "a" not in cache
+    assert "b" not in cache
+    assert not cache.claim("c")
+    assert cache.claim("b")
+    await cache.close()
+
+    # The file was compacted on load
+    assert path.read_text().splitlines() == [
+        '[1000012.0, "c"]',
+        '[1000020.5, "b"]',
+    ]
+
+
+@pytest.mark.anyio
+async def test_persistence_compaction(tmp_path: Path) -> None:
+    path = tmp_path / "idempotency.jsonl"
+    cache = IdempotencyCache(max_size=2, path=path)
+    for key in "abcd":
+        cache.claim(key)
+
+    await cache.close()
+    assert [line.split('"')[1] for line in path.read_text().splitlines()] == [
+        "c",
+        "d",
+    ]
+
+
+@pytest.mark.anyio
+async def test_persistence_off_loop(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test that claimed keys are written in batches on a worker thread."""
+    path = tmp_path / "idempotency.jsonl"
+    cache = IdempotencyCache(path=path)
+    write_file = IdempotencyCache._write_file
+    writes: list[tuple[str, list[str]]] = []
+
+    def _write_file(self: IdempotencyCache, *args: Any) -> None:
+        writes.append((threading.current_thread().name, args[1]))
+        write_file(self, *args)
+
+    monkeypatch.setattr(IdempotencyCache, "_write_file", _write_file)
+    for key in "abc":
+        assert cache.claim(key)
+
+    assert not writes
+    await cache.close()
+    assert len(writes) == 1
+    assert writes[0][0] != threading.main_thread().name
+    assert [line.split('"')[1] for line in writes[0][1]] == ["a", "b", "c"]
+    assert len(path.read_text().splitlines()) == 3
+
+
+@pytest.mark.anyio
+async def test_wait_in_flight() -> None:
+    """
+    Test that a duplicate waits for the delivery in flight, and is only claimed if
+    that delivery fails.
+
+    """
+    mailer = MockMailer()
+    mailer.idempotency_cache = IdempotencyCache()
+    message = mailer.create_message(subject="foo", plain_body="Hello")
+    set_idempotency_key(message, "a")
+    assert await mailer.claim_message(message)
+
+    task = create_task(mailer.claim_message(message))
+    await sleep(0)
+    assert not task.done()
+    mailer.release_message(message)
+    assert await task
+
+    task = create_task(mailer.claim_message(message))
+    await sleep(0)
+    assert not task.done()
+    mailer.complete_message(message)
+    assert not await task
+    assert not await mailer.claim_message(message)
+
+
+def test_bad_max_size() -> None:
+    with pytest.raises(ValueError, match="max_size must be at least 1"):
+        IdempotencyCache(max_size=0)
+
+
+def test_repr() -> None:
+    assert repr(IdempotencyCache(max_size=5, ttl=60)) == (
+        "IdempotencyCache(max_size=5, ttl=60, path=None)"
+    )
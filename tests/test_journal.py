@@ -0,0 +1,224 @@
+from __future__ import annotations
+
+import json
+import time
+from asyncio import sleep
+from pathlib import Path
+
+import pytest
+from asphalt.mailer.api import DeliveryError
+from asphalt.mailer.journal import DeliveryJournal, JournalEntry, main, read_journal
+from asphalt.mailer.mailers.mock import MockMailer
+from conftest import create_message
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def path(tmp_path: Path) -> Path:
+    return tmp_path / "logs" / "mail.journal"
+
+
+async def test_record(path: Path) -> None:
+    journal = DeliveryJournal(path)
+    started = time.monotonic()
+    journal.record("SMTPMailer", "<1@bar.baz>", ["a@b.c"], started, 250, 1234)
+    journal.record(
+        "SMTPMailer", None, ["a@b.c", "d@e.f"], started, 451, None, "Try again later"
+    )
+
+    # Nothing is written until the batch is flushed
+    assert list(read_journal(path)) == []
+    await journal.close()
+
+    entries = list(read_journal(path))
+    assert len(entries) == 2
+    assert entries[0].backend == "SMTPMailer"
+    assert entries[0].message_id == "<1@bar.baz>"
+    assert entries[0].recipients == ["a@b.c"]
+    assert entries[0].status == 250
+    assert entries[0].size == 1234
+    assert entries[0].error is None
+    assert 0 <= entries[0].duration < 1
+    assert time.time() - 5 < entries[0].timestamp <= time.time()
+    assert entries[1] == JournalEntry(
+        entries[1].timestamp,
+        "SMTPMailer",
+        None,
+        ["a@b.c", "d@e.f"],
+        entries[1].duration,
+        451,
+        None,
+        "Try again later",
+    )
+
+    # Nothing gets recorded after the journal has been closed
+    journal.record("SMTPMailer", None, [], started)
+    assert len(list(read_journal(path))) == 2
+
+
+async def test_flush_interval(path: Path) -> None:
+    journal = DeliveryJournal(path, flush_interval=0.05)
+    journal.record("MockMailer", None, [], time.monotonic())
+    await sleep(0.2)
+    assert len(list(read_journal(path))) == 1
+    await journal.close()
+
+
+async def test_max_batch(path: Path) -> None:
+    journal = DeliveryJournal(path, flush_interval=60, max_batch=3)
+    for _ in range(3):
+        journal.record("MockMailer", None, [], time.monotonic())
+
+    await sleep(0.1)
+    assert len(list(read_journal(path))) == 3
+    journal.record("MockMailer", None, [], time.monotonic())
+    await sleep(0.1)
+    assert len(list(read_journal(path))) == 3
+    await journal.close()
+    assert len(list(read_journal(path))) == 4
+
+
+async def test_write_error(path: Path, caplog: pytest.LogCaptureFixture) -> None:
+    journal = DeliveryJournal(path)
+    journal.record("MockMailer", None, [], time.monotonic(), error=object())  # type: ignore[arg-type]
+    await journal.close()
+    assert [record.message for record in caplog.records] == [
+        "Error writing 1 entries to the delivery journal"
+    ]
+
+
+async def test_rotation(path: Path) -> None:
+    journal = DeliveryJournal(path, max_bytes=200, backup_count=2, max_batch=1)
+    for i in range(12):
+        journal.record("MockMailer", f"<{i}@bar.baz>", ["a@b.c"], time.monotonic())
+        await sleep(0.01)
+
+    await journal.close()
+    assert sorted(p.name for p in path.parent.iterdir()) == [
+        "mail.journal",
+        "mail.journal.1",
+        "mail.journal.2",
+    ]
+    assert all(p.stat().st_size <= 200 for p in path.parent.iterdir())
+
+    # The rotated files are read oldest first, and the oldest entries are gone
+    message_ids = [entry.message_id for entry in read_journal(path)]
+    assert message_ids == [f"<{i}@bar.baz>" for i in range(12 - len(message_ids), 12)]
+    assert len(list(read_journal(path, rotated=False))) < len(message_ids)
+
+
+async def test_no_backups(path: Path) -> None:
+    """Test that the journal is never rotated (and so never wiped) without backups."""
+    journal = DeliveryJournal(path, max_bytes=100, backup_count=0, max_batch=1)
+    for i in range(5):
+        journal.record("MockMailer", f"<{i}@bar.baz>", [], time.monotonic())
+        await sleep(0.01)
+
+    await journal.close()
+    assert [p.name for p in path.parent.iterdir()] == ["mail.journal"]
+    assert [entry.message_id for entry in read_journal(path)] == [
+        f"<{i}@bar.baz>" for i in range(5)
+    ]
+
+
+def test_read_truncated(path: Path) -> None:
+    path.parent.mkdir()
+    path.write_text(
+        '[1700000000.0,"MockMailer",null,["a@b.c"],0.01,null,null,null]\n'
+        '[1700000001.0,"MockMailer",nu'
+    )
+    assert [entry.timestamp for entry in read_journal(path)] == [1700000000.0]
+
+
+async def test_mailer(path: Path) -> None:
+    mailer = MockMailer()
+    mailer.journal = DeliveryJournal(path)
+    await mailer.deliver(
+        create_message(message_id="<1@bar.baz>", bcc="hidden@domain.country")
+    )
+    mailer.failure_rate = 1
+    with pytest.raises(DeliveryError):
+        await mailer.deliver(
+            create_message(message_id="<2@bar.baz>", bcc="hidden@domain.country")
+        )
+
+    await mailer.journal.close()
+    entries = list(read_journal(path))
+    assert [
+        (entry.backend, entry.message_id, entry.recipients, entry.error)
+        for entry in entries
+    ] == [
+        (
+            "MockMailer",
+            "<1@bar.baz>",
+            ["test@domain.country", "hidden@domain.country"],
+            None,
+        ),
+        (
+            "MockMailer",
+            "<2@bar.baz>",
+            ["test@domain.country", "hidden@domain.country"],
+            "451 4.3.0 Temporary failure",
+        ),
+    ]
+
+
+async def test_main(path: Path, capsys: pytest.CaptureFixture[str]) -> None:
+    journal = DeliveryJournal(path)
+    started = time.monotonic()
+    journal.record("SMTPMailer", "<1@bar.baz>", ["a@b.c"], started, 250, 1234)
+    journal.record("SMTPMailer", "<2@bar.baz>", ["D@e.f"], started, 550, None, "Nope")
+    await journal.close()
+
+    main([str(path)])
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 2
+    assert lines[0].split("\t")[1:6] == [
+        "SMTPMailer",
+        "250",
+        "<1@bar.baz>",
+        "a@b.c",
+        "1234",
+    ]
+    assert lines[1].split("\t")[-1] == "Nope"
+
+    main([str(path), "--failed"])
+    assert "<2@bar.baz>" in capsys.readouterr().out
+
+    main([str(path), "--recipient", "d@E.f", "--json"])
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 1
+    assert json.loads(lines[0])["message_id"] == "<2@bar.baz>"
+
+    main([str(path), "--message-id", "<3@bar.baz>"])
+    assert capsys.readouterr().out == ""
+
+
+def test_main_missing_file(tmp_path: Path, capsys: pytest.CaptureFixture[str]) -> None:
+    with pytest.raises(SystemExit) as exc:
+        main([str(tmp_path / "nonexistent")])
+
+    assert exc.value.code == 1
+    assert "No such file" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize(
+    "kwargs, message",
+    [
+        pytest.param({"max_bytes": 0}, "max_bytes must be at least 1", id="max_bytes"),
+        pytest.param(
+            {"backup_count": -1}, "backup_count must not be negative", id="backup"
+        ),
+        pytest.param({"max_batch": 0}, "max_batch must be at least 1", id="batch"),
+    ],
+)
+def test_bad_arguments(path: Path, kwargs: dict[str, int], message: str) -> None:
+    with pytest.raises(ValueError, match=message):
+        DeliveryJournal(path, **kwargs)
+
+
+async def test_repr(path: Path) -> None:
+    journal = DeliveryJournal(path)
+    assert repr(journal) == f"DeliveryJournal(path={str(path)!r})"
+    await journal.close()
@@ -0,0 +1,274 @@
+from __future__ import annotations
+
+import logging
+import time
+from asyncio import Event, sleep, wait_for
+from collections.abc import AsyncGenerator
+from datetime import datetime, timedelta, timezone
+from email.message import EmailMessage
+from pathlib import Path
+from typing import Any, cast
+
+import pytest
+from asphalt.mailer.api import MessagesType
+from asphalt.mailer.idempotency import (
+    IdempotencyCache,
+    get_idempotency_key,
+    set_idempotency_key,
+)
+from asphalt.mailer.mailers.mock import MockMailer
+from asphalt.mailer.scheduler import DeliveryScheduler
+from conftest import create_message
+
+pytestmark = pytest.mark.anyio
+
+
+class TimestampingMailer(MockMailer):
+    def __init__(self) -> None:
+        super().__init__()
+        self.timestamps: list[float] = []
+
+    async def deliver(self, messages: MessagesType) -> None:
+        self.timestamps.append(time.monotonic())
+        await super().deliver(messages)
+
+
+@pytest.fixture
+async def mailer() -> AsyncGenerator[MockMailer, None]:
+    mailer = MockMailer()
+    mailer.scheduler = DeliveryScheduler(mailer)
+    await mailer.scheduler.start()
+    yield mailer
+    await mailer.scheduler.close()
+
+
+async def test_deliver_after(mailer: MockMailer) -> None:
+    assert mailer.scheduler is not None
+    await mailer.deliver_after(
+        create_message(subject="second", bcc="hidden@domain.country"), 0.2
+    )
+    await mailer.deliver_after(
+        create_message(subject="first", bcc="hidden@domain.country"),
+        timedelta(seconds=0.1),
+    )
+    assert len(mailer.scheduler) == 2
+    assert len(mailer.messages) == 0
+
+    await wait_for(mailer.messages.wait_for(subject="second"), 2)
+    assert [message["Subject"] for message in mailer.messages] == ["first", "second"]
+    assert mailer.messages[0]["Bcc"] == "hidden@domain.country"
+    assert mailer.messages[0].get_content() == "Hello\n"
+    assert len(mailer.scheduler) == 0
+
+
+async def test_deliver_at(mailer: MockMailer) -> None:
+    await mailer.deliver_at(
+        create_message(subject="past", bcc="hidden@domain.country"),
+        datetime(2020, 1, 1),
+    )
+    await mailer.deliver_at(
+        create_message(subject="future", bcc="hidden@domain.country"),
+        datetime.now(timezone.utc) + timedelta(hours=1),
+    )
+    await wait_for(mailer.messages.wait_for(subject="past"), 2)
+    await sleep(0.1)
+    assert len(mailer.messages) == 1
+    assert mailer.scheduler is not None
+    assert len(mailer.scheduler) == 1
+
+
+async def test_deliver_at_no_scheduler() -> None:
+    mailer = MockMailer()
+    with pytest.raises(RuntimeError, match="no scheduler has been set"):
+        await mailer.deliver_at(
+            create_message(subject="test", bcc="hidden@domain.country"), time.time()
+        )
+
+
+async def test_release_rate() -> None:
+    """Test that messages that are due at the same time are released gradually."""
+    mailer = TimestampingMailer()
+    scheduler = DeliveryScheduler(mailer, release_rate=50)
+    await scheduler.schedule(
+        [create_message(subject=str(i), bcc="hidden@domain.country") for i in range(5)],
+        time.time(),
+    )
+    await wait_for(mailer.messages.wait_for(subject="4"), 2)
+    await scheduler.close()
+
+    assert [message["Subject"] for message in mailer.messages] == list("01234")
+    intervals = [b - a for a, b in zip(mailer.timestamps, mailer.timestamps[1:])]
+    assert min(intervals) >= 0.015
+
+
+async def test_idempotency_key() -> None:
+    mailer = MockMailer()
+    mailer.idempotency_cache = IdempotencyCache()
+    scheduler = DeliveryScheduler(mailer, release_rate=None)
+    message = create_message(subject="test", bcc="hidden@domain.country")
+    set_idempotency_key(message, "abc")
+    await scheduler.schedule([message, message], time.time())
+    await wait_for(mailer.messages.wait_for(subject="test"), 2)
+    await sleep(0.1)
+    await scheduler.close()
+
+    assert len(mailer.messages) == 1
+    assert get_idempotency_key(mailer.messages[0]) == "abc"
+
+
+async def test_delivery_error(caplog: pytest.LogCaptureFixture) -> None:
+    caplog.set_level(logging.ERROR, "asphalt.mailer.scheduler")
+    mailer = MockMailer(failure_rate=1)
+    scheduler = DeliveryScheduler(mailer)
+    await scheduler.schedule(
+        create_message(subject="test", bcc="hidden@domain.country"), time.time()
+    )
+    await sleep(0.1)
+    await scheduler.close()
+
+    assert [record.message for record in caplog.records] == [
+        "Error delivering a scheduled message (Subject: test)"
+    ]
+
+
+async def test_persistence(tmp_path: Path) -> None:
+    path = tmp_path / "spool" / "scheduled"
+    mailer = MockMailer()
+    scheduler = DeliveryScheduler(mailer, path=path)
+    message = create_message(subject="later", bcc="hidden@domain.country")
+    set_idempotency_key(message, "abc")
+    await scheduler.schedule(message, time.time() + 3600)
+    await scheduler.schedule(
+        create_message(subject="now", bcc="hidden@domain.country"), time.time()
+    )
+    await wait_for(mailer.messages.wait_for(subject="now"), 2)
+    await sleep(0.1)
+    await scheduler.close()
+
+    # Simulate a crash in the middle of a write
+    with path.open("ab") as f:
+        f.write(b"A\x00\x01")
+
+    size = path.stat().st_size
+    mailer = MockMailer()
+    scheduler = DeliveryScheduler(mailer, path=path)
+    assert len(scheduler) == 1
+    assert path.stat().st_size < size
+
+    # Reschedule the loaded message to be delivered right away
+    scheduler._heap[0] = (time.time(), *scheduler._heap[0][1:])
+    await scheduler.start()
+    received = await wait_for(mailer.messages.wait_for(subject="later"), 2)
+    await sleep(0.1)
+    await scheduler.close()
+
+    assert received["Bcc"] == "hidden@domain.country"
+    assert get_idempotency_key(received) == "abc"
+
+    # Nothing is pending anymore, so the file has been truncated
+    assert path.stat().st_size == 0
+
+
+async def test_persistence_overlapping_deliveries(tmp_path: Path) -> None:
+    """
+    Test that the file isn't truncated while another due message is still being
+    delivered.
+    """
+
+    class BlockingMailer(MockMailer):
+        def __init__(self) -> None:
+            super().__init__()
+            self.unblock = Event()
+
+        async def deliver(self, messages: MessagesType) -> None:
+            if cast(EmailMessage, messages)["Subject"] == "slow":
+                await self.unblock.wait()
+
+            await super().deliver(messages)
+
+    path = tmp_path / "scheduled"
+    mailer = BlockingMailer()
+    scheduler = DeliveryScheduler(mailer, path=path, release_rate=None)
+    await scheduler.schedule(
+        [
+            create_message(subject="slow", bcc="hidden@domain.country"),
+            create_message(subject="fast", bcc="hidden@domain.country"),
+        ],
+        0,
+    )
+    await wait_for(mailer.messages.wait_for(subject="fast"), 2)
+    await sleep(0.1)
+
+    # If the application crashed now, the slow message would be loaded again
+    crashed_path = tmp_path / "crashed"
+    crashed_path.write_bytes(path.read_bytes())
+    assert len(DeliveryScheduler(MockMailer(), path=crashed_path)) == 1
+
+    mailer.unblock.set()
+    await wait_for(mailer.messages.wait_for(subject="slow"), 2)
+    await scheduler.close()
+    assert path.stat().st_size == 0
+
+
+async def test_compression(tmp_path: Path) -> None:
+    """Test that pending messages are held compressed, and still delivered intact."""
+    path = tmp_path / "scheduled"
+    mailer = MockMailer()
+    message = create_message(subject="compressed", bcc="hidden@domain.country")
+    message.add_attachment(
+        b"\x00" * 100000, "application", "octet-stream", filename="zeros.bin"
+    )
+    size = len(message.as_bytes())
+    scheduler = DeliveryScheduler(mailer, path=path, compression_level=None)
+    await scheduler.schedule(message, time.time() + 3600)
+    assert scheduler.pending_bytes == size
+    await scheduler.close()
+
+    # Messages stored uncompressed can be loaded by a scheduler that compresses them
+    scheduler = DeliveryScheduler(mailer, path=path)
+    await scheduler.schedule(message, time.time() + 3600)
+    assert len(scheduler) == 2
+    assert size < scheduler.pending_bytes < size + size // 10
+    await scheduler.close()
+
+    scheduler = DeliveryScheduler(mailer, path=path)
+    scheduler._heap = [(time.time(), *entry[1:]) for entry in scheduler._heap]
+    await scheduler.start()
+    await wait_for(mailer.messages.wait_for(subject="compressed"), 2)
+    await sleep(0.1)
+    await scheduler.close()
+
+    assert len(mailer.messages) == 2
+    assert scheduler.pending_bytes == 0
+    for received in mailer.messages:
+        attachment = next(received.iter_attachments())
+        assert attachment.get_content() == b"\x00" * 100000
+
+
+@pytest.mark.parametrize(
+    "kwargs, message",
+    [
+        pytest.param(
+            {"release_rate": 0}, "release_rate must be positive", id="release_rate"
+        ),
+        pytest.param(
+            {"max_concurrency": 0},
+            "max_concurrency must be at least 1",
+            id="max_concurrency",
+        ),
+        pytest.param(
+            {"compression_level": 0},
+            "compression_level must be between 1 and 9",
+            id="compression_level",
+        ),
+    ],
+)
+def test_bad_arguments(kwargs: dict[str, Any], message: str) -> None:
+    with pytest.raises(ValueError, match=message):
+        DeliveryScheduler(MockMailer(), **kwargs)
+
+
+def test_repr() -> None:
+    assert repr(DeliveryScheduler(MockMailer())) == (
+        "DeliveryScheduler(mailer=MockMailer(), pending=0)"
+    )
@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import logging
+import time
+from asyncio import sleep
+from typing import Any
+
+import pytest
+from asphalt.mailer.mailers.mock import MockMailer
+from asphalt.mailer.tracing import SpanRecord, Tracer, child_span
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_spans() -> None:
+    records: list[SpanRecord] = []
+    mailer = MockMailer()
+    mailer.tracer = Tracer(handler=records.append)
+    with mailer.trace("newsletter", issue=5):
+        message = mailer.create_message(
+            subject="foo", sender="a@b.c", to="d@e.f", plain_body="Hello"
+        )
+        mailer.add_attachment(message, b"\x00" * 100, "zeros.bin")
+        await mailer.deliver(message)
+
+    assert [(record.name, record.parent) for record in records] == [
+        ("create_message", "newsletter"),
+        ("add_attachment", "newsletter"),
+        ("mock.send", "newsletter"),
+        ("newsletter", None),
+    ]
+    assert len({record.trace_id for record in records}) == 1
+    assert records[1].attributes == {"size": 100}
+    assert records[3].attributes == {"issue": 5}
+    assert records[3].duration >= records[0].duration
+    assert time.time() - 5 < records[3].timestamp <= time.time()
+
+    summary = mailer.tracer.summary()
+    assert summary["create_message"].calls == 1
+    assert summary["newsletter"].max_time == records[3].duration
+    mailer.tracer.reset()
+    assert mailer.tracer.summary() == {}
+
+
+def test_no_tracer() -> None:
+    mailer = MockMailer()
+    with mailer.trace("foo") as span:
+        assert mailer.trace("bar") is span
+        assert child_span("baz") is span
+
+
+def test_attachment_without_span() -> None:
+    """Test that attachments added outside of any span aren't traced."""
+    records: list[SpanRecord] = []
+    mailer = MockMailer()
+    mailer.tracer = Tracer(handler=records.append)
+    message = mailer.create_message(subject="foo")
+    mailer.add_attachment(message, b"foo", "foo.txt")
+    assert [record.name for record in records] == ["create_message"]
+
+
+def test_sampling() -> None:
+    records: list[SpanRecord] = []
+    tracer = Tracer(sample_rate=0.3, handler=records.append, seed=1)
+    for _ in range(100):
+        with tracer.span("parent"):
+            with tracer.span("child"):
+                pass
+
+    parents = {record.trace_id for record in records if record.name == "parent"}
+    children = {record.trace_id for record in records if record.name == "child"}
+    assert 15 < len(parents) < 45
+    assert children == parents
+
+
+def test_error() -> None:
+    records: list[SpanRecord] = []
+    tracer = Tracer(handler=records.append)
+    with pytest.raises(ValueError), tracer.span("foo"):
+        raise ValueError("bar")
+
+    assert isinstance(records[0].error, ValueError)
+
+
+def test_handler_error(caplog: pytest.LogCaptureFixture) -> None:
+    def handler(record: SpanRecord) -> None:
+        raise RuntimeError("boom")
+
+    tracer = Tracer(handler=handler)
+    with tracer.span("foo"):
+        pass
+
+    assert [record.message for record in caplog.records] == ["Error in span handler"]
+    assert tracer.summary()["foo"].calls == 1
+
+
+async def test_lag_probe(caplog: pytest.LogCaptureFixture) -> None:
+    caplog.set_level(logging.WARNING, "asphalt.mailer.tracing")
+    tracer = Tracer(sample_rate=0, lag_threshold=0.05, lag_interval=0.01)
+    await tracer.start()
+    await sleep(0.03)
+    with tracer.span("blocking"):
+        time.sleep(0.1)  # noqa: ASYNC251
+
+    await sleep(0.03)
+    await tracer.close()
+
+    assert len(caplog.records) == 1
+    assert caplog.records[0].message.startswith("Event loop was blocked for ")
+    assert "mailer operations during that time: blocking (" in caplog.records[0].message
+
+    # Stalls are recorded regardless of sampling, but the spans themselves aren't
+    summary = tracer.summary()
+    assert list(summary) == ["event_loop_lag"]
+    assert summary["event_loop_lag"].max_time >= 0.05
+
+
+@pytest.mark.parametrize(
+    "kwargs, message",
+    [
+        pytest.param(
+            {"sample_rate": 1.5}, "sample_rate must be between 0 and 1", id="rate"
+        ),
+        pytest.param(
+            {"lag_threshold": 0}, "lag_threshold must be positive", id="threshold"
+        ),
+        pytest.param(
+            {"lag_interval": 0}, "lag_interval must be positive", id="interval"
+        ),
+    ],
+)
+def test_bad_arguments(kwargs: dict[str, Any], message: str) -> None:
+    with pytest.raises(ValueError, match=message):
+        Tracer(**kwargs)
+
+
+def test_repr() -> None:
+    assert repr(Tracer(0.5)) == "Tracer(sample_rate=0.5)"
+    assert repr(Tracer().span("foo")) == "Span(name='foo', sampled=True)"
+    assert repr(Tracer(0).span("foo")) == "Span(name='foo', sampled=False)"
@@ -1,6 +1,16 @@
+from __future__ import annotations
+
+from collections.abc import AsyncIterable, AsyncIterator, Iterable
 from email.message import EmailMessage
 
-from asphalt.mailer.utils import get_recipients
+import pytest
+from asphalt.mailer.mailers.mock import MockMailer
+from asphalt.mailer.utils import (
+    estimate_size,
+    get_recipients,
+    get_transfer_encoding,
+    iterate_messages,
+)
 
 
 def test_get_recipients() -> None:
@@ -14,3 +24,85 @@ def test_get_recipients() -> None:
         "bar@bar.bar",
         "invisible@reci.pient",
     ]
+
+
+def test_estimate_size() -> None:
+    mailer = MockMailer()
+    msg = mailer.create_message(
+        subject="Hello",
+        sender="foo@example.org",
+        to="bar@example.org",
+        plain_body="Hellö wörld\n" * 100,
+        html_body="<p>Hellö wörld</p>\n" * 100,
+    )
+    mailer.add_attachment(msg, bytes(range(256)) * 400, "data.bin")
+    estimate = estimate_size(msg)
+    assert abs(estimate - len(msg.as_bytes())) < len(msg.as_bytes()) * 0.01
+
+    # Messages not built by a mailer get an estimate computed on the spot
+    plain_msg = EmailMessage()
+    plain_msg["Subject"] = "Hello"
+    plain_msg.set_content("x" * 10000)
+    assert abs(estimate_size(plain_msg) - len(plain_msg.as_bytes())) < 100
+
+
+def test_estimate_size_changed_message() -> None:
+    """Test that changes made after create_message() are reflected in the estimate."""
+    mailer = MockMailer()
+    msg = mailer.create_message(subject="Hello", plain_body="Hello")
+    msg.add_attachment(
+        b"\0" * 1_000_000, maintype="application", subtype="octet-stream"
+    )
+    assert abs(estimate_size(msg) - len(msg.as_bytes())) < 1000
+
+
+def test_estimate_size_8bit() -> None:
+    """Test that multibyte characters in 8-bit bodies are counted as bytes."""
+    mailer = MockMailer()
+    msg = mailer.create_message(subject="Hello", plain_body="Hellö wörld\n" * 1000)
+    assert msg["Content-Transfer-Encoding"] == "8bit"
+    assert abs(estimate_size(msg) - len(msg.as_bytes())) < 100
+
+
+@pytest.mark.parametrize(
+    "text, charset, allow_8bit, expected",
+    [
+        pytest.param("Hello world\n", "utf-8", False, "7bit", id="ascii"),
+        pytest.param("x" * 999, "utf-8", True, "quoted-printable", id="ascii_long"),
+        pytest.param("Hellö wörld\n" * 10, "utf-8", True, "8bit", id="8bit"),
+        pytest.param(
+            "Hello wörld, how are you?\n",
+            "utf-8",
+            False,
+            "quoted-printable",
+            id="mostly_ascii",
+        ),
+        pytest.param("Привет, мир\n", "utf-8", False, "base64", id="non_latin"),
+        pytest.param("ö" * 999, "utf-8", True, "base64", id="8bit_long"),
+        pytest.param("Hello world\n", "utf-16", True, "base64", id="utf16"),
+    ],
+)
+def test_get_transfer_encoding(
+    text: str, charset: str, allow_8bit: bool, expected: str
+) -> None:
+    assert get_transfer_encoding(text, charset, allow_8bit) == expected
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("source", ["single", "iterable", "async_iterable"])
+async def test_iterate_messages(source: str) -> None:
+    async def generate_messages() -> AsyncIterator[EmailMessage]:
+        for message in messages:
+            yield message
+
+    messages = [EmailMessage(), EmailMessage()]
+    argument: EmailMessage | Iterable[EmailMessage] | AsyncIterable[EmailMessage]
+    if source == "single":
+        messages = messages[:1]
+        argument = messages[0]
+    elif source == "iterable":
+        argument = iter(messages)
+    else:
+        argument = generate_messages()
+
+    assert [message async for message in iterate_messages(argument)] == messages